@@ -0,0 +1,206 @@
+#*******************************************************************************
+#                                                                             
+#	Philippe GIRARD 
+# 	Université Paris Cité, CNRS, Institut Jacques Monod, F-75013 Paris, France
+#
+# 	benchmarkFRET.py
+#	Release v1.0
+#
+#	Copyright 2022 - AGPL-3.0 License
+#                                                                             
+#******************************************************************************/
+
+
+#@ File(label="nuclearFRET.py script", description="Script whose functions are benchmarked", style="file") scriptFile
+#@ File(label="Output folder", description="Folder of the benchmark tables", style="directory") outputFolder
+#@ String(label="Image sizes (pixels)", description="Comma separated sizes of the square images", value="1024,2048,4096,8192,16384") sizes
+#@ String(label="Numbers of nuclei", description="Comma separated numbers of nuclei", value="10,100,1000,5000") counts
+#@ Integer(label="Repetitions", value=1) repetitions
+#@ String(label="Watershed factors", description="Comma separated factors of the pyramid watershed compared with factor 1", value="1,2,4") watershedFactors
+#@ Boolean(label="Save the synthetic images", description="Save each image and its ground truth for nuclearFRET.py", value=false) saveImages
+
+# Benchmark of the stages of nuclearFRET.py on synthetic images with a known FRET index per nucleus :
+# - benchmark.csv : time and throughput of each stage for each image size and number of nuclei (scaling curves)
+# - accuracy.csv : error of the mean FRET index of the nuclei and IoU of the segmentation against the ground truth, and
+#   agreement of the native preprocessing and FRET index of nuclearFRET.py with the numerical core
+# - watershed.csv : time and peak heap of the pyramid watershed for each factor, IoU of its labels with factor 1
+
+import os
+import sys
+
+from ij import IJ, ImagePlus
+from ij.io import FileSaver
+from ij.process import FloatProcessor, Blitter, ImageStatistics
+from ij.measure import Measurements
+from ij.gui import OvalRoi
+from ij.plugin.filter import EDM
+
+from inra.ijpb.label import LabelImages
+
+from java.lang import System, Exception as JavaException, OutOfMemoryError
+from java.lang.management import ManagementFactory, MemoryType
+from jarray import array as javaArray
+
+sys.path.insert(0, scriptFile.getParent())
+sys.path.insert(0, os.path.join(scriptFile.getParent(), "benchmark"))
+import nuclearFRET as nf
+from syntheticFRET import generateNuclei, generateImage, saveGroundTruth
+
+background = 100.0 # background of the synthetic images, subtracted as a constant
+saturation = 4095
+
+
+## time of the stages of one configuration
+class StageTimer:
+	def __init__(self, table, size, count, repetition):
+		self.table = table
+		self.key = [size, count, repetition]
+		self.pixels = size * size
+		self.count = count
+
+	def run(self, stage, function, *args):
+		start = System.nanoTime()
+		result = function(*args)
+		seconds = (System.nanoTime() - start) / 1e9
+		self.table.addRow(self.key + [stage, self.pixels, seconds, self.pixels / max(seconds, 1e-9) / 1e6,
+			self.count / max(seconds, 1e-9)])
+		return result
+
+# Preprocessing of both channels as in the STEP 2 of nuclearFRET.py
+def preprocess(impDonnor_, impAcceptor_):
+	for imp in (impDonnor_, impAcceptor_) :
+		nf.removeSaturatedPixels(imp, saturation, nf.gaussianSigma)
+		imp.getProcessor().subtract(background)
+
+# Heap used by the JVM (MB) after a garbage collection, the peaks of the memory pools being reset
+def resetPeakHeap():
+	System.gc()
+	for pool in ManagementFactory.getMemoryPoolMXBeans() :
+		pool.resetPeakUsage()
+	return ManagementFactory.getMemoryMXBean().getHeapMemoryUsage().getUsed() / 1048576.0
+
+# Peak of the heap (MB) since resetPeakHeap : sum of the peaks of the heap memory pools
+def getPeakHeap():
+	return sum(pool.getPeakUsage().getUsed() for pool in ManagementFactory.getMemoryPoolMXBeans()
+		if pool.getType() == MemoryType.HEAP) / 1048576.0
+
+# Number of NaN pixels of a 32-bit image
+def countNaN(ip_):
+	return ip_.getPixelCount() - ImageStatistics.getStatistics(ip_, Measurements.AREA, None).pixelCount
+
+# Native preprocessing and FRET index of nuclearFRET.py against the numerical core (purecore, itself compared with
+# numpycore by fretcore.crosscheck) : the NaN pixels of removeSaturatedPixels must be the saturatedIndices of the raw
+# channels and the FRET index of computeFRETIndex the core.fretIndex of the preprocessed channels
+# Return True if the NaN pixels are the same, and the maximum absolute difference of the FRET index
+def checkCore(ipRawDonnor_, ipRawAcceptor_, ipDonnor_, ipAcceptor_, ipFRET_):
+	sameNaN = True
+	for ipRaw, ip in ((ipRawDonnor_, ipDonnor_), (ipRawAcceptor_, ipAcceptor_)) :
+		indices = nf.core.saturatedIndices(ipRaw.convertToFloatProcessor().getPixels(), saturation)
+		fp = ip.duplicate()
+		nf.core.setNaN(fp.getPixels(), indices)
+		sameNaN = sameNaN and countNaN(ip) == len(indices) == countNaN(fp)
+	fret = nf.core.fretIndex(ipDonnor_.getPixels(), ipAcceptor_.getPixels())[0]
+	fpDiff = FloatProcessor(ipFRET_.getWidth(), ipFRET_.getHeight(), fret)
+	count = countNaN(fpDiff)
+	fpDiff.copyBits(ipFRET_, 0, 0, Blitter.DIFFERENCE) # NaN where either index is NaN
+	sameNaN = sameNaN and countNaN(ipFRET_) == count == countNaN(fpDiff)
+	fpDiff.resetMinAndMax()
+	return sameNaN, fpDiff.getMax()
+
+# Marker-controlled watershed with one marker at the center of each nucleus and one background marker farther than
+# 3 pixels from the nuclei, the background label being removed. Pyramid watershed if factor_ > 1
+def segment(impProj_, ipTruth_, nuclei_, factor_=1):
+	fp = FloatProcessor(ipTruth_.getWidth(), ipTruth_.getHeight())
+	mask = ipTruth_.convertToByteProcessor(False)
+	mask.threshold(0)
+	outside = EDM().makeFloatEDM(mask, 255, False).getPixels()
+	markers = fp.getPixels()
+	backgroundLabel = len(nuclei_) + 1
+	for i in xrange(len(markers)) :
+		if outside[i] > 3 :
+			markers[i] = backgroundLabel
+	for label, x, y, radius, fret in nuclei_ :
+		fp.setValue(label)
+		fp.fill(OvalRoi(x - 2, y - 2, 5, 5))
+	impLabel = nf.computePyramidWatershed(impProj_, ImagePlus("Marker Image", fp), factor_)
+	LabelImages.replaceLabels(impLabel.getProcessor(), javaArray([backgroundLabel], 'f'), 0.0)
+	return impLabel
+
+# Per-nucleus measurement as in the STEP 4 of nuclearFRET.py
+def measure(impLabel_, ipFRET_, labels_):
+	pool = nf.BufferPool()
+	fpLabelOut, dist = nf.labelDistanceTransform(impLabel_.getProcessor(), max(nf.bandOuter, nf.nucleiDilation), pool)
+	keep = [False] * (max(labels_) + 1)
+	for label in labels_ :
+		keep[label] = True
+	fpBandLabels, fpDilated, boxes, profilePixels, outside = nf.getEnvelope(fpLabelOut, dist, keep, nf.bandInner,
+		nf.bandOuter, nf.nucleiDilation, nf.profileDepth, nf.profileBin, pool)
+	nf.measureBand(ipFRET_, outside, profilePixels, pool)
+	return nf.measureLabels(fpDilated, ipFRET_, impLabel_.getCalibration(), labels_)
+
+# Benchmark of one configuration, the accuracy is measured on the ground truth labels
+def benchmark(size_, count_, repetition_, timings_, accuracy_, watershed_):
+	nuclei = generateNuclei(size_, count_, seed_=repetition_)
+	imp, impTruth = generateImage(size_, nuclei, background_=background, saturation_=saturation, seed_=repetition_)
+	if saveImages :
+		name = "synthetic_%d_%d_%d" % (size_, count_, repetition_)
+		FileSaver(imp).saveAsTiff(os.path.join(outputFolder.getPath(), name + ".tif"))
+		saveGroundTruth(nuclei, os.path.join(outputFolder.getPath(), name + ".csv"))
+	stack = imp.getStack()
+	impProj = ImagePlus("MAX", stack.getProcessor(1).duplicate())
+	impProj.getProcessor().copyBits(stack.getProcessor(2), 0, 0, Blitter.MAX)
+	impDonnor = ImagePlus("Donnor", stack.getProcessor(1))
+	impAcceptor = ImagePlus("Acceptor", stack.getProcessor(2))
+	imp = None
+
+	timer = StageTimer(timings_, size_, count_, repetition_)
+	timer.run("removeSaturatedPixels", preprocess, impDonnor, impAcceptor)
+	impFRET = timer.run("CalculationFRETIndex", nf.CalculationFRETIndex, impDonnor, impAcceptor, False, None, False)[0]
+	coreNaN, coreDiff = checkCore(stack.getProcessor(1), stack.getProcessor(2), impDonnor.getProcessor(),
+		impAcceptor.getProcessor(), impFRET.getProcessor())
+	impDonnor = impAcceptor = stack = None
+	impLabel = timer.run("watershed", segment, impProj, impTruth.getProcessor(), nuclei)
+	rois = timer.run("L2R", nf.L2R, impLabel)
+	timer.run("measurement", measure, impLabel, impFRET.getProcessor(), rois.keys())
+
+	#accuracy against the ground truth
+	truth = dict((label, fret) for label, x, y, radius, fret in nuclei)
+	stats = nf.measureLabels(impTruth.getProcessor(), impFRET.getProcessor(), impTruth.getCalibration())
+	errors = [abs(values[1] - truth[label]) for label, values in stats.items() if values[1] == values[1]]
+	ious = nf.getLabelIoU(impLabel.getProcessor(), impTruth.getProcessor())
+	iouTruth = [ious.get(label, 0.0) for label in truth]
+	accuracy_.addRow([size_, count_, repetition_, len(rois), len(truth),
+		sum(errors) / len(errors) if errors else float("nan"), max(errors) if errors else float("nan"),
+		sum(iouTruth) / len(iouTruth), min(iouTruth), coreNaN, coreDiff])
+	print "%dx%d, %d nuclei : %.2f s, FRET error %.3f %%, IoU %.3f" % (size_, size_, count_,
+		sum(timings_.columns["Seconds"][-5:]), accuracy_.columns["MeanAbsError"][-1], accuracy_.columns["MeanIoU"][-1])
+
+	#pyramid watershed against the full resolution one
+	for factor in [int(s) for s in watershedFactors.split(",") if s.strip()] :
+		baseHeap = resetPeakHeap()
+		start = System.nanoTime()
+		impFactor = segment(impProj, impTruth.getProcessor(), nuclei, factor)
+		seconds = (System.nanoTime() - start) / 1e9
+		peakHeap = getPeakHeap()
+		ious = nf.getLabelIoU(impFactor.getProcessor(), impLabel.getProcessor()).values()
+		watershed_.addRow([size_, count_, repetition_, factor, seconds, baseHeap, peakHeap,
+			sum(ious) / len(ious) if ious else float("nan"), min(ious) if ious else float("nan")])
+		impFactor = None
+
+
+timings = nf.ColumnTable(["Size", "Nuclei", "Repetition", "Stage", "Pixels", "Seconds", "MPixelsPerSecond", "NucleiPerSecond"])
+accuracy = nf.ColumnTable(["Size", "Nuclei", "Repetition", "Detected", "Truth", "MeanAbsError", "MaxAbsError", "MeanIoU", "MinIoU", "CoreSameNaN", "CoreMaxAbsDiff"])
+watershed = nf.ColumnTable(["Size", "Nuclei", "Repetition", "Factor", "Seconds", "BaseHeapMB", "PeakHeapMB", "MeanIoU", "MinIoU"])
+for size in [int(s) for s in sizes.split(",") if s.strip()] :
+	for count in [int(s) for s in counts.split(",") if s.strip()] :
+		for repetition in range(1, repetitions + 1) :
+			try :
+				benchmark(size, count, repetition, timings, accuracy, watershed)
+			except (Exception, JavaException, OutOfMemoryError), e :
+				print "%dx%d, %d nuclei : failed - %s" % (size, size, count, e)
+				timings.addRow([size, count, repetition, "failed", size * size, float("nan"), float("nan"), float("nan")])
+			IJ.freeMemory()
+timings.saveAs(os.path.join(outputFolder.getPath(), "benchmark.csv"))
+accuracy.saveAs(os.path.join(outputFolder.getPath(), "accuracy.csv"))
+watershed.saveAs(os.path.join(outputFolder.getPath(), "watershed.csv"))
+print 'End'
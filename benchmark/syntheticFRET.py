@@ -0,0 +1,87 @@
+#*******************************************************************************
+#                                                                             
+#	Philippe GIRARD 
+# 	Université Paris Cité, CNRS, Institut Jacques Monod, F-75013 Paris, France
+#
+# 	syntheticFRET.py
+#	Release v1.0
+#
+#	Copyright 2022 - AGPL-3.0 License
+#                                                                             
+#******************************************************************************/
+
+# Synthetic multichannel images of nuclei with a known FRET index, for the benchmark of nuclearFRET.py
+# Channel 1 (Donnor) = (1-E).S and channel 2 (Acceptor) = E.S, where S is the intensity of a nucleus (bright envelope and
+# dimmer interior) and E its FRET efficiency : the FRET index A/(D+A)*100 of the nucleus is 100.E
+
+import os
+from math import sqrt, ceil
+
+from ij import ImagePlus, ImageStack
+from ij.process import ImageProcessor, FloatProcessor
+from ij.gui import OvalRoi
+from ij.plugin.filter import GaussianBlur
+
+from java.util import Random, Collections, ArrayList
+
+
+# Nuclei (label, xcenter, ycenter, radius, FRET index in %) on a jittered grid of an image of size_ x size_ pixels,
+# without overlap, with a FRET index drawn uniformly in fretRange_
+def generateNuclei(size_, count_, fretRange_=(20.0, 60.0), seed_=1):
+	random = Random(seed_)
+	grid = int(ceil(sqrt(count_)))
+	cell = float(size_) / grid
+	cells = ArrayList(range(grid * grid))
+	Collections.shuffle(cells, random)
+	nuclei_ = []
+	for label in range(1, count_ + 1) :
+		k = cells.get(label - 1)
+		jitter = lambda : (random.nextDouble() - 0.5) * 0.1 * cell
+		x = (k % grid + 0.5) * cell + jitter()
+		y = (k // grid + 0.5) * cell + jitter()
+		radius = cell * (0.24 + 0.12 * random.nextDouble())
+		fret = fretRange_[0] + (fretRange_[1] - fretRange_[0]) * random.nextDouble()
+		nuclei_.append((label, x, y, radius, fret))
+	return nuclei_
+
+# Two-channel 16-bit image of the nuclei and the ground truth label image. The envelope (2 pixels thick) is rim_ times
+# brighter than the interior of intensity_, the channels are blurred (blur_), added to the background and to a
+# Gaussian noise (noise_), and clipped at saturation_
+def generateImage(size_, nuclei_, intensity_=1500.0, rim_=2.5, background_=100.0, noise_=30.0, saturation_=4095, blur_=1.0, seed_=1):
+	fpDonnor = FloatProcessor(size_, size_)
+	fpAcceptor = FloatProcessor(size_, size_)
+	fpLabel = FloatProcessor(size_, size_)
+	for label, x, y, radius, fret in nuclei_ :
+		e = fret / 100.0
+		outer = OvalRoi(x - radius, y - radius, 2 * radius, 2 * radius)
+		inner = OvalRoi(x - radius + 2, y - radius + 2, 2 * radius - 4, 2 * radius - 4)
+		for fp, fraction in ((fpDonnor, 1 - e), (fpAcceptor, e)) :
+			fp.setValue(fraction * intensity_ * rim_)
+			fp.fill(outer)
+			fp.setValue(fraction * intensity_)
+			fp.fill(inner)
+		fpLabel.setValue(label)
+		fpLabel.fill(outer)
+	ImageProcessor.setRandomSeed(seed_)
+	stack = ImageStack(size_, size_)
+	for fp, name in ((fpDonnor, "Donnor"), (fpAcceptor, "Acceptor")) :
+		if blur_ > 0 :
+			GaussianBlur().blurGaussian(fp, blur_, blur_, 0.002)
+		fp.add(background_)
+		fp.noise(noise_)
+		fp.max(saturation_)
+		fp.min(0)
+		stack.addSlice(name, fp.convertToShortProcessor(False))
+	imp_ = ImagePlus("Synthetic nuclei %dx%d (%d)" % (size_, size_, len(nuclei_)), stack)
+	imp_.setDimensions(2, 1, 1)
+	return imp_, ImagePlus("Ground truth labels", fpLabel)
+
+# Save the ground truth of the nuclei as a csv file
+def saveGroundTruth(nuclei_, path_):
+	f = open(path_, "w")
+	try :
+		f.write("Label,X,Y,Radius,FRET index (%)\n")
+		for label, x, y, radius, fret in nuclei_ :
+			f.write("%d,%.3f,%.3f,%.3f,%.5f\n" % (label, x, y, radius, fret))
+	finally :
+		f.close()
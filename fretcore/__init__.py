@@ -0,0 +1,24 @@
+#*******************************************************************************
+#
+#	Philippe GIRARD
+# 	Université Paris Cité, CNRS, Institut Jacques Monod, F-75013 Paris, France
+#
+# 	fretcore
+#	Release v1.0
+#
+#	Copyright 2022 - AGPL-3.0 License
+#
+#******************************************************************************/
+
+# Numerical core of nuclearFRET.py, independent of ImageJ : background subtraction, saturation masking, FRET index,
+# thresholding, intersection over union of labels, nuclear envelope and contour sampling on flat arrays of pixels
+# - purecore : pure Python, used by nuclearFRET.py in Fiji (Jython) on the pixels of the ImageJ processors
+# - numpycore : the same functions vectorized with NumPy (CPython)
+# - parallel : FRET index of large images by blocks of rows in a process pool (CPython)
+# - crosscheck : comparison of both backends (python -m fretcore.crosscheck)
+# core is numpycore when NumPy is available, purecore otherwise
+
+try :
+	from fretcore import numpycore as core
+except ImportError :
+	from fretcore import purecore as core
@@ -0,0 +1,128 @@
+#*******************************************************************************
+#
+#	Philippe GIRARD
+# 	Université Paris Cité, CNRS, Institut Jacques Monod, F-75013 Paris, France
+#
+# 	crosscheck.py
+#	Release v1.0
+#
+#	Copyright 2022 - AGPL-3.0 License
+#
+#******************************************************************************/
+
+# Comparison of the pure Python and NumPy backends of fretcore on random images (zeros, saturated and NaN pixels, labels
+# with a signed distance, contour points inside and outside the image) : python -m fretcore.crosscheck [size] [seed]
+# The images must be equal (NaN at the same pixels) and the sums equal to a relative tolerance. Exit code 1 on a mismatch
+
+import sys
+from array import array
+
+import numpy as np
+
+from fretcore import purecore, numpycore, parallel
+
+tolerance = 1e-12 # relative tolerance of the sums
+
+
+def toArray(values_):
+	return array('f', np.asarray(values_, np.float32).reshape(-1).tobytes())
+
+def sameImage(pure_, vectorized_):
+	return np.array_equal(np.frombuffer(pure_, np.float32), np.asarray(vectorized_, np.float32).reshape(-1), equal_nan=True)
+
+# Histogram of the pixels on the 65536 levels of a 16-bit image (values clamped to [0, 65535], NaN excluded)
+def histogram16(pixels_):
+	p = pixels_[~np.isnan(pixels_)]
+	return np.bincount(np.clip(p, 0.0, 65535.0).astype(np.intp), minlength=65536).tolist()
+
+def sameValues(a_, b_):
+	if isinstance(a_, dict) :
+		return isinstance(b_, dict) and sorted(a_) == sorted(b_) and all(sameValues(a_[k], b_[k]) for k in a_)
+	if isinstance(a_, (list, tuple)) :
+		return len(a_) == len(b_) and all(sameValues(a, b) for a, b in zip(a_, b_))
+	if a_ != a_ :
+		return b_ != b_
+	return abs(a_ - b_) <= tolerance * max(abs(a_), abs(b_), 1.0)
+
+def randomImages(size_, seed_):
+	rng = np.random.RandomState(seed_)
+	donor = rng.uniform(0, 4200, (size_, size_)).astype(np.float32)
+	acceptor = rng.uniform(0, 4200, (size_, size_)).astype(np.float32)
+	donor[rng.uniform(size=donor.shape) < 0.02] = np.nan
+	acceptor[rng.uniform(size=acceptor.shape) < 0.02] = 0
+	cell = 8
+	labels = np.kron(rng.randint(0, 20, (size_ // cell + 1, size_ // cell + 1)), np.ones((cell, cell)))[:size_, :size_]
+	dist = rng.uniform(-15, 10, (size_, size_)).astype(np.float32)
+	keep = rng.uniform(size=20) < 0.8
+	xs = rng.uniform(-2, size_ + 2, 500).astype(np.float32)
+	ys = rng.uniform(-2, size_ + 2, 500).astype(np.float32)
+	return donor, acceptor, labels.astype(np.float32), dist, keep, xs, ys
+
+def crosscheck(size_=256, seed_=1):
+	donor, acceptor, labels, dist, keep, xs, ys = randomImages(size_, seed_)
+	checks = []
+
+	indices = purecore.saturatedIndices(toArray(donor), 4095)
+	checks.append(("saturatedIndices", list(indices) == numpycore.saturatedIndices(donor, 4095).tolist()))
+	pure = purecore.setNaN(toArray(donor), indices)
+	checks.append(("setNaN", sameImage(pure, numpycore.setNaN(donor.copy(), indices))))
+
+	histogram = histogram16(donor)
+	checks.append(("histogramPercentile", all(sameValues(purecore.histogramPercentile(h, q, lo, hi),
+		numpycore.histogramPercentile(h, q, lo, hi)) for h, q, lo, hi in ((histogram, 20, 0, None),
+		(histogram, 50, 100, 3000), ([0] * 10, 50, 0, None)))))
+	rng = np.random.RandomState(seed_)
+	grid = rng.uniform(100, 200, 12 * 9)
+	grid[rng.uniform(size=grid.size) < 0.4] = np.nan # cells without background pixels
+	checks.append(("fillGrid", sameValues(purecore.fillGrid(grid.tolist(), 12, 9), numpycore.fillGrid(grid, 12, 9).tolist())
+		and sameValues(purecore.fillGrid([float("nan")] * 4, 2, 2), [0.0] * 4)))
+
+	histogram = histogram16(acceptor)
+	bins, lo, width = purecore.binHistogram(histogram)
+	bins_, lo_, width_ = numpycore.binHistogram(histogram)
+	checks.append(("binHistogram", bins == bins_.tolist() and (lo, width) == (lo_, width_)))
+	checks.append(("binLevels", list(purecore.binLevels(toArray(acceptor), lo, width))
+		== numpycore.binLevels(acceptor, lo, width).tolist()))
+
+	fret, err, vmin, vmax = purecore.fretIndex(toArray(donor), toArray(acceptor), True)
+	fret_, err_, vmin_, vmax_ = numpycore.fretIndex(donor, acceptor, True)
+	checks.append(("fretIndex", sameImage(fret, fret_) and sameImage(err, err_) and (vmin, vmax) == (vmin_, vmax_)))
+	fretParallel, errParallel, vminParallel, vmaxParallel = parallel.fretIndex(donor, acceptor, True, 2, size_ // 3)
+	checks.append(("parallel.fretIndex", sameImage(fret, fretParallel) and sameImage(err, errParallel)
+		and (vmin, vmax) == (vminParallel, vmaxParallel)))
+	pureDonor, pureAcceptor = toArray(donor), toArray(acceptor)
+	purecore.fretIndex(pureDonor, pureAcceptor, True, True)
+	vectorizedDonor, vectorizedAcceptor = donor.copy(), acceptor.copy()
+	numpycore.fretIndex(vectorizedDonor, vectorizedAcceptor, True, True)
+	checks.append(("fretIndex (inPlace)", sameImage(pureDonor, fret_) and sameImage(pureAcceptor, err_)
+		and sameImage(fret, vectorizedDonor) and sameImage(err, vectorizedAcceptor)))
+	fretImage = np.frombuffer(fret, np.float32).reshape(donor.shape)
+
+	checks.append(("labelIoU", sameValues(purecore.labelIoU(toArray(labels), toArray(labels.T)),
+		numpycore.labelIoU(labels, labels.T))))
+	empty = np.zeros((0, 0))
+	checks.append(("labelIoU (empty)", sameValues(purecore.labelIoU(toArray(empty), toArray(empty)),
+		numpycore.labelIoU(empty, empty)) and numpycore.labelIoU(empty, empty) == {}))
+
+	pure = purecore.envelope(toArray(labels), toArray(dist), size_, keep.tolist(), 1, 2, 2, 10, 1)
+	vectorized = numpycore.envelope(labels, dist, size_, keep, 1, 2, 2, 10, 1)
+	checks.append(("envelope", all(sameImage(pure[i], vectorized[i]) for i in range(2)) and pure[2] == vectorized[2]
+		and all(list(pure[3][i]) == vectorized[3][i].tolist() for i in range(3))))
+	checks.append(("radialProfiles", sameValues(purecore.radialProfiles(fret, pure[3]),
+		numpycore.radialProfiles(fretImage, vectorized[3]))))
+
+	for bilinear in (False, True) :
+		pure = purecore.sampleContour(fret, size_, size_, toArray(xs), toArray(ys), bilinear)
+		vectorized = numpycore.sampleContour(fretImage, size_, size_, xs, ys, bilinear)
+		checks.append(("sampleContour (bilinear=%s)" % bilinear, list(pure[0]) == vectorized[0].tolist()
+			and all(sameImage(pure[i], vectorized[i]) for i in range(1, 4))))
+	return checks
+
+
+if __name__ == "__main__" :
+	size = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+	seed = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+	checks = crosscheck(size, seed)
+	for name, ok in checks :
+		print("%-30s %s" % (name, "OK" if ok else "MISMATCH"))
+	sys.exit(0 if all(ok for name, ok in checks) else 1)
@@ -0,0 +1,215 @@
+#*******************************************************************************
+#
+#	Philippe GIRARD
+# 	Université Paris Cité, CNRS, Institut Jacques Monod, F-75013 Paris, France
+#
+# 	numpycore.py
+#	Release v1.0
+#
+#	Copyright 2022 - AGPL-3.0 License
+#
+#******************************************************************************/
+
+# Numerical core of nuclearFRET.py vectorized with NumPy (CPython) : the same functions as purecore on flat arrays of
+# pixels (2D arrays are flattened row by row). The computations are made in float64 and the images returned in float32
+# like purecore, so that both backends give the same values (the sums are accumulated in the order of the pixels)
+
+from math import ceil
+
+import numpy as np
+
+
+def _flat(pixels_, dtype_=None):
+	return np.asarray(pixels_, dtype=dtype_).reshape(-1)
+
+
+#### Preprocessing
+
+# Indices of the 0-value and saturated pixels (< 1 or >= saturation_)
+def saturatedIndices(pixels_, saturation_, indices_=None):
+	p = _flat(pixels_)
+	return np.flatnonzero((p < 1) | (p >= saturation_))
+
+# NaN at the indices_ of the pixels, in place (pixels_ must be a float NumPy array)
+def setNaN(pixels_, indices_):
+	pixels_.reshape(-1)[np.asarray(indices_, dtype=np.intp)] = np.nan
+	return pixels_
+
+
+#### Background estimation
+
+# Percentile of the pixels counted by a 16-bit histogram : see purecore.histogramPercentile
+def histogramPercentile(histogram_, q_, lo_=0, hi_=None):
+	counts = np.asarray(histogram_, np.int64)
+	hi_ = len(counts) - 1 if hi_ is None else hi_
+	cumulative = np.cumsum(counts[lo_:hi_ + 1])
+	if len(cumulative) == 0 or cumulative[-1] == 0 :
+		return float("nan")
+	rank = max(int(ceil(q_ / 100.0 * cumulative[-1])), 1)
+	return lo_ + int(np.searchsorted(cumulative, rank)) + 0.5
+
+# Cells without background pixels filled from their neighbours : see purecore.fillGrid
+def fillGrid(grid_, gw_, gh_):
+	grid = np.array(grid_, np.float64).reshape(gh_, gw_)
+	if np.isnan(grid).all() :
+		return np.zeros(gw_ * gh_)
+	while np.isnan(grid).any() :
+		previous = np.pad(grid, 1, mode="constant", constant_values=np.nan)
+		total = np.zeros((gh_, gw_))
+		count = np.zeros((gh_, gw_), np.intp)
+		for dy in (0, 1, 2) :
+			for dx in (0, 1, 2) :
+				g = previous[dy:dy+gh_, dx:dx+gw_]
+				ok = ~np.isnan(g)
+				total += np.where(ok, g, 0.0)
+				count += ok
+		fill = np.isnan(grid) & (count > 0)
+		grid[fill] = total[fill] / count[fill]
+	return grid.reshape(-1)
+
+
+#### Histogram
+
+# Histogram of nbins_ bins between the first and the last occupied levels : see purecore.binHistogram
+def binHistogram(histogram_, nbins_=256):
+	histogram = np.asarray(histogram_)
+	occupied = np.flatnonzero(histogram)
+	if len(occupied) == 0 :
+		return np.zeros(nbins_, np.intp), 0, 1.0
+	lo = int(occupied[0])
+	width = (int(occupied[-1]) - lo + 1) / float(nbins_)
+	b = np.minimum(((occupied - lo) / width).astype(np.intp), nbins_ - 1)
+	return np.bincount(b, weights=histogram[occupied], minlength=nbins_).astype(np.intp), lo, width
+
+# Bin of each pixel in the bins of binHistogram (int8), 0 for NaN : see purecore.binLevels
+def binLevels(pixels_, lo_, width_, nbins_=256):
+	p = _flat(pixels_, np.float64)
+	nan = np.isnan(p)
+	levels = np.clip(np.where(nan, 0.0, p), 0.0, 65535.0).astype(np.intp)
+	b = np.clip(((levels - lo_) / width_).astype(np.intp), 0, nbins_ - 1)
+	b[nan] = 0
+	return b.astype(np.uint8).view(np.int8)
+
+
+#### FRET index
+
+# FRET index A/(D+A)*100 : see purecore.fretIndex
+# inPlace_ : the index is written in donor_ and the error in acceptor_ (float32 arrays)
+def fretIndex(donor_, acceptor_, error_=False, inPlace_=False):
+	a = _flat(acceptor_, np.float64)
+	s = _flat(donor_, np.float64) + a
+	with np.errstate(divide="ignore", invalid="ignore") :
+		e = np.where(s >= 1.0, a / s, np.nan)
+		valid = (e >= 0.0) & (e <= 1.0)
+		v = np.where(valid, 100.0 * e, np.nan)
+		err_ = np.where(valid, 100.0 * np.sqrt(e * (1.0 - e) / s), np.nan).astype(np.float32) if error_ else None
+	if valid.any() :
+		vmin, vmax = float(v[valid].min()), float(v[valid].max())
+	else :
+		vmin, vmax = float(np.finfo(np.float32).max), -float(np.finfo(np.float32).max)
+	if inPlace_ :
+		_flat(donor_)[:] = v
+		if error_ :
+			_flat(acceptor_)[:] = err_
+		return donor_, acceptor_ if error_ else None, vmin, vmax
+	return v.astype(np.float32), err_, vmin, vmax
+
+
+#### Labels
+
+# Intersection over union of each label of two label images {label : IoU}
+def labelIoU(labelsA_, labelsB_):
+	a = _flat(labelsA_).astype(np.intp)
+	b = _flat(labelsB_).astype(np.intp)
+	if a.size == 0 : # empty label image : no label, as purecore
+		return {}
+	size = max(a.max(), b.max(), 0) + 1
+	na = np.bincount(a[a > 0], minlength=size)
+	nb = np.bincount(b[b > 0], minlength=size)
+	both = np.bincount(a[(a > 0) & (a == b)], minlength=size)
+	labels = np.flatnonzero((na > 0) | (nb > 0))
+	return dict((int(l), float(both[l]) / (na[l] + nb[l] - both[l])) for l in labels)
+
+
+#### Nuclear envelope
+
+# Band labels, dilated labels, boxes of the bands and pixels of the radial profiles : see purecore.envelope
+def envelope(labels_, dist_, width_, keep_, inner_, outer_, dilation_, depth_, bin_):
+	labels = _flat(labels_).astype(np.intp)
+	d = _flat(dist_, np.float64)
+	keep = np.asarray(keep_, dtype=bool)
+	inside = (labels > 0) & (labels < len(keep))
+	inside[inside] = keep[labels[inside]]
+	band = inside & (d >= -inner_) & (d <= outer_)
+	bandLabels_ = np.where(band, labels, 0).astype(np.float32)
+	dilatedLabels_ = np.where(inside & (d <= dilation_), labels, 0).astype(np.float32)
+
+	boxes_ = {}
+	idx = np.flatnonzero(band)
+	if len(idx) > 0 :
+		lab = labels[idx]
+		x = idx % width_
+		y = idx // width_
+		size = lab.max() + 1
+		xmin = np.full(size, np.iinfo(np.intp).max)
+		ymin = np.full(size, np.iinfo(np.intp).max)
+		xmax = np.full(size, -1)
+		ymax = np.full(size, -1)
+		np.minimum.at(xmin, lab, x)
+		np.minimum.at(ymin, lab, y)
+		np.maximum.at(xmax, lab, x)
+		np.maximum.at(ymax, lab, y)
+		for label in np.unique(lab).tolist() :
+			boxes_[label] = [int(xmin[label]), int(ymin[label]), int(xmax[label]), int(ymax[label])]
+
+	indices = np.flatnonzero(inside & (d >= -depth_) & (d <= outer_))
+	bins = np.floor(d[indices] / bin_).astype(np.intp)
+	return bandLabels_, dilatedLabels_, boxes_, (indices, labels[indices], bins)
+
+# Radial profiles of the FRET index on the pixels of envelope : see purecore.radialProfiles
+def radialProfiles(fret_, pixels_):
+	indices, labels, bins = pixels_
+	f = _flat(fret_, np.float64)[indices]
+	sel = ~np.isnan(f)
+	profiles_ = {}
+	if sel.any() :
+		lab = labels[sel]
+		b = bins[sel]
+		offset = b.min()
+		span = b.max() - offset + 1
+		key = lab * span + (b - offset)
+		counts = np.bincount(key)
+		sums = np.bincount(key, weights=f[sel])
+		for k in np.flatnonzero(counts).tolist() :
+			profiles_.setdefault(k // span, {})[int(k % span + offset)] = [int(counts[k]), float(sums[k])]
+	return profiles_
+
+
+#### Contours
+
+# Values of the image at the points of a contour : see purecore.sampleContour
+def sampleContour(pixels_, width_, height_, xs_, ys_, bilinear_=False):
+	pixels = _flat(pixels_, np.float64)
+	x = _flat(xs_, np.float64)
+	y = _flat(ys_, np.float64)
+	if bilinear_ :
+		u = np.clip(x - 0.5, 0.0, width_ - 1.0)
+		v = np.clip(y - 0.5, 0.0, height_ - 1.0)
+		x0 = np.minimum(u.astype(np.intp), width_ - 2) if width_ > 1 else np.zeros(len(u), np.intp)
+		y0 = np.minimum(v.astype(np.intp), height_ - 2) if height_ > 1 else np.zeros(len(v), np.intp)
+		x1 = np.minimum(x0 + 1, width_ - 1)
+		y1 = np.minimum(y0 + 1, height_ - 1)
+		fx = u - x0
+		fy = v - y0
+		top = pixels[y0*width_+x0] + fx * (pixels[y0*width_+x1] - pixels[y0*width_+x0])
+		bottom = pixels[y1*width_+x0] + fx * (pixels[y1*width_+x1] - pixels[y1*width_+x0])
+		values = top + fy * (bottom - top)
+		inside = (x >= 0) & (y >= 0) & (x < width_) & (y < height_)
+	else :
+		xi = x.astype(np.intp) # truncation toward 0 like int()
+		yi = y.astype(np.intp)
+		inside = (xi >= 0) & (yi >= 0) & (xi < width_) & (yi < height_)
+		values = np.full(len(x), np.nan)
+		values[inside] = pixels[yi[inside]*width_+xi[inside]]
+	idx = np.flatnonzero(inside & ~np.isnan(values) & (values != 0))
+	return idx, x[idx].astype(np.float32), y[idx].astype(np.float32), values[idx].astype(np.float32)
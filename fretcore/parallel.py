@@ -0,0 +1,41 @@
+#*******************************************************************************
+#
+#	Philippe GIRARD
+# 	Université Paris Cité, CNRS, Institut Jacques Monod, F-75013 Paris, France
+#
+# 	parallel.py
+#	Release v1.0
+#
+#	Copyright 2022 - AGPL-3.0 License
+#
+#******************************************************************************/
+
+# FRET index of large images with numpycore in a process pool (CPython) : the pixels are independent, the Donnor and
+# Acceptor images are split in blocks of rows computed by the workers and the blocks are gathered in order
+
+from multiprocessing import Pool
+
+import numpy as np
+
+from fretcore import numpycore
+
+
+def _fretBlock(args_):
+	donor, acceptor, error = args_
+	return numpycore.fretIndex(donor, acceptor, error)
+
+# FRET index, its error (None if error_ is False) and its range [vmin, vmax] of 2D Donnor and Acceptor images, by blocks
+# of rows_ rows on processes_ workers (number of CPUs if None). Same result as numpycore.fretIndex on the whole images
+def fretIndex(donor_, acceptor_, error_=False, processes_=None, rows_=512):
+	donor = np.asarray(donor_)
+	acceptor = np.asarray(acceptor_)
+	blocks = [(donor[y:y+rows_], acceptor[y:y+rows_], error_) for y in range(0, donor.shape[0], rows_)]
+	pool = Pool(processes_)
+	try :
+		results = pool.map(_fretBlock, blocks)
+	finally :
+		pool.close()
+		pool.join()
+	fret_ = np.concatenate([r[0] for r in results]).reshape(donor.shape)
+	err_ = np.concatenate([r[1] for r in results]).reshape(donor.shape) if error_ else None
+	return fret_, err_, min(r[2] for r in results), max(r[3] for r in results)
@@ -0,0 +1,280 @@
+#*******************************************************************************
+#
+#	Philippe GIRARD
+# 	Université Paris Cité, CNRS, Institut Jacques Monod, F-75013 Paris, France
+#
+# 	purecore.py
+#	Release v1.0
+#
+#	Copyright 2022 - AGPL-3.0 License
+#
+#******************************************************************************/
+
+# Numerical core of nuclearFRET.py in pure Python, without ImageJ : the images are flat arrays of pixels (row by row,
+# index y*width+x). Runs in Jython (Fiji) on the Java arrays of the ImageJ processors and in CPython on array('f') or
+# lists. The new images are float32 arrays : Java float[] in Jython, array('f') in CPython
+
+from array import array
+from math import sqrt, floor, ceil
+
+try :
+	xrange
+except NameError : # CPython 3
+	xrange = range
+
+try :
+	from jarray import zeros as _zeros # Jython : arrays usable by the FloatProcessor of ImageJ
+	def newFloats(n_):
+		return _zeros(n_, 'f')
+	def newBytes(n_):
+		return _zeros(n_, 'b')
+except ImportError :
+	def newFloats(n_):
+		return array('f', [0.0]) * n_
+	def newBytes(n_):
+		return array('b', [0]) * n_
+
+nan = float("nan")
+maxFloat = 3.4028234663852886e38 # Float.MAX_VALUE
+
+
+#### Preprocessing
+
+# Indices of the 0-value and saturated pixels (< 1 or >= saturation_), in indices_ if given (reusable array('i'))
+def saturatedIndices(pixels_, saturation_, indices_=None):
+	if indices_ is None :
+		indices_ = array('i')
+	del indices_[:]
+	for i in xrange(len(pixels_)) :
+		v = pixels_[i]
+		if v < 1 or v >= saturation_ :
+			indices_.append(i)
+	return indices_
+
+# NaN at the indices_ of the pixels, in place
+def setNaN(pixels_, indices_):
+	for i in indices_ :
+		pixels_[i] = nan
+	return pixels_
+
+
+#### Background estimation
+
+# Robust background : percentile q_ (0-100) of the pixels counted by a 16-bit histogram (the masked histogram of the
+# pixels outside the objects), at the center of the level of the percentile. Only the levels lo_ to hi_ are read (range
+# of the pixels, all levels by default). NaN if there is no pixel
+def histogramPercentile(histogram_, q_, lo_=0, hi_=None):
+	hi_ = len(histogram_) - 1 if hi_ is None else hi_
+	total = 0
+	for level in xrange(lo_, hi_ + 1) :
+		total += histogram_[level]
+	if total == 0 :
+		return nan
+	rank = max(int(ceil(q_ / 100.0 * total)), 1)
+	cumulative = 0
+	for level in xrange(lo_, hi_ + 1) :
+		cumulative += histogram_[level]
+		if cumulative >= rank :
+			return level + 0.5
+	return nan
+
+# Background surface on a grid of gw_ x gh_ cells (row by row) : the cells without background pixels (NaN) get the mean
+# of their neighbours, pass after pass. Return the filled grid, zeros if there is no background pixel at all
+def fillGrid(grid_, gw_, gh_):
+	grid = list(grid_)
+	if all(g != g for g in grid) :
+		return [0.0] * (gw_ * gh_)
+	while any(g != g for g in grid) :
+		previous = list(grid)
+		for gy in xrange(gh_) :
+			for gx in xrange(gw_) :
+				if previous[gy * gw_ + gx] == previous[gy * gw_ + gx] :
+					continue
+				total = 0.0
+				count = 0
+				for ny in xrange(max(gy - 1, 0), min(gy + 2, gh_)) :
+					for nx in xrange(max(gx - 1, 0), min(gx + 2, gw_)) :
+						g = previous[ny * gw_ + nx]
+						if g == g :
+							total += g
+							count += 1
+				if count > 0 :
+					grid[gy * gw_ + gx] = total / count
+	return grid
+
+
+#### Histogram
+
+# Histogram of nbins_ bins between the first and the last occupied levels lo and hi of a 16-bit histogram (the 256 bins
+# of the automatic thresholds of ImageJ). Return the bins, lo and the width of a bin in levels
+def binHistogram(histogram_, nbins_=256):
+	bins = [0] * nbins_
+	occupied = [i for i in xrange(len(histogram_)) if histogram_[i] > 0]
+	if not occupied :
+		return bins, 0, 1.0
+	lo = occupied[0]
+	width = (occupied[-1] - lo + 1) / float(nbins_)
+	for i in occupied :
+		bins[min(int((i - lo) / width), nbins_ - 1)] += histogram_[i]
+	return bins, lo, width
+
+# Bin of each pixel (signed bytes for an 8-bit image) in the bins of binHistogram, 0 for NaN
+def binLevels(pixels_, lo_, width_, nbins_=256):
+	levels_ = newBytes(len(pixels_))
+	for i in xrange(len(pixels_)) :
+		v = pixels_[i]
+		if v == v :
+			b = min(max(int((int(min(max(v, 0.0), 65535.0)) - lo_) / width_), 0), nbins_ - 1)
+			levels_[i] = b - 256 if b > 127 else b
+	return levels_
+
+
+#### FRET index
+
+# FRET index A/(D+A)*100 in one pass on the Donnor and Acceptor pixels. Pixels with D+A < 1 or an index outside [0,100]
+# are NaN. The optional error is the shot-noise standard deviation of the index 100*sqrt(E(1-E)/(D+A))
+# Return the index, its error (None if error_ is False) and the range [vmin, vmax] of the index
+# inPlace_ : the index is written in donor_ and the error in acceptor_ (no new image)
+def fretIndex(donor_, acceptor_, error_=False, inPlace_=False):
+	n = len(donor_)
+	fret_ = donor_ if inPlace_ else newFloats(n)
+	err_ = (acceptor_ if inPlace_ else newFloats(n)) if error_ else None
+	vmin = maxFloat
+	vmax = -maxFloat
+	for i in xrange(n) :
+		a = acceptor_[i]
+		s = donor_[i] + a
+		e = a / s if s >= 1.0 else nan # NaN if D+A is NaN or < 1
+		if 0.0 <= e <= 1.0 :
+			v = 100.0 * e
+			fret_[i] = v
+			if v < vmin :
+				vmin = v
+			if v > vmax :
+				vmax = v
+			if error_ :
+				err_[i] = 100.0 * sqrt(e * (1.0 - e) / s)
+		else :
+			fret_[i] = nan
+			if error_ :
+				err_[i] = nan
+	return fret_, err_, vmin, vmax
+
+
+#### Labels
+
+# Intersection over union of each label of two label images {label : IoU}
+def labelIoU(labelsA_, labelsB_):
+	counts = {} # label : [pixels in A, pixels in B, pixels in both]
+	for i in xrange(len(labelsA_)) :
+		a = int(labelsA_[i])
+		b = int(labelsB_[i])
+		if a > 0 :
+			counts.setdefault(a, [0, 0, 0])[0] += 1
+			if a == b :
+				counts[a][2] += 1
+		if b > 0 :
+			counts.setdefault(b, [0, 0, 0])[1] += 1
+	return dict((label, float(both) / (na + nb - both)) for label, (na, nb, both) in counts.items())
+
+
+#### Nuclear envelope
+
+# Nuclear envelope from the signed distance dist_ to the envelope (negative inside), in one pass on the pixels of the
+# kept labels (keep_[label] True). It does not depend on the FRET index and is computed once for all the frames :
+# - labels of the band : pixels at a distance -inner_ <= d <= outer_ of the envelope
+# - labels of the nuclei dilated by dilation_
+# - boxes of the bands {label : [xmin, ymin, xmax, ymax]}
+# - pixels of the radial profiles (-depth_ <= d <= outer_) : indices, labels and bins of width bin_ for radialProfiles
+def envelope(labels_, dist_, width_, keep_, inner_, outer_, dilation_, depth_, bin_):
+	n = len(labels_)
+	bandLabels_, dilatedLabels_ = newFloats(n), newFloats(n)
+	boxes_ = {}
+	indices, labels, bins = array('i'), array('i'), array('i')
+	for y in xrange(n // width_) :
+		offset = y * width_
+		for x in xrange(width_) :
+			i = offset + x
+			label = int(labels_[i])
+			if label == 0 or label >= len(keep_) or not keep_[label] :
+				continue
+			d = dist_[i]
+			if d <= dilation_ :
+				dilatedLabels_[i] = label
+			if -inner_ <= d <= outer_ :
+				bandLabels_[i] = label
+				box = boxes_.get(label)
+				if box is None :
+					boxes_[label] = [x, y, x, y]
+				else :
+					if x < box[0] :
+						box[0] = x
+					if x > box[2] :
+						box[2] = x
+					box[3] = y
+			if -depth_ <= d <= outer_ :
+				indices.append(i)
+				labels.append(label)
+				bins.append(int(floor(d / bin_)))
+	return bandLabels_, dilatedLabels_, boxes_, (indices, labels, bins)
+
+# Radial profiles of the FRET index (NaN excluded) on the pixels of envelope : {label : {bin : [count, sum]}}
+def radialProfiles(fret_, pixels_):
+	indices, labels, bins = pixels_
+	profiles_ = {}
+	for k in xrange(len(indices)) :
+		f = fret_[indices[k]]
+		if f != f :
+			continue
+		profile = profiles_.get(labels[k])
+		if profile is None :
+			profile = profiles_[labels[k]] = {}
+		acc = profile.get(bins[k])
+		if acc is None :
+			profile[bins[k]] = [1, f]
+		else :
+			acc[0] += 1
+			acc[1] += f
+	return profiles_
+
+
+#### Contours
+
+# Values of the image at the points (xs_, ys_) of a contour : pixel containing the point or bilinear interpolation
+# between the centers of the pixels. Points outside the image, NaN and 0 values are dropped
+# Return the indices of the kept points, their coordinates and their values
+def sampleContour(pixels_, width_, height_, xs_, ys_, bilinear_=False):
+	idx = array('i')
+	xs = array('f')
+	ys = array('f')
+	values = array('f')
+	for i in xrange(len(xs_)) :
+		x = xs_[i]
+		y = ys_[i]
+		if bilinear_ :
+			if x < 0 or y < 0 or x >= width_ or y >= height_ :
+				continue
+			u = min(max(x - 0.5, 0.0), width_ - 1.0) # half pixel of the border : value of the border pixels
+			v = min(max(y - 0.5, 0.0), height_ - 1.0)
+			x0 = min(int(u), width_ - 2) if width_ > 1 else 0
+			y0 = min(int(v), height_ - 2) if height_ > 1 else 0
+			x1 = min(x0 + 1, width_ - 1)
+			y1 = min(y0 + 1, height_ - 1)
+			fx = u - x0
+			fy = v - y0
+			top = pixels_[y0*width_+x0] + fx * (pixels_[y0*width_+x1] - pixels_[y0*width_+x0])
+			bottom = pixels_[y1*width_+x0] + fx * (pixels_[y1*width_+x1] - pixels_[y1*width_+x0])
+			value = top + fy * (bottom - top)
+		else :
+			xi = int(x)
+			yi = int(y)
+			if xi < 0 or yi < 0 or xi >= width_ or yi >= height_ :
+				continue
+			value = pixels_[yi*width_+xi]
+		if value != value or value == 0 : # NaN or 0
+			continue
+		idx.append(i)
+		xs.append(x)
+		ys.append(y)
+		values.append(value)
+	return idx, xs, ys, values
@@ -0,0 +1,172 @@
+#*******************************************************************************
+#
+#	Philippe GIRARD
+# 	Université Paris Cité, CNRS, Institut Jacques Monod, F-75013 Paris, France
+#
+# 	store.py
+#	Release v1.0
+#
+#	Copyright 2022 - AGPL-3.0 License
+#
+#******************************************************************************/
+
+# Append-only store of the results of all the series of the batch mode, in pure Python (Jython and CPython) :
+# one folder per table (runs, nuclei, contours, profiles, cells) holding CSV parts keyed by File and Serie.
+# Each writer (a batch run) writes its own parts of each table, so that several batches can fill the same store
+# concurrently, and the threads of a batch share its writer : the rows are buffered and written in blocks under a lock.
+# Each block is a new part written in a temporary file renamed when complete : an interrupted write only leaves a
+# temporary file that the readers ignore, and a part is never rewritten
+# Summary of a value by condition : python -m fretcore.store <store folder> [value] [table] [column of the groups]
+
+import os
+import sys
+import csv
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from math import sqrt
+
+flushRows = 10000 # rows of a table buffered before being written
+
+
+def _formatValue(value_):
+	if value_ is None :
+		return ""
+	if isinstance(value_, float) :
+		return "NaN" if value_ != value_ else repr(value_)
+	if sys.version_info[0] < 3 and isinstance(value_, unicode) :
+		return value_.encode("utf-8")
+	return str(value_)
+
+def _openCsv(path_, mode_):
+	if sys.version_info[0] < 3 :
+		return open(path_, mode_ + "b")
+	return open(path_, mode_, newline="", encoding="utf-8")
+
+
+## writer of a store : buffered rows of each table, appended to the parts of this writer
+class ResultStore:
+	def __init__(self, folder, flushRows=flushRows):
+		self.folder = folder
+		self.flushRows = flushRows
+		self.writerId = "%s-%s" % (time.strftime("%Y%m%d-%H%M%S"), uuid.uuid4().hex[:8])
+		self.lock = threading.Lock()
+		self.buffers = OrderedDict() # table : [columns, rows]
+		self.parts = 0 # number of parts written
+		if not os.path.isdir(folder) :
+			try :
+				os.makedirs(folder)
+			except OSError : # created by another writer
+				pass
+
+	# append rows (lists of values in the order of columns) to a table, written when flushRows rows are buffered
+	def append(self, table, columns, rows):
+		with self.lock :
+			buffer = self.buffers.get(table)
+			if buffer is None :
+				buffer = self.buffers[table] = [list(columns), []]
+			elif buffer[0] != list(columns) :
+				raise ValueError("columns of the table %s changed: %s" % (table, ", ".join(columns)))
+			buffer[1].extend(rows)
+			if len(buffer[1]) >= self.flushRows :
+				self.write(table)
+
+	def flush(self):
+		with self.lock :
+			for table in self.buffers :
+				self.write(table)
+
+	def close(self):
+		self.flush()
+
+	# write the buffered rows of a table in a new part of the writer (the store must be locked)
+	def write(self, table):
+		columns, rows = self.buffers[table]
+		if not rows :
+			return
+		folder = os.path.join(self.folder, table)
+		if not os.path.isdir(folder) :
+			try :
+				os.makedirs(folder)
+			except OSError :
+				pass
+		self.parts += 1
+		path = os.path.join(folder, "part-%s-%06d.csv" % (self.writerId, self.parts))
+		f = _openCsv(path + ".tmp", "w")
+		try :
+			writer = csv.writer(f)
+			writer.writerow([_formatValue(c) for c in columns])
+			writer.writerows([_formatValue(v) for v in row] for row in rows)
+		finally :
+			f.close()
+		os.rename(path + ".tmp", path) # the complete part is visible to the readers
+		del rows[:]
+
+
+#### Queries
+
+# Rows of a table of a store, all parts together : OrderedDict {column : value} with the values as strings
+def readTable(folder_, table_):
+	folder = os.path.join(folder_, table_)
+	if not os.path.isdir(folder) :
+		return
+	for name in sorted(os.listdir(folder)) :
+		if not name.endswith(".csv") : # temporary file of a part being written
+			continue
+		f = _openCsv(os.path.join(folder, name), "r")
+		try :
+			reader = csv.reader(f)
+			columns = next(reader, None)
+			if columns is None :
+				continue
+			for row in reader :
+				if len(row) == len(columns) :
+					yield OrderedDict(zip(columns, row))
+		finally :
+			f.close()
+
+# Statistics of a list of numbers : count, mean, standard deviation, median, min and max
+def describe(values_):
+	values = sorted(values_)
+	n = len(values)
+	if n == 0 :
+		return OrderedDict([("count", 0)])
+	mean = sum(values) / n
+	std = sqrt(sum((v - mean) ** 2 for v in values) / (n - 1)) if n > 1 else 0.0
+	median = values[n // 2] if n % 2 else (values[n // 2 - 1] + values[n // 2]) / 2.0
+	return OrderedDict([("count", n), ("mean", mean), ("std", std), ("median", median), ("min", values[0]), ("max", values[-1])])
+
+# Summary of the column value_ of a table (NaN excluded) by groups of the values of the columns by_. The columns of the
+# runs table (Condition, FRETtype, Donor, ...) are joined by File and Serie. where_ is an optional filter of the rows
+# Return OrderedDict {group (tuple) : statistics}
+def summarize(folder_, value_="Mean", table_="nuclei", by_=("Condition",), where_=None):
+	runs = dict(((run["File"], run["Serie"]), run) for run in readTable(folder_, "runs"))
+	groups = {}
+	for row in readTable(folder_, table_) :
+		run = runs.get((row.get("File"), row.get("Serie")), {})
+		if where_ is not None and not where_(row, run) :
+			continue
+		try :
+			v = float(row[value_])
+		except (KeyError, ValueError) :
+			continue
+		if v != v :
+			continue
+		key = tuple(row[c] if c in row else run.get(c, "") for c in by_)
+		groups.setdefault(key, []).append(v)
+	return OrderedDict((key, describe(groups[key])) for key in sorted(groups))
+
+
+if __name__ == "__main__" :
+	if len(sys.argv) < 2 :
+		print("usage: python -m fretcore.store <store folder> [value] [table] [column of the groups, ...]")
+		sys.exit(1)
+	value = sys.argv[2] if len(sys.argv) > 2 else "Mean"
+	table = sys.argv[3] if len(sys.argv) > 3 else "nuclei"
+	by = sys.argv[4:] or ["Condition"]
+	summary = summarize(sys.argv[1], value, table, by)
+	statistics = ("count", "mean", "std", "median", "min", "max")
+	print(",".join(list(by) + list(statistics)))
+	for key, stats in summary.items() :
+		print(",".join(list(key) + [_formatValue(stats.get(s)) for s in statistics]))
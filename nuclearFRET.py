@@ -11,11 +11,14 @@
 #******************************************************************************/
 
 
-#@ File(label="LSM Multidimensional file", description="Select a Hyperstack CTZ-(Series or not) file ", style="file") inputFile
+#@ File(label="LSM Multidimensional file", description="Select a Hyperstack CTZ-(Series or not) file ", style="file", required=false) inputFile
 #@ String (label="Type of FRET analysis", description="Select the object to analyze ", choices={"Nuclei", "Whole cell"}, style="radioButtonHorizontal") FRETtype
 #@ Boolean(label="Choose values for background subtraction", description="Values for background subtraction",value=False, persist=True) backgroundSubtract
 #@ Double(label="Background intensity level of Donor channel", description="Background intensity level of donor?",value=140, persist=True)  backgroundDonor
 #@ Double(label="Background intensity level of Acceptor channel", description="Background intensity level of acceptor?",value=140, persist=True)  backgroundAcceptor
+#@ String(label="Automatic background", description="Estimate the background of each channel without values or selection", choices={"None", "Percentile", "Surface"}, style="radioButtonHorizontal", persist=True) backgroundAuto
+#@ Boolean(label="Automatic markers of the nuclei", description="Find the markers of the watershed and the background without selection",value=False, persist=True) autoMarkers
+#@ File(label="Batch parameter file (optional)", description="Analyze every series of a list of files or folders without dialog", style="file", required=false) parameterFile
 
 
 
@@ -32,63 +35,127 @@ from os import path
 from collections import OrderedDict
 
 import sys
+import re
+import threading
+import hashlib
+import json
+import shutil
+from array import array
 
 
 # ImageJ Library ----------------------------------------------------------------------------
-from ij import IJ, ImagePlus,  Prefs, WindowManager
-from ij.process import ImageConverter, ByteProcessor, AutoThresholder,  FloatPolygon, ImageStatistics
+from ij import IJ, ImagePlus, Prefs
+from ij.process import ImageProcessor, ByteProcessor, FloatProcessor, AutoThresholder,  FloatPolygon, ImageStatistics, Blitter
 from ij.gui import GenericDialog, WaitForUserDialog, PlotWindow, ProfilePlot, Overlay, Line, Wand
-from ij.gui import Plot, Roi, PointRoi,PolygonRoi, OvalRoi, ShapeRoi
-from ij.plugin import ZAxisProfiler, ZProjector
-from ij.plugin import RoiEnlarger
-from ij.plugin import ImageCalculator as IC
+from ij.gui import Plot, Roi, PointRoi,PolygonRoi, OvalRoi
+from ij.plugin import RoiScaler, Binner
 from ij.measure import ResultsTable , Measurements, Calibration
-from ij.plugin.filter import Analyzer
+from ij.plugin.filter import Analyzer, GaussianBlur, EDM, ThresholdToSelection, RankFilters
 from ij.plugin.frame import RoiManager
 from ij.text import TextWindow
+from ij.io import RoiDecoder, RoiEncoder, FileSaver
 
 # Loci Library ------------------------------------------------------------------------------------------
-from loci.formats import ImageReader
-from loci.formats import MetadataTools
-from loci.plugins.in import ImporterOptions
-from loci.plugins import BF
+from loci.formats import ChannelSeparator
+from loci.formats import MetadataTools, FormatTools
+from loci.formats.out import OMETiffWriter
+from loci.common import DataTools
+from loci.plugins.util import ImageProcessorReader, LociPrefs
+from ome.units import UNITS
+from ome.units.quantity import Length
+from ome.xml.model.primitives import PositiveInteger
 
 
 # MorphoLibJ Library ---------------------------------------------------------------------------------------
 from inra.ijpb.watershed import Watershed, MarkerControlledWatershedTransform2D
 from inra.ijpb.binary import BinaryImages
 from inra.ijpb.label import LabelImages
+from inra.ijpb.morphology import MinimaAndMaxima, Reconstruction
+from inra.ijpb.measure.region2d import BoundingBox
 from inra.ijpb.color.ColorMaps import CommonLabelMaps
 from inra.ijpb.color import CommonColors
 
 # Java class ---------------------------------------------------------------------------------------
 from java.lang import Float
-from java.awt import Color
-from java.awt.event import AdjustmentListener  
+from java.lang import Exception as JavaException
+from java.lang import Runtime, System, Math
+from java.lang import Long
+from java.lang.management import ManagementFactory
+from java.util.concurrent import Callable, Executors, Semaphore, TimeUnit
+from java.util import Properties, IdentityHashMap
+from java.util.zip import ZipInputStream, ZipOutputStream, ZipEntry
+from java.io import FileInputStream, FileOutputStream, BufferedOutputStream, ByteArrayOutputStream, InputStreamReader
+from jarray import zeros
+from jarray import array as javaArray
+from java.awt import Color, Rectangle
+from java.awt.event import AdjustmentListener, ActionListener
+from java.awt.image import IndexColorModel
+from javax.swing import Timer
 from java.awt.image import BufferedImage
-from java.awt.geom import Rectangle2D, Ellipse2D
 
-from  javafx.geometry import Point2D
-from  math import isnan
+from  math import isnan, sqrt, pi, floor, ceil
 
-from org.jfree.chart import ChartPanel, JFreeChart
-from org.jfree.chart.axis import NumberAxis
-from org.jfree.chart.plot import XYPlot
-from org.jfree.chart.renderer.xy import XYLineAndShapeRenderer
-from org.jfree.data.xy import XYDataset, XYSeries, XYSeriesCollection
+# Numerical core : fretcore folder next to the script (or in Fiji.app/jars/Lib) ------------------------------------------
+try :
+	sys.path.append(path.dirname(path.abspath(__file__)))
+except NameError : # __file__ is not defined when the script is run from the script editor
+	pass
+from fretcore import purecore as core
+from fretcore.store import ResultStore
 
 #---------------------------------------------------------------
 #---------------          CONSTANTS            -----------------
 #---------------------------------------------------------------
 setconcat = False
 showomexml = False
-autoscale = False
+autoscale = False # display range of the FRET index image : [min,max] of the index if True, [0,100] if False
 Prefs.blackBackground = True
 
 
 showRoiManager = False # show RoiManager
 
 FRETTitle = "FRET index (%)" #Title of the RT for FRET measurements
+FRETErrorTitle = "FRET index error (%)" #Title of the shot-noise error image of the FRET index
+FRETError = False # compute and save the FRET index error image
+
+saturationLevel = None # pixels >= saturationLevel are saturated, None : 2^(bit depth)-1 from the OME metadata
+gaussianSigma = 2.0 # sigma of the Gaussian blur of the Donnor and Acceptor images
+
+contourSpacing = 0 # arc-length resampling of the contours at this spacing (pixels), 0 : points of the interpolated polygon
+contourBilinear = False # FRET index of the contour points by bilinear interpolation (False : pixel containing the point)
+nucleiDilation = 2 # dilation (pixels) of the nuclei labels for the measurement of the mean FRET index
+bandInner = 1 # nuclear band : pixels of the nucleus at distance <= bandInner of the envelope
+bandOuter = 2 # nuclear band : pixels outside the nucleus at distance <= bandOuter of the envelope
+profileDepth = 10 # radial profile of the FRET index from profileDepth pixels inside the nucleus to bandOuter outside
+profileBin = 1 # width (pixels) of the bins of the radial profile
+pixelParameters = ("sigma", "dilation", "spacing", "markerDynamic", "markerMinRadius", "backgroundMargin", "bandInner", "bandOuter", "profileDepth", "profileBin") # in pixels of the full resolution image
+numericalParameters = ("saturation", "sigma", "dilation", "spacing", "markerDynamic", "markerMinRadius", "backgroundMargin", "watershedFactor", "tileSize", "tileFactor", "bandInner", "bandOuter", "profileDepth", "profileBin", "backgroundPercentile", "backgroundGrid")
+precision = 5 # decimal places of the result tables
+
+markersFile = "RoiSet_Markers.zip" # markers of the watershed saved in the folder of each serie
+markerDynamic = 2.0 # automatic markers : dynamic (pixels) of the maxima of the distance map of the nuclei
+markerMinRadius = 3.0 # automatic markers : minimum distance (pixels) of a marker to the border of its nucleus
+backgroundMargin = 5.0 # automatic markers : minimum distance (pixels) of the background marker to the nuclei
+watershedFactor = 1 # watershed on the projection downsampled by this factor then refined at full resolution (1 : full resolution)
+cacheSize = 2048 # batch mode : size limit (MB) of the cache of the preprocessed images and labels
+tileSize = 0 # batch mode : read and process the series in tiles of this size (pixels), 0 : whole planes
+tileFactor = 4 # batch mode by tiles : downsampling factor of the images used for the segmentation and the measurements (outputs in full resolution pixels)
+watershedCheck = False # compare the pyramid watershed to the full resolution watershed (IoU of each nucleus in the log)
+backgroundFile = "RoiSet_Background.zip" # background ROI saved in the folder of each serie
+# FRET pairs for the detection of the Donnor and Acceptor channels, in the order of preference :
+# (name, (donor emission range in nm, words of the channel names), (acceptor emission range in nm, words of the channel names))
+fretPairs = [
+	("CFP/YFP", ((460, 500), ("CFP", "Cerulean", "Turquoise", "mTFP")), ((515, 545), ("YFP", "Venus", "Citrine", "YPet"))),
+	("GFP/RFP", ((500, 515), ("GFP", "Clover", "Emerald")), ((575, 625), ("RFP", "Cherry", "Ruby", "Scarlet", "Tomato"))),
+	("BFP/GFP", ((435, 460), ("BFP", "Azurite", "Sapphire")), ((500, 515), ("GFP", "Clover", "Emerald"))),
+	("Cy3/Cy5", ((555, 580), ("Cy3",)), ((655, 690), ("Cy5",))),
+]
+backgroundPercentile = 50.0 # automatic background : percentile of the pixels below the Otsu threshold of the channel
+backgroundGrid = 64 # automatic background surface : size (pixels) of the cells of the grid
+imageExtensions = ".lsm,.czi" # default extensions of the files analyzed in batch mode
+storeFlushRows = 10000 # batch mode : rows of a table of the results store buffered before being written
+lowMemory = False # batch mode : in-place stages, reuse of the float images and release of the images once used
+bufferPoolSize = 4 # low-memory mode : released float images of each size kept for reuse
 
 IJ.setForegroundColor(255, 255, 255) # set foreground color to white
 
@@ -98,28 +165,726 @@ IJ.setForegroundColor(255, 255, 255) # set foreground color to white
 #---------------------------------------------------------------
 
 
-## threshold class
-class ThresholdPreviewer(AdjustmentListener):  
-	def __init__(self, imp, sliders):  
-		self.imp = imp   
-		#self.currentSlice = imp.getCurrentSlice()
-		self.sliders = sliders  
+## thresholds of an image from its 16-bit histogram computed once : the AutoThresholder methods are evaluated on the
+## 256 bins between its first and last occupied levels (like ImageJ for the 16-bit images) and cached by method
+## The histogram is the native one of the 16-bit image, or of a 32-bit image converted to the nearest 16-bit levels
+## (clamped to [0, 65535]) without its NaN pixels
+class ThresholdEngine:
+	def __init__(self, ip):
+		self.ip = ip
+		self.width = ip.getWidth()
+		self.height = ip.getHeight()
+		if ip.getBitDepth() == 16 :
+			self.histogram = list(ip.getHistogram())
+		else :
+			self.histogram = list(ip.convertToShortProcessor(False).getHistogram())
+			if ip.getBitDepth() == 32 : # the NaN pixels are converted to 0
+				self.histogram[0] -= ip.getPixelCount() - ImageStatistics.getStatistics(ip, Measurements.AREA, None).pixelCount
+		self.cumulative = array('l', [0]) * (len(self.histogram) + 1) # cumulative[v] : pixels below the level v
+		for v, count in enumerate(self.histogram) :
+			self.cumulative[v+1] = self.cumulative[v] + count
+		self.bins, self.lo, self.binWidth = core.binHistogram(self.histogram, 256)
+		self.thresholds = {}
+
+	# (min, max) of an AutoThresholder method ("MaxEntropy dark" : objects brighter than the background) like ImageJ :
+	# the threshold level of the method on the 256 bins is converted to the 16-bit levels of the bins
+	def getThresholds(self, method_):
+		thresholds_ = self.thresholds.get(method_)
+		if thresholds_ is None :
+			words = method_.split()
+			level = AutoThresholder().getThreshold(AutoThresholder.Method.valueOf(words[0]), javaArray(self.bins, 'i'))
+			bound = self.lo + (level + 1) * self.binWidth
+			thresholds_ = self.thresholds[method_] = (bound, 65535.0) if "dark" in words[1:] else (0.0, bound)
+		return thresholds_
+
+	# number of pixels (NaN excluded) with a 16-bit level in [min_, max_]
+	def getCount(self, min_, max_):
+		lo = min(max(int(ceil(min_)), 0), 65536)
+		hi = min(max(int(floor(max_)) + 1, lo), 65536)
+		return self.cumulative[hi] - self.cumulative[lo]
+
+	def getTotal(self):
+		return self.cumulative[-1]
+
+	# 8-bit preview : bin of each pixel, displayed through the LUT of getLut
+	def createPreview(self, title_):
+		pixels = self.ip.getPixels() if self.ip.getBitDepth() == 32 else self.ip.convertToFloatProcessor().getPixels()
+		levels = core.binLevels(pixels, self.lo, self.binWidth, 256)
+		return ImagePlus(title_, ByteProcessor(self.width, self.height, levels, self.getLut(65536, 65535)))
+
+	# grey levels with the bins of [min_, max_] in red
+	def getLut(self, min_, max_):
+		reds = zeros(256, 'b')
+		greens = zeros(256, 'b')
+		blues = zeros(256, 'b')
+		for b in xrange(256) :
+			grey = b - 256 if b > 127 else b
+			center = self.lo + (b + 0.5) * self.binWidth
+			reds[b] = -1 if min_ <= center <= max_ else grey
+			greens[b] = 0 if min_ <= center <= max_ else grey
+			blues[b] = 0 if min_ <= center <= max_ else grey
+		return IndexColorModel(8, 256, reds, greens, blues)
+
+## threshold preview of the sliders of a dialog : the slider events are debounced and the preview is updated with the LUT
+## of the engine and the fraction of pixels from its histogram, the image itself is never scanned again
+class ThresholdPreviewer(AdjustmentListener, ActionListener):
+	def __init__(self, engine, imp, sliders, label=None, delay=40):
+		self.engine = engine
+		self.imp = imp
+		self.sliders = sliders
+		self.label = label
+		self.timer = Timer(delay, self)
+		self.timer.setRepeats(False)
 		self.threshold()
-		
-	def adjustmentValueChanged(self, event):  
-		self.threshold()   
-			
-	def reset(self):  
-		IJ.resetThreshold(self.imp) 
-		
+
+	def adjustmentValueChanged(self, event):
+		self.timer.restart()
+
+	def actionPerformed(self, event):
+		self.threshold()
+
+	def stop(self):
+		self.timer.stop()
+
 	def threshold(self):
-		IJ.setThreshold(self.imp, self.sliders.get(0).getValue() ,self.sliders.get(1).getValue())
-	
-	def getMinThreshold(self) :
-		return self.sliders.get(0).getValue()
-		
-	def getMaxThreshold(self) :
-		return self.sliders.get(1).getValue()
+		minThreshold, maxThreshold = self.getThresholds()
+		self.imp.getProcessor().setColorModel(self.engine.getLut(minThreshold, maxThreshold))
+		self.imp.updateAndDraw()
+		if self.label is not None :
+			total = self.engine.getTotal()
+			count = self.engine.getCount(minThreshold, maxThreshold)
+			self.label.setText("%d pixels (%.1f %%)" % (count, 100.0 * count / total if total > 0 else 0.0))
+
+	def getThresholds(self):
+		return float(self.sliders.get(0).getValue()), float(self.sliders.get(1).getValue())
+
+## Bio-Formats reader session : the file is opened once for the OME metadata and the planes of all its series
+class ImageFileReader:
+	def __init__(self, imagefile):
+		self.imagefile = imagefile
+		self.omeMeta = MetadataTools.createOMEXMLMetadata()
+		self.reader = ImageProcessorReader(ChannelSeparator(LociPrefs.makeImageReader()))
+		self.reader.setMetadataStore(self.omeMeta)
+		self.reader.setId(imagefile)
+		self.lock = threading.Lock() # the reader is shared by the series analyzed concurrently
+		self.users = 0 # series of the batch still using the reader
+		self.onClose = None
+
+	def getSeriesCount(self):
+		return self.reader.getSeriesCount()
+
+	# Dimensions (sizeC, sizeT, sizeZ) of a serie
+	def getDimensions(self, idxSerie):
+		with self.lock :
+			self.reader.setSeries(idxSerie)
+			return self.reader.getSizeC(), self.reader.getSizeT(), self.reader.getSizeZ()
+
+	# Spatial calibration of a serie from the OME metadata
+	def getCalibration(self, idxSerie):
+		cal = Calibration()
+		sizeX = self.omeMeta.getPixelsPhysicalSizeX(idxSerie)
+		sizeY = self.omeMeta.getPixelsPhysicalSizeY(idxSerie)
+		if sizeX is not None and sizeY is not None :
+			cal.pixelWidth = sizeX.value(UNITS.MICROMETER).doubleValue()
+			cal.pixelHeight = sizeY.value(UNITS.MICROMETER).doubleValue()
+			cal.setUnit("micron")
+		return cal
+
+	# Maximum projection over Z of a channel (0..sizeC-1) at a frame, read plane by plane (the reader must be locked)
+	def projectChannel(self, c, frame):
+		ip = None
+		for z in range(self.reader.getSizeZ()) :
+			plane = self.reader.openProcessors(self.reader.getIndex(z, c, frame))[0]
+			if ip is None :
+				ip = plane
+			else :
+				ip.copyBits(plane, 0, 0, Blitter.MAX)
+		return ip
+
+	# Read every channel of a serie once at a frame (maximum projection over Z) : return the maximum projection of
+	# all channels and a dictionary {channel index (1..sizeC) : plane} of the channels to keep (all if None)
+	def readSerie(self, idxSerie, channels=None, frame=0):
+		planes = {}
+		ipProj = None
+		with self.lock :
+			self.reader.setSeries(idxSerie)
+			for c in range(self.reader.getSizeC()) :
+				ip = self.projectChannel(c, frame)
+				if ipProj is None :
+					ipProj = ip.duplicate()
+				else :
+					ipProj.copyBits(ip, 0, 0, Blitter.MAX)
+				if channels is None or c+1 in channels :
+					planes[c+1] = ip
+		ipProj.setColorModel(None) # Grays
+		impProj = ImagePlus("MAX_" + os.path.basename(self.imagefile), ipProj)
+		impProj.setCalibration(self.getCalibration(idxSerie))
+		return impProj, planes
+
+	# Read only the channels (1..sizeC) of a serie at a frame (maximum projection over Z) : {channel : plane}
+	def readPlanes(self, idxSerie, channels, frame):
+		with self.lock :
+			self.reader.setSeries(idxSerie)
+			return dict((c, self.projectChannel(c-1, frame)) for c in channels)
+
+	# Size (sizeX, sizeY) of the planes of a serie
+	def getSize(self, idxSerie):
+		with self.lock :
+			self.reader.setSeries(idxSerie)
+			return self.reader.getSizeX(), self.reader.getSizeY()
+
+	# Read the region (x, y, w, h) of a channel (1..sizeC) at the first frame through the tile API of the reader
+	# (maximum projection over Z)
+	def readTile(self, idxSerie, channel, x, y, w, h):
+		with self.lock :
+			self.reader.setSeries(idxSerie)
+			ip = None
+			for z in range(self.reader.getSizeZ()) :
+				plane = self.reader.openProcessors(self.reader.getIndex(z, channel-1, 0), x, y, w, h)[0]
+				if ip is None :
+					ip = plane
+				else :
+					ip.copyBits(plane, 0, 0, Blitter.MAX)
+			return ip
+
+	# OME metadata of the channels of a serie : [{channel (1..sizeC), name, fluor, emission, excitation (nm)}], None for
+	# the missing values
+	def getChannels(self, idxSerie):
+		toNm = lambda length_ : None if length_ is None or length_.value(UNITS.NANOMETER) is None else length_.value(UNITS.NANOMETER).doubleValue()
+		sizeC = self.getDimensions(idxSerie)[0]
+		channels = []
+		for c in range(sizeC) :
+			channel = OrderedDict([("channel", c+1), ("name", None), ("fluor", None), ("emission", None), ("excitation", None)])
+			if c < self.omeMeta.getChannelCount(idxSerie) :
+				channel["name"] = self.omeMeta.getChannelName(idxSerie, c)
+				channel["fluor"] = self.omeMeta.getChannelFluor(idxSerie, c)
+				channel["emission"] = toNm(self.omeMeta.getChannelEmissionWavelength(idxSerie, c))
+				channel["excitation"] = toNm(self.omeMeta.getChannelExcitationWavelength(idxSerie, c))
+			channels.append(channel)
+		return channels
+
+	# Mean intensity of each channel of a serie on the Bio-Formats thumbnail of its middle Z plane at a frame : intensity
+	# profile of the channels without reading the planes at full resolution
+	def getThumbnailMeans(self, idxSerie, frame=0):
+		with self.lock :
+			self.reader.setSeries(idxSerie)
+			z = self.reader.getSizeZ() // 2
+			return [self.reader.openThumbProcessors(self.reader.getIndex(z, c, frame))[0].getStatistics().mean
+				for c in range(self.reader.getSizeC())]
+
+	# Saturation level 2^(bit depth)-1 of a serie from the significant bits of the OME metadata
+	def getSaturation(self, idxSerie):
+		bits = self.omeMeta.getPixelsSignificantBits(idxSerie)
+		if bits is not None :
+			bits = bits.getValue()
+		else :
+			with self.lock :
+				self.reader.setSeries(idxSerie)
+				bits = self.reader.getBitsPerPixel()
+		return (1 << bits) - 1
+
+	# Register the series of the batch that use the reader, the file is closed when all of them are released
+	def retain(self, n):
+		with self.lock :
+			self.users += n
+
+	def release(self):
+		with self.lock :
+			self.users -= 1
+			closing = self.users == 0
+		if closing :
+			self.close()
+
+	def close(self):
+		self.reader.close()
+		if self.onClose is not None :
+			self.onClose()
+
+## 32-bit OME-TIFF written tile by tile, with the sub-resolutions sizes[1:] of the pyramid (full resolution sizes[0])
+class TiledTiffWriter:
+	def __init__(self, path, sizes, tileSize, cal):
+		if os.path.exists(path) :
+			os.remove(path)
+		meta = MetadataTools.createOMEXMLMetadata()
+		MetadataTools.populateMetadata(meta, 0, os.path.basename(path), False, "XYZCT",
+			FormatTools.getPixelTypeString(FormatTools.FLOAT), sizes[0][0], sizes[0][1], 1, 1, 1, 1)
+		for r in range(1, len(sizes)) :
+			meta.setResolutionSizeX(PositiveInteger(sizes[r][0]), 0, r)
+			meta.setResolutionSizeY(PositiveInteger(sizes[r][1]), 0, r)
+		if cal.scaled() :
+			meta.setPixelsPhysicalSizeX(Length(cal.pixelWidth, UNITS.MICROMETER), 0)
+			meta.setPixelsPhysicalSizeY(Length(cal.pixelHeight, UNITS.MICROMETER), 0)
+		self.sizes = sizes
+		self.writer = OMETiffWriter()
+		self.writer.setMetadataRetrieve(meta)
+		self.writer.setBigTiff(True)
+		self.tileSize = self.writer.setTileSizeX(tileSize)
+		self.writer.setTileSizeY(tileSize)
+		self.writer.setId(path)
+
+	# write a region of the current resolution at (x, y)
+	def writeTile(self, fp, x, y):
+		self.writer.saveBytes(0, DataTools.floatsToBytes(fp.getPixels(), False), x, y, fp.getWidth(), fp.getHeight())
+
+	# write the sub-resolutions from the image of the first one, each next one downsampled from the previous one
+	def writeLevels(self, fp):
+		for r in range(1, len(self.sizes)) :
+			if r > 1 :
+				fp = downsample(fp, self.sizes[r][0], self.sizes[r][1])
+			self.writer.setResolution(r)
+			for y in xrange(0, fp.getHeight(), self.tileSize) :
+				for x in xrange(0, fp.getWidth(), self.tileSize) :
+					fp.setRoi(x, y, min(self.tileSize, fp.getWidth()-x), min(self.tileSize, fp.getHeight()-y))
+					self.writeTile(fp.crop(), x, y)
+			fp.resetRoi()
+
+	def close(self):
+		self.writer.close()
+
+## columnar result table : one list per column, saved as a csv file in one stream
+class ColumnTable:
+	def __init__(self, columns):
+		self.columns = OrderedDict((name, []) for name in columns)
+
+	def addRow(self, values):
+		for column, value in zip(self.columns.values(), values) :
+			column.append(value)
+
+	# add several rows given column by column (sequences of the same length)
+	def extend(self, values):
+		for column, value in zip(self.columns.values(), values) :
+			column.extend(value)
+
+	def getCounter(self):
+		return len(self.columns.values()[0]) if self.columns else 0
+
+	# format of a column : string, integer or decimal with the precision of the tables
+	def formatter(self, column):
+		if all(isinstance(v, basestring) for v in column) :
+			return lambda v : v
+		if all(isinstance(v, (int, long)) for v in column) :
+			return str
+		return lambda v : "NaN" if isnan(v) else "%.*f" % (precision, v)
+
+	def saveAs(self, path):
+		formats = [self.formatter(column) for column in self.columns.values()]
+		f = open(path, "w")
+		try :
+			f.write(",".join(self.columns.keys()) + "\n")
+			f.writelines(",".join([fmt(v) for fmt, v in zip(formats, row)]) + "\n" for row in zip(*self.columns.values()))
+		finally :
+			f.close()
+
+	# rows of the table prefixed with the values of keys (File and Serie of the results store)
+	def getRows(self, keys=()):
+		return [list(keys) + list(row) for row in zip(*self.columns.values())]
+
+	def toResultsTable(self):
+		rt = ResultsTable()
+		for row in zip(*self.columns.values()) :
+			rt.incrementCounter()
+			for name, v in zip(self.columns.keys(), row) :
+				rt.addValue(name, v)
+		return rt
+
+## closed contour : coordinates of the points in two float arrays
+class Contour:
+	def __init__(self, xs, ys):
+		self.xs = xs
+		self.ys = ys
+
+	@staticmethod
+	def fromPolygon(fpol):
+		n = fpol.npoints
+		return Contour(array('f', fpol.xpoints[:n]), array('f', fpol.ypoints[:n]))
+
+	def size(self):
+		return len(self.xs)
+
+	# remove the consecutive duplicated points (and the last point if equal to the first one)
+	def dedupe(self):
+		xs_ = array('f')
+		ys_ = array('f')
+		xs = self.xs
+		ys = self.ys
+		for i in xrange(len(xs)) :
+			if i == 0 or xs[i] != xs_[-1] or ys[i] != ys_[-1] :
+				xs_.append(xs[i])
+				ys_.append(ys[i])
+		while len(xs_) > 1 and xs_[-1] == xs_[0] and ys_[-1] == ys_[0] :
+			xs_.pop()
+			ys_.pop()
+		return Contour(xs_, ys_)
+
+	def getLength(self):
+		xs = self.xs
+		ys = self.ys
+		n = len(xs)
+		return sum(sqrt((xs[i] - xs[i-1])**2 + (ys[i] - ys[i-1])**2) for i in xrange(n)) if n > 1 else 0.0
+
+	# twice the signed area (shoelace), positive for a counterclockwise contour in (x, y)
+	def getSignedArea2(self):
+		xs = self.xs
+		ys = self.ys
+		return sum(xs[i-1] * ys[i] - xs[i] * ys[i-1] for i in xrange(len(xs)))
+
+	# points at a constant arc-length spacing_ along the closed contour, starting from the first point
+	def resample(self, spacing_):
+		xs = self.xs
+		ys = self.ys
+		n = len(xs)
+		if n < 2 or spacing_ <= 0 :
+			return Contour(array('f', xs), array('f', ys))
+		count = max(int(round(self.getLength() / spacing_)), 3)
+		step = self.getLength() / count
+		xs_ = array('f', [xs[0]])
+		ys_ = array('f', [ys[0]])
+		target = step
+		walked = 0.0
+		for i in xrange(1, n + 1) :
+			x0, y0 = xs[i-1], ys[i-1]
+			x1, y1 = xs[i % n], ys[i % n]
+			seg = sqrt((x1 - x0)**2 + (y1 - y0)**2)
+			while seg > 0 and target <= walked + seg and len(xs_) < count :
+				t = (target - walked) / seg
+				xs_.append(x0 + t * (x1 - x0))
+				ys_.append(y0 + t * (y1 - y0))
+				target += step
+			walked += seg
+		return Contour(xs_, ys_)
+
+	# outward unit normals from the central differences
+	def getNormals(self):
+		xs = self.xs
+		ys = self.ys
+		n = len(xs)
+		sign = 1.0 if self.getSignedArea2() >= 0 else -1.0
+		nx = array('f', [0.0] * n)
+		ny = array('f', [0.0] * n)
+		for i in xrange(n) :
+			tx = xs[(i+1) % n] - xs[i-1]
+			ty = ys[(i+1) % n] - ys[i-1]
+			norm = sqrt(tx*tx + ty*ty)
+			if norm > 0 :
+				nx[i] = sign * ty / norm
+				ny[i] = -sign * tx / norm
+		return nx, ny
+
+	# signed curvature (1/pixel) of the circle through each point and its neighbours, positive where convex
+	def getCurvature(self):
+		xs = self.xs
+		ys = self.ys
+		n = len(xs)
+		sign = 1.0 if self.getSignedArea2() >= 0 else -1.0
+		k = array('f', [0.0] * n)
+		for i in xrange(n) :
+			ax = xs[i] - xs[i-1]
+			ay = ys[i] - ys[i-1]
+			bx = xs[(i+1) % n] - xs[i]
+			by = ys[(i+1) % n] - ys[i]
+			d = sqrt((ax*ax + ay*ay) * (bx*bx + by*by) * ((ax+bx)**2 + (ay+by)**2))
+			if d > 0 :
+				k[i] = sign * 2.0 * (ax*by - ay*bx) / d
+		return k
+
+	def toRoi(self, name_=None):
+		n = len(self.xs)
+		roi = PolygonRoi(FloatPolygon(javaArray(self.xs, 'f'), javaArray(self.ys, 'f'), n), Roi.POLYGON)
+		roi.setName(name_)
+		return roi
+
+## content-addressed cache of the intermediate images of the series (batch mode) : one folder per key holding TIFF
+## images, the least recently used folders are removed when the cache exceeds maxBytes
+class ResultCache:
+	lock = threading.Lock() # the cache folder is shared by the series analyzed concurrently
+
+	def __init__(self, folder, maxBytes):
+		self.folder = folder
+		self.maxBytes = maxBytes
+		if not os.path.isdir(folder) :
+			os.makedirs(folder)
+
+	# key of a serie : path, modification time and size of the file, serie index
+	def getFileKey(self, imagefile, idxSerie):
+		return (os.path.abspath(imagefile), os.path.getmtime(imagefile), os.path.getsize(imagefile), idxSerie)
+
+	# hash of the content of a small file (ROI zip), None if no file
+	def getFileHash(self, path):
+		if path is None :
+			return None
+		f = open(path, "rb")
+		try :
+			return hashlib.sha1(f.read()).hexdigest()
+		finally :
+			f.close()
+
+	# key of a stage : hash of the key of the serie, the name of the stage and its parameters
+	def getKey(self, *parts):
+		return hashlib.sha1(repr(parts)).hexdigest()
+
+	# images {name : ImagePlus} of a key in the order of names, None if not cached
+	def load(self, key, names):
+		entry = os.path.join(self.folder, key)
+		paths = [os.path.join(entry, name + ".tif") for name in names]
+		with ResultCache.lock :
+			if not all(os.path.isfile(path) for path in paths) :
+				return None
+			os.utime(entry, None) # most recently used
+		imps = [IJ.openImage(path) for path in paths]
+		return imps if None not in imps else None
+
+	# values saved with the images of a key (store), None if there are none
+	def loadInfo(self, key):
+		path = os.path.join(self.folder, key, "info.json")
+		if not os.path.isfile(path) :
+			return None
+		f = open(path)
+		try :
+			return json.load(f, object_pairs_hook=OrderedDict)
+		finally :
+			f.close()
+
+	# save the images {name : ImagePlus} of a key and the values of info, the source file is recorded for the invalidation
+	def store(self, key, imps, source, info=None):
+		entry = os.path.join(self.folder, key)
+		tmp = "%s.%d.tmp" % (entry, threading.current_thread().ident)
+		if os.path.isdir(tmp) :
+			shutil.rmtree(tmp)
+		os.makedirs(tmp)
+		for name, imp in imps.items() :
+			FileSaver(imp).saveAsTiff(os.path.join(tmp, name + ".tif"))
+		f = open(os.path.join(tmp, "source.txt"), "w")
+		try :
+			f.write(os.path.abspath(source))
+		finally :
+			f.close()
+		if info is not None :
+			saveJson(info, os.path.join(tmp, "info.json"))
+		with ResultCache.lock :
+			if os.path.isdir(entry) :
+				shutil.rmtree(entry)
+			os.rename(tmp, entry)
+			self.evict()
+
+	# remove the least recently used entries above the size limit (the cache must be locked)
+	def evict(self):
+		entries = []
+		total = 0
+		for name in os.listdir(self.folder) :
+			entry = os.path.join(self.folder, name)
+			if name.endswith(".tmp") or not os.path.isdir(entry) :
+				continue
+			size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+			entries.append((os.path.getmtime(entry), size, entry))
+			total += size
+		for mtime, size, entry in sorted(entries) :
+			if total <= self.maxBytes :
+				break
+			shutil.rmtree(entry, True)
+			total -= size
+
+	# remove the entries of the files (all entries if None)
+	def invalidate(self, imagefiles=None):
+		sources = None if imagefiles is None else set(os.path.abspath(f) for f in imagefiles)
+		with ResultCache.lock :
+			for name in os.listdir(self.folder) :
+				entry = os.path.join(self.folder, name)
+				if not os.path.isdir(entry) :
+					continue
+				if sources is not None :
+					source = os.path.join(entry, "source.txt")
+					if not os.path.isfile(source) or open(source).read().strip() not in sources :
+						continue
+				shutil.rmtree(entry, True)
+
+## wall time, CPU time of the thread and JVM heap of the successive stages of the analysis of a serie
+## stage() closes the current stage and opens the next one, count() adds pixel/ROI counts to the current stage
+class StageProfiler:
+	threads = ManagementFactory.getThreadMXBean()
+
+	def __init__(self, **info):
+		self.info = OrderedDict(sorted(info.items()))
+		self.stages = []
+		self.current = None
+		self.folder = None # folder of the serie, where the report is saved
+		self.memory = None # BufferPool of the serie : peak bytes of the images held during each stage
+
+	@staticmethod
+	def snapshot():
+		runtime = Runtime.getRuntime()
+		return System.nanoTime(), StageProfiler.threads.getCurrentThreadCpuTime(), runtime.totalMemory() - runtime.freeMemory()
+
+	def stage(self, name, **counts):
+		self.close()
+		if self.memory is not None :
+			self.memory.resetPeak()
+		self.current = (name, self.snapshot(), dict((key, int(n)) for key, n in counts.items()))
+
+	def count(self, **counts):
+		if self.current is not None :
+			for key, n in counts.items() :
+				self.current[2][key] = self.current[2].get(key, 0) + int(n)
+
+	def close(self):
+		if self.current is None :
+			return
+		name, (wall0, cpu0, heap0), counts = self.current
+		wall, cpu, heap = self.snapshot()
+		stage = OrderedDict([("stage", name), ("wallSeconds", (wall - wall0) / 1e9), ("cpuSeconds", max(cpu - cpu0, 0) / 1e9),
+			("heapBeforeMB", heap0 / 1048576.0), ("heapAfterMB", heap / 1048576.0)])
+		if self.memory is not None :
+			stage["peakHeldMB"] = self.memory.peak / 1048576.0
+		stage["counts"] = counts
+		self.stages.append(stage)
+		self.current = None
+
+	def getReport(self):
+		report = OrderedDict(self.info)
+		report["wallSeconds"] = sum(stage["wallSeconds"] for stage in self.stages)
+		report["cpuSeconds"] = sum(stage["cpuSeconds"] for stage in self.stages)
+		report["peakHeldMB"] = max([stage.get("peakHeldMB", 0.0) for stage in self.stages] or [0.0])
+		report["stages"] = self.stages
+		return report
+
+	def save(self, path):
+		saveJson(self.getReport(), path)
+
+## progress of the batch mode : throughput in series/min, and report of the stages of all series
+class BatchProgress:
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.results = {True : 0, False : 0, None : 0} # analyzed, skipped, failed
+		self.startTime = System.nanoTime()
+		self.reports = []
+
+	def done(self, result, report=None):
+		with self.lock :
+			self.results[result] += 1
+			if report is not None :
+				self.reports.append(report)
+			count = sum(self.results.values())
+			minutes = (System.nanoTime() - self.startTime) / 6e10
+			print "Batch mode : %d serie(s) done - %.2f series/min" % (count, count / max(minutes, 1e-9))
+
+	# aggregated report : totals of each stage over the series and summary of each serie
+	def getReport(self):
+		with self.lock :
+			stages = OrderedDict()
+			for report in self.reports :
+				for stage in report["stages"] :
+					total = stages.setdefault(stage["stage"], OrderedDict([("series", 0), ("wallSeconds", 0.0),
+						("cpuSeconds", 0.0), ("maxHeapAfterMB", 0.0), ("maxPeakHeldMB", 0.0), ("counts", {})]))
+					total["series"] += 1
+					total["wallSeconds"] += stage["wallSeconds"]
+					total["cpuSeconds"] += stage["cpuSeconds"]
+					total["maxHeapAfterMB"] = max(total["maxHeapAfterMB"], stage["heapAfterMB"])
+					total["maxPeakHeldMB"] = max(total["maxPeakHeldMB"], stage.get("peakHeldMB", 0.0))
+					for key, n in stage["counts"].items() :
+						total["counts"][key] = total["counts"].get(key, 0) + n
+			minutes = (System.nanoTime() - self.startTime) / 6e10
+			count = sum(self.results.values())
+			return OrderedDict([("analyzed", self.results[True]), ("skipped", self.results[False]), ("failed", self.results[None]),
+				("wallSeconds", minutes * 60), ("seriesPerMinute", count / max(minutes, 1e-9)),
+				("maxPeakHeldMB", max([report["peakHeldMB"] for report in self.reports] or [0.0])), ("stages", stages),
+				("series", [OrderedDict((key, report[key]) for key in ("file", "serie", "result", "wallSeconds", "cpuSeconds", "peakHeldMB"))
+					for report in self.reports])])
+
+## images of a serie : bytes of the pixels held by the analysis (acquired or registered with hold, until released) and
+## their peak since the last reset, reported for each stage by StageProfiler. With reuse (low-memory mode), the pixel
+## arrays of the released 32-bit images are kept by size, at most maxFree of each size, and given back by acquire
+class BufferPool:
+	bytesPerPixel = {8 : 1, 16 : 2, 24 : 4, 32 : 4}
+
+	def __init__(self, reuse=False, maxFree=bufferPoolSize):
+		self.reuse = reuse
+		self.maxFree = maxFree
+		self.held = IdentityHashMap() # pixel array : bytes
+		self.free = {} # length : [pixel arrays]
+		self.bytes = 0 # bytes of the held and free arrays
+		self.peak = 0
+
+	# pixel arrays (with their size in bytes) of an ImagePlus (all slices) or an ImageProcessor
+	def getArrays(self, image):
+		if isinstance(image, ImagePlus) :
+			if image.getStackSize() > 1 :
+				stack = image.getStack()
+				arrays = [stack.getPixels(i) for i in xrange(1, stack.getSize() + 1)]
+			else : # None if already flushed
+				arrays = [image.getProcessor().getPixels()] if image.getProcessor() is not None else []
+		else :
+			arrays = [image.getPixels()]
+		size = self.bytesPerPixel[image.getBitDepth()]
+		return [(pixels, len(pixels) * size) for pixels in arrays if pixels is not None]
+
+	# register images allocated elsewhere (reader, plugins), an array held twice is counted once
+	def hold(self, *images):
+		for image in images :
+			if image is None :
+				continue
+			for pixels, n in self.getArrays(image) :
+				if not self.held.containsKey(pixels) :
+					self.held.put(pixels, n)
+					self.bytes += n
+		self.peak = max(self.peak, self.bytes)
+
+	# the images are no longer used : their arrays are kept for reuse or dropped, the ImagePlus are flushed
+	def release(self, *images):
+		for image in images :
+			if image is None :
+				continue
+			for pixels, n in self.getArrays(image) :
+				if self.held.remove(pixels) is None :
+					continue
+				free = self.free.setdefault(len(pixels), [])
+				if self.reuse and image.getBitDepth() == 32 and len(free) < self.maxFree :
+					free.append(pixels)
+				else :
+					self.bytes -= n
+			if isinstance(image, ImagePlus) :
+				image.flush()
+
+	# 32-bit image of the size (values of a released image in the low-memory mode, zeros else)
+	def acquire(self, width, height):
+		n = width * height
+		free = self.free.get(n)
+		if free :
+			pixels = free.pop()
+		else :
+			pixels = zeros(n, 'f')
+			self.bytes += 4 * n
+		self.held.put(pixels, 4 * n)
+		self.peak = max(self.peak, self.bytes)
+		return FloatProcessor(width, height, pixels)
+
+	def resetPeak(self):
+		self.peak = self.bytes
+
+## task of the batch thread pool : analysis of one serie
+class SeriesTask(Callable):
+	def __init__(self, session, idxSerie, params, permits, progress):
+		self.session = session
+		self.idxSerie = idxSerie
+		self.params = params
+		self.permits = permits # bound the number of series open at once
+		self.progress = progress
+
+	# return True if analyzed, False if skipped, None if failed
+	def call(self):
+		result = None
+		profiler = StageProfiler(file=self.session.imagefile, serie=self.idxSerie+1)
+		self.permits.acquire()
+		try :
+			result = analyzeSeries(self.session, self.idxSerie, self.params, profiler)
+		except (Exception, JavaException), e :
+			print "[%s S%d] Analysis failed: %s" % (os.path.basename(self.session.imagefile), self.idxSerie+1, e)
+		finally :
+			self.permits.release()
+			self.session.release()
+			report = closeProfiler(profiler, result)
+			if self.params["store"] is not None :
+				storeRun(self.params["store"], report, self.params)
+			self.progress.done(result, report)
+		return result
 
 #---------------------------------------------------------------
 #----------------- All Functions for analysis  -----------------
@@ -128,77 +893,95 @@ class ThresholdPreviewer(AdjustmentListener):
 
 #### Fonctions for STEP 1 : Preparation of data & analysis - Preprocessing
 
-# Get indexes of Donnor and Acceptor images
-def getImpIndexes(imagefile_ , sizeC_ , idxSeries_ ):
-	#read in ImagePlus with arguments
-	options = ImporterOptions()
-	options.setId(imagefile_)
-	options.setSeriesOn(idxSeries_,True)	
-	impsLSM = BF.openImagePlus(options)
-
-	#projection in Z dimension :impProj_
-	IJ.run(impsLSM[0], "Grays", "stack")
-	impProj_ = ZProjector.run(impsLSM[0],"max")
-	IJ.run(impProj_, "Enhance Contrast", "saturated=0.35")	
-	IJ.setTool("rectangle")
-	impProj_.show()
-	idProj_ = impProj_.getID()
-	IJ.run("Brightness/Contrast...")
-	waitDialog = WaitForUserDialog("ROI","Select a ROI with the rectangle tool")
-	waitDialog.show()
-
-	impsLSM[0].setCalibration(Calibration())
-	impsLSM[0].setDimensions(1, 1, sizeC_)
-	plot = ZAxisProfiler.getPlot(impsLSM[0])
-	plot.setXYLabels('Channel','Mean')
-	xvalues = plot.getXValues()
-	yvalues = plot.getYValues()
-	series = XYSeries("Mean intensity channel")
-	for i in range(len(xvalues)) :
-		series.add(xvalues[i], yvalues[i])
-	dataset = XYSeriesCollection(series) #Add series to dataset
-	yaxis = NumberAxis("Mean")
-	xaxis = NumberAxis("# Channel")
-	offset = 0.5
-	xaxis.setRange(1-offset, sizeC_+offset)
-	r = XYLineAndShapeRenderer()
-	r.setSeriesPaint(0, Color.RED)
-	r.setSeriesShape(0, Ellipse2D.Double(-3.0,-3.0,6.0,6.0))
-	xyplot = XYPlot(dataset, xaxis, yaxis, r)
-	xyplot.setBackgroundPaint(Color.white)
-	chart = JFreeChart(xyplot)
-	chart.removeLegend()
-	impPlot = IJ.createImage("Mean intensity channel", "RGB", 512, 512, 1);
-	imagePlot = impPlot.getBufferedImage()
-	chart.draw(imagePlot.createGraphics(), Rectangle2D.Float(0, 0, impPlot.getWidth(), impPlot.getHeight()))
-	impPlot.setImage(imagePlot)
-	impPlot.show()
+# Donnor and Acceptor channels (1..sizeC) of a serie without reading its planes at full resolution :
+# - the first pair of pairs_ whose donor and acceptor both match a channel by the emission wavelength of the OME metadata
+#   or by a word of the name or fluorophore of the channel. Among several matching channels (spectral images), the
+#   brightest on the thumbnails is kept (the emission maximum)
+# - else the two main maxima of the intensity profile of the thumbnails, the donor before the acceptor
+# A channel given by donor_ or acceptor_ is kept and only the other one is detected (a pair of the metadata must then
+# match the given channel). means_ are the thumbnail means of the channels if already read
+# Return the Donnor, the Acceptor and the source of the choice
+def detectChannels(session_, idxSerie_, pairs_, means_=None, donor_=None, acceptor_=None):
+	if donor_ is not None and acceptor_ is not None :
+		return donor_, acceptor_, "parameters"
+	channels = session_.getChannels(idxSerie_)
+	getMeans = lambda : means_ if means_ is not None else session_.getThumbnailMeans(idxSerie_)
+	def matches(channel, spec) :
+		(low, high), words = spec
+		if channel["emission"] is not None and low <= channel["emission"] <= high :
+			return True
+		names = " ".join(s for s in (channel["name"], channel["fluor"]) if s).lower()
+		return any(word.lower() in names for word in words)
+	def candidates(spec, given, exclude) :
+		found = [channel["channel"] for channel in channels if matches(channel, spec) and channel["channel"] not in exclude]
+		if given is not None :
+			return [given] if given in found else []
+		return found
+	for name, donor, acceptor in pairs_ :
+		donors = candidates(donor, donor_, [acceptor_])
+		acceptors = candidates(acceptor, acceptor_, donors)
+		if donors and acceptors :
+			if len(donors) > 1 or len(acceptors) > 1 :
+				means_ = getMeans()
+				donors.sort(key=lambda c : -means_[c-1])
+				acceptors.sort(key=lambda c : -means_[c-1])
+			return donors[0], acceptors[0], "metadata " + name
+	means_ = getMeans()
+	n = len(means_)
+	peaks = [c for c in range(n) if (c == 0 or means_[c] >= means_[c-1]) and (c == n-1 or means_[c] >= means_[c+1])]
+	if donor_ is not None or acceptor_ is not None :
+		#brightest other channel, after the given Donnor or before the given Acceptor if possible
+		given = (donor_ if donor_ is not None else acceptor_) - 1
+		others = [c for c in range(n) if c != given]
+		after = [c for c in others if (c > given) == (donor_ is not None)]
+		pool = [c for c in after if c in peaks] or after or others
+		if not pool :
+			raise ValueError("no channel other than C%d to pair with" % (given + 1))
+		other = max(pool, key=lambda c : means_[c]) + 1
+		if donor_ is not None :
+			return donor_, other, "thumbnails"
+		return other, acceptor_, "thumbnails"
+	if len(peaks) < 2 :
+		peaks = range(n)
+	donor, acceptor = sorted(sorted(peaks, key=lambda c : -means_[c])[:2])
+	return donor + 1, acceptor + 1, "thumbnails"
+
+# Dialog of the Donnor and Acceptor channels : the detected channels by default, with the metadata of the channels and
+# the intensity profile of the thumbnails
+def selectChannels(session_, idxSerie_, pairs_):
+	means = session_.getThumbnailMeans(idxSerie_)
+	donor, acceptor, source = detectChannels(session_, idxSerie_, pairs_, means)
+	sizeC = len(means)
+	plot = Plot("Mean intensity channel", "# Channel", "Mean")
+	plot.setColor(Color.RED)
+	plot.add("connected circle", [float(c) for c in range(1, sizeC+1)], means)
+	plot.setLimits(0.5, sizeC + 0.5, 0, max(means) * 1.05 if max(means) > 0 else 1)
+	plotWindow = plot.show()
 
 	gui = GenericDialog("Select FRET Donnor/Acceptor images")
-	gui.addSlider("Donnor image: ", 1, sizeC_, 3)
-	gui.addSlider("Acceptor image: ", 1, sizeC_, 6)
+	for channel in session_.getChannels(idxSerie_) :
+		gui.addMessage("C%d : %s%s%s" % (channel["channel"], channel["name"] or "",
+			" (%s)" % channel["fluor"] if channel["fluor"] else "",
+			", emission %.0f nm" % channel["emission"] if channel["emission"] is not None else ""))
+	gui.addMessage("Detected from the " + source)
+	gui.addSlider("Donnor image: ", 1, sizeC, donor)
+	gui.addSlider("Acceptor image: ", 1, sizeC, acceptor)
 	gui.showDialog()
-	impPlot.close()
-	impProj_.deleteRoi()
+	if plotWindow is not None :
+		plotWindow.close()
+	if gui.wasCanceled() :
+		raise ValueError("no Donnor and Acceptor channels selected")
 	idxDonnor_ = int(gui.getNextNumber())
 	idxAcceptor_ = int(gui.getNextNumber())
-	for i in range(len(impsLSM)) :
-		impsLSM[i].flush()
-		
-	return idxDonnor_, idxAcceptor_, idProj_
-
-	
-#Open ZCT hyperstack with only one channel index 
-def extractImpFromIndex(imagefile_ , idxChannel_ , idxSeries_ ):
-	options = ImporterOptions()
-	options.setId(imagefile_)
-	options.setSeriesOn(idxSeries_,True)	
-	options.setAutoscale(autoscale)
-	options.setShowOMEXML(showomexml)
-	options.setConcatenate(setconcat)
-	options.setCBegin(idxSeries_ , idxChannel_ -1)
-	options.setCEnd(idxSeries_ ,idxChannel_ -1)  
-	return BF.openImagePlus(options)[0]
+	return idxDonnor_, idxAcceptor_
+
+# ImagePlus of one channel plane read by ImageFileReader.readSerie
+def extractImpFromPlanes(planes_ , idxChannel_ , cal_ , title_):
+	if idxChannel_ not in planes_ :
+		raise ValueError("channel %d does not exist" % idxChannel_)
+	imp_ = ImagePlus(title_, planes_.pop(idxChannel_))
+	imp_.setCalibration(cal_.copy())
+	return imp_
 
 # Adjust the string size with 0
 def adjustSizeNum(s_ , length_):
@@ -229,18 +1012,80 @@ def getBackgroundROI(imp_) :
 	imp_.hide()
 	return roi_
 
-# subtract the mean intensity of the ROI obtained from the function getBackgroundROI
+# mean intensity (NaN excluded) of the pixels of the ROI obtained from the function getBackgroundROI
+def measureBackground(imp_, roi_):
+	ip_ = imp_.getProcessor()
+	width = ip_.getWidth()
+	height = ip_.getHeight()
+	values = [ip_.getPixelValue(p.x, p.y) for p in roi_.getContainedPoints() if 0 <= p.x < width and 0 <= p.y < height]
+	values = [v for v in values if not isnan(v)]
+	return sum(values) / len(values) if values else Float.NaN
+
+# subtract the mean intensity of the ROI, return the subtracted value
 def subtractBackground(imp_, roi_):
-	Analyzer.setMeasurements(Measurements.MEAN)
-	Analyzer.setPrecision(5)
-	rt= ResultsTable.getResultsTable()
-	rt.reset() 
-	analyzer = Analyzer(imp_,rt)
-	imp_.setRoi(roi_)
-	analyzer.measure()
-	imp_.deleteRoi()
-	imp_.getProcessor().subtract(rt.getValue ('Mean', 0))
-	return
+	value_ = measureBackground(imp_, roi_)
+	imp_.getProcessor().subtract(value_)
+	return value_
+
+# percentile q_ of the pixels of the mask_ in the rectangle rect_ of a 16-bit image, from the masked histogram of ImageJ
+# read between the min and max of these pixels (core.histogramPercentile). NaN if there is no pixel
+def maskedPercentile(sp_, mask_, q_, rect_):
+	sp_.setRoi(rect_)
+	mask_.setRoi(rect_)
+	sp_.setMask(mask_.crop())
+	stats = ImageStatistics.getStatistics(sp_, Measurements.MIN_MAX, None)
+	if stats.pixelCount == 0 :
+		return Float.NaN
+	return core.histogramPercentile(sp_.getHistogram(), q_, int(stats.min), int(stats.max))
+
+# subtract the background estimated from the pixels below the Otsu threshold of the 32-bit image (outside the objects) :
+# - "percentile" : backgroundPercentile of these pixels, return the subtracted value
+# - "surface" : percentile of these pixels in each cell of a grid of backgroundGrid pixels, surface interpolated between
+#   the cells to correct an uneven illumination, return the size of the grid and the range of the surface
+# The percentiles are taken from the 16-bit histogram of the background pixels, the surface is the grid resized with a
+# bilinear interpolation and subtracted natively
+def subtractAutoBackground(imp_, params_):
+	ip_ = imp_.getProcessor()
+	width, height = ip_.getWidth(), ip_.getHeight()
+	objects = ThresholdEngine(ip_).getThresholds("Otsu dark")[0]
+	ip_.resetRoi()
+	ip_.setThreshold(-Float.MAX_VALUE, Math.nextDown(float(objects)), ImageProcessor.NO_LUT_UPDATE)
+	mask = ip_.createMask() # background pixels (NaN excluded)
+	ip_.resetThreshold()
+	sp = ip_.convertToShortProcessor(False)
+	q = params_["backgroundPercentile"]
+	if params_["backgroundAuto"] == "surface" :
+		cell = max(int(params_["backgroundGrid"]), 1)
+		gw, gh = (width + cell - 1) // cell, (height + cell - 1) // cell
+		grid = [maskedPercentile(sp, mask, q, Rectangle(gx * cell, gy * cell, min(cell, width - gx * cell), min(cell, height - gy * cell)))
+			for gy in xrange(gh) for gx in xrange(gw)]
+		grid = core.fillGrid(grid, gw, gh)
+		fpGrid = FloatProcessor(gw, gh, javaArray(grid, 'f'))
+		fpGrid.setInterpolationMethod(ImageProcessor.BILINEAR)
+		ip_.copyBits(fpGrid.resize(gw * cell, gh * cell), 0, 0, Blitter.SUBTRACT) # cells aligned on the image
+		return OrderedDict([("grid", [gw, gh]), ("cell", cell), ("min", min(grid)), ("max", max(grid)), ("mean", sum(grid) / len(grid))])
+	value_ = maskedPercentile(sp, mask, q, Rectangle(0, 0, width, height))
+	if value_ == value_ :
+		ip_.subtract(value_)
+	return value_
+
+# background subtraction of the Donnor and Acceptor images by the method of the parameters : automatic estimation,
+# constant values or mean of the background ROI. Return the method and the background of each channel
+def subtractBackgrounds(impDonnor_, impAcceptor_, params_, backROI_=None):
+	if params_["backgroundAuto"] :
+		method = params_["backgroundAuto"]
+	else :
+		method = "constant" if params_["backgroundSubtract"] else "roi"
+	background_ = OrderedDict([("method", method)])
+	for name, imp in (("donor", impDonnor_), ("acceptor", impAcceptor_)) :
+		if params_["backgroundAuto"] :
+			background_[name] = subtractAutoBackground(imp, params_)
+		elif params_["backgroundSubtract"] :
+			background_[name] = params_["backgroundDonor" if name == "donor" else "backgroundAcceptor"]
+			imp.getProcessor().subtract(background_[name])
+		else :
+			background_[name] = subtractBackground(imp, backROI_)
+	return background_
 
 # Convert a freeline to a 2-pts PointRoi
 def Line2PointRoi(roi_) :
@@ -251,95 +1096,451 @@ def Line2PointRoi(roi_) :
 	points.setOptions("extra large cross label")
 	return points
 
-# Generic Dialog for threshold method
-def thresholdImageUI(imp_):  
-	IJ.setAutoThreshold(imp_, "Default dark")
-	minThresholdValue = imp_.getProcessor().getMinThreshold()
-	imp_.show()	
+# Generic Dialog for threshold method : thresholds (min, max) of the image chosen with a preview, "Default dark" at start
+# and "MaxEntropy dark" if the dialog is canceled, all computed from the histogram of the image
+def thresholdImageUI(imp_):
+	engine = ThresholdEngine(imp_.getProcessor())
+	minThreshold, maxThreshold = engine.getThresholds("Default dark")
+	impPreview = engine.createPreview(imp_.getTitle())
+	impPreview.show()
 	gd = GenericDialog("Threshold")
-	gd.addSlider("Min", 0, 65535, minThresholdValue)
-	gd.addSlider("Max", 0, 65535, 65535)
-	sliders = gd.getSliders()
-	previewer = ThresholdPreviewer(imp_, sliders)  
-	for slider in sliders :
-		slider.addAdjustmentListener(previewer)  
-
-	gd.showDialog()  
-
-	if gd.wasOKed():  
-		minThreshold = previewer.getMinThreshold()
-		maxThreshold = previewer.getMaxThreshold()
-		IJ.setRawThreshold(imp_, minThreshold, maxThreshold, None)
+	gd.addSlider("Min", 0, 65535, int(round(minThreshold)))
+	gd.addSlider("Max", 0, 65535, int(round(maxThreshold)))
+	gd.addMessage(" " * 40)
+	previewer = ThresholdPreviewer(engine, impPreview, gd.getSliders(), gd.getMessage())
+	for slider in gd.getSliders() :
+		slider.addAdjustmentListener(previewer)
+
+	gd.showDialog()
+	previewer.stop()
+	impPreview.close()
+
+	if gd.wasOKed():
+		thresholds_ = previewer.getThresholds()
 	else :
-		IJ.setAutoThreshold(imp_, "MaxEntropy dark")
-	imp_.hide()
-	ImageConverter(imp_).convertToGray32()
-	IJ.run(imp_, "NaN Background", "")	
-	return
-
-
-#Remove 0-value and saturated pixels and attribute the value "NAN" to them
-def removeSaturatedPixels(imp_):
-	imp2_= imp_.duplicate()
-	IJ.setRawThreshold(imp2_, 1, 4094 ,None) # the camera is 12-bits dynamical range =[0,4095]
-	IJ.run(imp2_, "Convert to Mask", "")
-	IJ.run(imp2_, "Divide...", "value=255")
-	ImageConverter(imp_).convertToGray32()
-	IJ.run(imp_, "Gaussian Blur...", "sigma=2")
-	imp_ = IC().run("Multiply create 32-bit", imp_, imp2_)
-	IJ.setRawThreshold(imp_, 0, 4095 ,None)
-	IJ.run(imp_, "NaN Background", "")	
-	return
-
+		thresholds_ = engine.getThresholds("MaxEntropy dark")
+	return thresholds_
+
+
+#Remove 0-value and saturated pixels (>= saturation_) and attribute the value "NAN" to them after a Gaussian blur
+#The 32-bit image is processed in place, the pixels are masked before the blur by a threshold (byte mask)
+#With a BufferPool, another bit depth is converted in an image of the pool and the original image is released
+def removeSaturatedPixels(imp_, saturation_, sigma_=gaussianSigma, pool_=None):
+	fp_ = imp_.getProcessor()
+	if fp_.getBitDepth() != 32 :
+		if pool_ is not None :
+			ip = fp_
+			fp_ = ip.toFloat(0, pool_.acquire(ip.getWidth(), ip.getHeight()))
+			pool_.release(ip)
+		else :
+			fp_ = fp_.convertToFloatProcessor()
+	fp_.resetRoi()
+	fp_.setThreshold(1.0, Math.nextDown(float(saturation_)), ImageProcessor.NO_LUT_UPDATE) # pixels in [1, saturation_[
+	mask = fp_.createMask()
+	fp_.resetThreshold()
+	mask.invert() # 255 for the 0-value, saturated and NaN pixels
+	GaussianBlur().blurGaussian(fp_, sigma_, sigma_, 0.0002) # separable blur in place
+	fp_.setValue(Float.NaN)
+	fp_.fill(mask)
+	imp_.setProcessor(fp_)
+	return imp_
+
+# NaN for the pixels of the 32-bit image outside [minthres_, maxthres_] ("NaN Background") then despeckle
 def applyThreshold(imp_, minthres_, maxthres_):
-	IJ.setRawThreshold(imp_, minthres_, maxthres_, "Black & White")
+	IJ.setRawThreshold(imp_, minthres_, maxthres_, None)
 	if imp_.getStackSize() > 1 :
-		IJ.run(imp_, "NaN Background", "stack")	
+		IJ.run(imp_, "NaN Background", "stack")
 		IJ.run(imp_, "Despeckle", "stack")
 	else :
-		IJ.run(imp_, "NaN Background", "")	
+		IJ.run(imp_, "NaN Background", "")
 		IJ.run(imp_, "Despeckle", "")
 	return 
 
-# Computation of the fret index
-def CalculationFRETIndex(impD_,impA_, threshold):
+# Image downsampled to the size (width_, height_) by averaging the finite pixels only : the image with 0 for NaN and
+# the mask of the finite pixels are averaged by the same native resize and divided, NaN where all the pixels are NaN
+def downsample(ip_, width_, height_):
+	fp = ip_.duplicate().convertToFloatProcessor() if ip_.getBitDepth() == 32 else ip_.convertToFloatProcessor()
+	fp.resetRoi()
+	fp.setThreshold(-Float.MAX_VALUE, Float.MAX_VALUE, ImageProcessor.NO_LUT_UPDATE)
+	mask = fp.createMask()
+	fp.resetThreshold()
+	fpWeight = mask.convertToFloatProcessor() # 255 for the finite pixels
+	mask.invert()
+	fp.setValue(0.0)
+	fp.fill(mask)
+	for ip in (fp, fpWeight) :
+		ip.setInterpolationMethod(ImageProcessor.BILINEAR)
+	fp = fp.resize(width_, height_, True)
+	fpWeight = fpWeight.resize(width_, height_, True)
+	setNaNOutside(fpWeight, Float.MIN_VALUE, Float.MAX_VALUE)
+	fp.copyBits(fpWeight, 0, 0, Blitter.DIVIDE)
+	fp.multiply(255.0)
+	return fp
+
+# Thresholds of an automatic method from the histogram of the image (batch mode)
+def getAutoThresholds(imp_, method_):
+	return ThresholdEngine(imp_.getProcessor()).getThresholds(method_)
+
+# NaN for the pixels of a 32-bit image outside [min_, max_] : threshold mask filled natively ("NaN Background")
+def setNaNOutside(fp_, min_, max_):
+	fp_.resetRoi()
+	fp_.setThreshold(min_, max_, ImageProcessor.NO_LUT_UPDATE)
+	mask = fp_.createMask()
+	fp_.resetThreshold()
+	mask.invert()
+	fp_.setValue(Float.NaN)
+	fp_.fill(mask)
+
+# FRET index A/(D+A)*100 with the native operations of FloatProcessor (Blitter ADD, DIVIDE and threshold masks), on
+# two working images : pixels with D+A < 1 or an index outside [0,100] are NaN. The optional error is the shot-noise
+# standard deviation of the index 100*sqrt(E(1-E)/(D+A)), a per-pixel confidence from the summed intensity
+# inPlace_ : the index is written in the pixels of the 32-bit Donnor and the error in the Acceptor (low-memory mode)
+def computeFRETIndex(ipD_, ipA_, error_=False, inPlace_=False):
+	inPlace_ = inPlace_ and ipD_.getBitDepth() == 32 and ipA_.getBitDepth() == 32
+	if inPlace_ :
+		fpD, fpA = ipD_, ipA_
+	else :
+		fpD = ipD_.duplicate().convertToFloatProcessor() if ipD_.getBitDepth() == 32 else ipD_.convertToFloatProcessor()
+		fpA = ipA_.duplicate().convertToFloatProcessor() if ipA_.getBitDepth() == 32 else ipA_.convertToFloatProcessor()
+	fpD.copyBits(fpA, 0, 0, Blitter.ADD) # D+A
+	setNaNOutside(fpD, 1.0, Float.MAX_VALUE)
+	fpSum = fpD.duplicate() if error_ else None
+	fpA.copyBits(fpD, 0, 0, Blitter.DIVIDE) # E = A/(D+A)
+	setNaNOutside(fpA, 0.0, 1.0)
+	fpD.copyBits(fpA, 0, 0, Blitter.COPY)
+	if error_ :
+		fpA.resetRoi()
+		fpA.multiply(-1.0)
+		fpA.add(1.0) # 1-E
+		fpA.copyBits(fpD, 0, 0, Blitter.MULTIPLY)
+		fpA.copyBits(fpSum, 0, 0, Blitter.DIVIDE)
+		fpA.sqrt()
+		fpA.multiply(100.0)
+	fpD.multiply(100.0)
+	fpD.resetMinAndMax() # range of the finite values
+	#new processors on the pixels : the Donnor and Acceptor images can be flushed in the low-memory mode
+	width, height = ipD_.getWidth(), ipD_.getHeight()
+	fpFRET_ = FloatProcessor(width, height, fpD.getPixels())
+	fpError_ = FloatProcessor(width, height, fpA.getPixels()) if error_ else None
+	return fpFRET_, fpError_, fpD.getMin(), fpD.getMax()
+
+# Computation of the fret index : FRET index image and its error image (None if error_ is False)
+# inPlace_ : the images share the pixels of the Donnor and Acceptor images, which must no longer be used
+def CalculationFRETIndex(impD_,impA_, threshold, thresholds_=None, error_=False, inPlace_=False):
 	if threshold :
 		#Select the good threshold in the Acceptor image and threshold with NAN background
 		#if not Autothreshold.MaxEntropy method is used
-		impMask = impA_.duplicate()
-		thres_min, thres_max = thresholdImageUI(impMask)
-		impMask.close()
-		applyThreshold(impDonnor, thres_min, thres_max)
-		applyThreshold(impAcceptor, thres_min, thres_max)
-
-	impD_ = IC().run("Add create 32-bit", impD_,impA_)#------- 1) image Donnor+Acceptor -> Denominator
-	IJ.setRawThreshold(impD_,1,Float.MAX_VALUE, None) # remove 0-value pixels to exclude infinity value in the  divide calculation
-	IJ.run(impD_, "NaN Background", "")	
-	impA_ = IC().run("Divide create 32-bit", impA_, impD_)#------- 2) image Acceptor/(Donnor+Acceptor)
-	IJ.setRawThreshold(impA_,0,1, None)
-	IJ.run(impA_, "NaN Background", "")	
-	IJ.run(impA_, "Multiply...", "value=100")
-	IJ.run(impA_, "Enhance Contrast", "saturated=0.35")
-	impA_.setDisplayRange(0, 100)
-	IJ.run(impA_, "Fire", "")
-	return impA_
+		if thresholds_ is None :
+			thresholds_ = thresholdImageUI(impA_)
+		thres_min, thres_max = thresholds_
+		applyThreshold(impD_, thres_min, thres_max)
+		applyThreshold(impA_, thres_min, thres_max)
+
+	fpFRET_, fpError_, vmin, vmax = computeFRETIndex(impD_.getProcessor(), impA_.getProcessor(), error_, inPlace_)
+	return createFRETImages(fpFRET_, fpError_, vmin, vmax)
+
+# FRET index image (displayed in [vmin_, vmax_] if autoscale) and its error image (None if fpError_ is None)
+def createFRETImages(fpFRET_, fpError_, vmin_, vmax_):
+	impFRET_ = ImagePlus(FRETTitle, fpFRET_)
+	if autoscale and vmin_ <= vmax_ :
+		impFRET_.setDisplayRange(vmin_, vmax_)
+	else :
+		impFRET_.setDisplayRange(0, 100)
+	IJ.run(impFRET_, "Fire", "")
+	impError_ = None
+	if fpError_ is not None :
+		impError_ = ImagePlus(FRETErrorTitle, fpError_)
+		IJ.run(impError_, "Fire", "")
+	return impFRET_, impError_
 
 			 	
-# Label to ROIManager
-def L2R(imp_, rm_):
-	ip_ = imp_.duplicate().getProcessor()
+# Name of a ROI as given by the RoiManager (yyyy-xxxx from the center of the ROI)
+def getRoiName(roi_):
+	bounds = roi_.getBounds()
+	return adjustSizeNum(str(bounds.y+bounds.height/2), 4) + "-" + adjustSizeNum(str(bounds.x+bounds.width/2), 4)
+
+# Bounding box and seed pixel of every label from the native bounding boxes of MorphoLibJ
+# {label : [xmin, ymin, xmax, ymax, xseed, yseed]}, the seed is the first pixel of the top row of the label (on its contour)
+def getLabelBoxes(ip_):
+	labels = LabelImages.findAllLabels(ip_)
+	width, height = ip_.getWidth(), ip_.getHeight()
+	boxes_ = {}
+	for label, box in zip(labels, BoundingBox.boundingBoxes(ip_, labels, Calibration())) :
+		x0, y0 = int(floor(box.getXMin())), int(floor(box.getYMin()))
+		x1 = min(int(ceil(box.getXMax())), width - 1) # may include the column after the label
+		y1 = min(int(ceil(box.getYMax())), height - 1)
+		x = x0
+		while x < x1 and ip_.getf(x, y0) != label :
+			x += 1
+		boxes_[label] = [x0, y0, x1, y1, x, y0]
+	return boxes_
+
+# Label to ROIs : {label : ROI} sorted by label, the contour of each label is traced once from its seed pixel
+# (only the component of the seed pixel is traced for a label made of several components)
+def L2R(imp_):
+	ip_ = imp_.getProcessor()
+	boxes = getLabelBoxes(ip_)
 	wand = Wand( ip_ )
-	ip_.setColor(0)
-	for y in range(imp_.height):
-		for x in range(imp_.width):
-			 if ( ip_.getPixel( x, y ) > 0.0 ):
-			 	wand.autoOutline( x, y )
-			 	if ( wand.npoints > 0 ) :
-			 		roi = PolygonRoi(wand.xpoints, wand.ypoints, wand.npoints, Roi.TRACED_ROI)
-					roi.setPosition( imp_.getCurrentSlice() )
-					ip_.fill(roi)
-					rm_.addRoi( roi )
-	return
+	rois_ = OrderedDict()
+	for label in sorted(boxes) :
+		box = boxes[label]
+		wand.autoOutline( box[4], box[5], label, label )
+		if ( wand.npoints > 0 ) :
+			roi = PolygonRoi(wand.xpoints, wand.ypoints, wand.npoints, Roi.TRACED_ROI)
+			roi.setPosition( imp_.getCurrentSlice() )
+			roi.setName(getRoiName(roi))
+			rois_[label] = roi
+	return rois_
+
+# Automatic markers of the watershed : the smoothed projection is thresholded (Otsu) and filled, one marker per
+# extended maximum (dynamic_) of its distance map deeper than minRadius_, and one background marker for the pixels
+# farther than margin_ from the nuclei. Return the label image of the markers and the mask of the nuclei
+def getAutoMarkers(impProj_, sigma_, dynamic_, minRadius_, margin_):
+	ip = impProj_.getProcessor().convertToFloatProcessor()
+	if ip is impProj_.getProcessor() :
+		ip = ip.duplicate()
+	if sigma_ > 0 :
+		GaussianBlur().blurGaussian(ip, sigma_, sigma_, 0.0002)
+	ip.setAutoThreshold(AutoThresholder.Method.Otsu, True, ImageProcessor.NO_LUT_UPDATE)
+	mask = Reconstruction.fillHoles(ip.createMask())
+	edm = EDM().makeFloatEDM(mask, 0, False)
+	distances = edm.getPixels()
+	for i in xrange(len(distances)) :
+		if distances[i] < minRadius_ :
+			distances[i] = 0
+	maxima = MinimaAndMaxima.extendedMaxima(edm, dynamic_, 8)
+	maxima.copyBits(mask, 0, 0, Blitter.AND) # no marker in the background plateau
+	markers = BinaryImages.componentsLabeling(maxima, 8, 32).convertToFloatProcessor()
+	labels = markers.getPixels()
+	background = markers.getStatistics().max + 1
+	outside = EDM().makeFloatEDM(mask, 255, False).getPixels()
+	for i in xrange(len(labels)) :
+		if outside[i] > margin_ :
+			labels[i] = background
+	return ImagePlus("Marker Image", markers), mask
+
+# Automatic selection of the background regions to merge : one point in each label lying mostly (> 50%) outside the
+# mask of the nuclei. Return a PointRoi for LabelImages.mergeLabels, None if there is no background label
+def getBackgroundLabels(impLabel_, mask_):
+	ip = impLabel_.getProcessor()
+	labels = ip.convertToFloatProcessor().getPixels()
+	inside = mask_.getPixels()
+	width = ip.getWidth()
+	counts = {} # label : [pixels, pixels inside the mask, index of the first pixel]
+	for i in xrange(len(labels)) :
+		label = int(labels[i])
+		if label == 0 :
+			continue
+		count = counts.get(label)
+		if count is None :
+			count = counts[label] = [0, 0, i]
+		count[0] += 1
+		if inside[i] != 0 :
+			count[1] += 1
+	roi_ = None
+	for label in sorted(counts) :
+		total, nuclei, first = counts[label]
+		if nuclei * 2 < total :
+			if roi_ is None :
+				roi_ = PointRoi(first % width, first // width)
+			else :
+				roi_.addPoint(first % width, first // width)
+	return roi_
+
+# Marker-controlled watershed of the projection downsampled by factor_ (average), the markers being downsampled by
+# their maximum in each block (Binner). The labels are upsampled and the pixels close to the dams (3x3 low resolution
+# neighbourhood) are flooded again at full resolution, the watershed being restricted to these pixels and a ring of
+# labeled pixels around them. Full resolution watershed if factor_ <= 1 or if markers closer than factor_ are merged
+def computePyramidWatershed(impProj_, impMarker_, factor_):
+	f = int(factor_)
+	if f <= 1 :
+		return Watershed.computeWatershed(impProj_, impMarker_, None, 8, True )
+	ip = impProj_.getProcessor()
+	width = ip.getWidth()
+	height = ip.getHeight()
+	sw = (width + f - 1) // f
+	sh = (height + f - 1) // f
+	ip.setInterpolationMethod(ImageProcessor.BILINEAR)
+	ipSmall = ip.resize(sw, sh, True)
+
+	#markers : maximum of each block of the image padded to a multiple of factor_
+	ipMarker = impMarker_.getProcessor()
+	padded = FloatProcessor(sw * f, sh * f)
+	padded.insert(ipMarker.convertToFloatProcessor(), 0, 0)
+	markerSmall = Binner().shrink(padded, f, f, Binner.MAX)
+	if len(LabelImages.findAllLabels(markerSmall)) < len(LabelImages.findAllLabels(ipMarker)) :
+		print "Markers closer than the watershed factor %d : full resolution watershed" % f
+		return Watershed.computeWatershed(impProj_, impMarker_, None, 8, True )
+	impSmall = Watershed.computeWatershed(ImagePlus("Projection", ipSmall), ImagePlus("Marker Image", markerSmall), None, 8, True )
+
+	#dams of the low resolution labels dilated by one pixel (3x3), then upsampled by replication with the labels
+	labelsSmall = impSmall.getProcessor().convertToFloatProcessor()
+	labelsSmall.setThreshold(0.0, 0.0, ImageProcessor.NO_LUT_UPDATE)
+	band = labelsSmall.createMask()
+	labelsSmall.resetThreshold()
+	RankFilters().rank(band, 1, RankFilters.MAX)
+	for ipLow in (labelsSmall, band) :
+		ipLow.setInterpolationMethod(ImageProcessor.NONE)
+	labels = FloatProcessor(width, height)
+	labels.copyBits(labelsSmall.resize(sw * f, sh * f), 0, 0, Blitter.COPY)
+	mask = ByteProcessor(width, height)
+	mask.copyBits(band.resize(sw * f, sh * f), 0, 0, Blitter.COPY)
+	labels.setValue(0.0)
+	labels.fill(mask) # markers : the labels outside the band
+	RankFilters().rank(mask, 1, RankFilters.MAX) # the band and a ring of labeled pixels flooded from the markers
+	refined = Watershed.computeWatershed(impProj_, ImagePlus("Marker Image", labels), ImagePlus("Mask", mask), 8, True )
+	labels.copyBits(refined.getProcessor().convertToFloatProcessor(), 0, 0, Blitter.MAX) # refined labels in the band
+	impLabel_ = ImagePlus(refined.getTitle(), labels)
+	impLabel_.setCalibration(refined.getCalibration())
+	return impLabel_
+
+# Intersection over union of the labels of two label images : {label : IoU}
+def getLabelIoU(ipA_, ipB_):
+	return core.labelIoU(ipA_.convertToFloatProcessor().getPixels(), ipB_.convertToFloatProcessor().getPixels())
+
+# Batch mode by tiles : the Donnor and Acceptor planes are read in tiles of params_["tileSize"] with a halo for the
+# Gaussian blur and the despeckle, preprocessed and background subtracted, and the FRET index of each tile is written in
+# the pyramidal "FRET index (%).ome.tif". The projection (the Donnor and Acceptor tiles read once), Donnor, Acceptor and
+# full-resolution FRET index tiles are downsampled by params_["tileFactor"] (mean of the finite pixels), the FRET index
+# one giving the sub-resolutions of the pyramid. Return the downsampled projection, Donnor, Acceptor and FRET index images
+def streamSerie(session_, idxSerie_, params_, impFolder_, backROI_=None):
+	idxDonnor, idxAcceptor = params_["donor"], params_["acceptor"]
+	if idxDonnor == idxAcceptor :
+		raise ValueError("the Donnor and Acceptor channels must be different")
+	thresholds = None
+	if params_["FRETtype"] == "Whole cell" :
+		thresholds = params_["thresholds"]
+		if thresholds is None :
+			raise ValueError("thresholdMin and thresholdMax are required for the Whole cell analysis by tiles")
+	f = max(int(params_["tileFactor"]), 1)
+	width, height = session_.getSize(idxSerie_)
+	sizeC = session_.getDimensions(idxSerie_)[0]
+	cal = session_.getCalibration(idxSerie_)
+	saturation = params_["saturation"] or session_.getSaturation(idxSerie_)
+	sigma = params_["sigma"]
+	halo = int(ceil(3 * sigma)) + 2 # Gaussian blur and despeckle
+
+	# preprocessed region of a channel, and the raw pixels of its part tile_ (x, y, w, h in the region) if given
+	def readRegion(channel, x, y, w, h, tile_=None) :
+		ip = session_.readTile(idxSerie_, channel, x, y, w, h)
+		raw = None
+		if tile_ is not None :
+			ip.setRoi(*tile_)
+			raw = ip.crop()
+			ip.resetRoi()
+		return removeSaturatedPixels(ImagePlus("tile", ip), saturation, sigma), raw
+
+	# region of a tile with its halo
+	def getHalo(x, y, w, h) :
+		rx = max(x - halo, 0)
+		ry = max(y - halo, 0)
+		return rx, ry, min(x + w + halo, width) - rx, min(y + h + halo, height) - ry
+
+	if params_["backgroundSubtract"] :
+		backDonnor, backAcceptor = params_["backgroundDonor"], params_["backgroundAcceptor"]
+	else :
+		b = backROI_.getBounds()
+		rx, ry, rw, rh = getHalo(b.x, b.y, b.width, b.height)
+		roi = backROI_.clone()
+		roi.setLocation(b.x - rx, b.y - ry)
+		backDonnor = measureBackground(readRegion(idxDonnor, rx, ry, rw, rh)[0], roi)
+		backAcceptor = measureBackground(readRegion(idxAcceptor, rx, ry, rw, rh)[0], roi)
+
+	unit = 16 * f # tiles of the TIFF multiple of 16, aligned on the downsampled images
+	tile = max(unit, int(params_["tileSize"]) // unit * unit)
+	sw, sh = (width + f - 1) // f, (height + f - 1) // f
+	sizes = [(width, height)]
+	w, h = sw, sh
+	while True :
+		sizes.append((w, h))
+		if max(w, h) <= tile :
+			break
+		w, h = (w + 1) // 2, (h + 1) // 2
+	writer = TiledTiffWriter(os.path.join(impFolder_, FRETTitle+".ome.tif"), sizes, tile, cal)
+	writerError = None
+	if params_["FRETError"] :
+		writerError = TiledTiffWriter(os.path.join(impFolder_, FRETErrorTitle+".ome.tif"), sizes, tile, cal)
+	fpProj, fpDonnor, fpAcceptor = FloatProcessor(sw, sh), FloatProcessor(sw, sh), FloatProcessor(sw, sh)
+	fpFRETSmall = FloatProcessor(sw, sh)
+	fpErrorSmall = FloatProcessor(sw, sh) if writerError is not None else None
+	try :
+		for y in xrange(0, height, tile) :
+			for x in xrange(0, width, tile) :
+				w = min(tile, width - x)
+				h = min(tile, height - y)
+				rx, ry, rw, rh = getHalo(x, y, w, h)
+				impD, rawD = readRegion(idxDonnor, rx, ry, rw, rh, (x - rx, y - ry, w, h))
+				impA, rawA = readRegion(idxAcceptor, rx, ry, rw, rh, (x - rx, y - ry, w, h))
+				impD.getProcessor().subtract(backDonnor)
+				impA.getProcessor().subtract(backAcceptor)
+				if thresholds is not None :
+					applyThreshold(impD, thresholds[0], thresholds[1])
+					applyThreshold(impA, thresholds[0], thresholds[1])
+				fpFRET, fpError, vmin, vmax = computeFRETIndex(impD.getProcessor(), impA.getProcessor(), writerError is not None)
+				tiles = [fpFRET, fpError, impD.getProcessor(), impA.getProcessor()]
+				for ip in tiles :
+					if ip is not None :
+						ip.setRoi(x - rx, y - ry, w, h)
+				writer.writeTile(fpFRET.crop(), x, y)
+				if writerError is not None :
+					writerError.writeTile(fpError.crop(), x, y)
+				ipProj = None
+				raws = {idxDonnor : rawD, idxAcceptor : rawA} # already read with their halo
+				for c in range(1, sizeC + 1) :
+					ip = raws[c] if c in raws else session_.readTile(idxSerie_, c, x, y, w, h)
+					if ipProj is None :
+						ipProj = ip.convertToFloatProcessor()
+					else :
+						ipProj.copyBits(ip.convertToFloatProcessor(), 0, 0, Blitter.MAX)
+				ds, dh = (w + f - 1) // f, (h + f - 1) // f
+				fpProj.insert(downsample(ipProj, ds, dh), x // f, y // f)
+				fpDonnor.insert(downsample(impD.getProcessor().crop(), ds, dh), x // f, y // f)
+				fpAcceptor.insert(downsample(impA.getProcessor().crop(), ds, dh), x // f, y // f)
+				fpFRETSmall.insert(downsample(fpFRET.crop(), ds, dh), x // f, y // f)
+				if fpErrorSmall is not None :
+					fpErrorSmall.insert(downsample(fpError.crop(), ds, dh), x // f, y // f)
+
+		calSmall = cal.copy()
+		calSmall.pixelWidth *= f
+		calSmall.pixelHeight *= f
+		impDonnor = ImagePlus("Donnor", fpDonnor)
+		impAcceptor = ImagePlus("Acceptor", fpAcceptor)
+		fpFRETSmall.resetMinAndMax()
+		impFRET, impError = createFRETImages(fpFRETSmall, fpErrorSmall, fpFRETSmall.getMin(), fpFRETSmall.getMax())
+		writer.writeLevels(fpFRETSmall)
+		if writerError is not None :
+			writerError.writeLevels(fpErrorSmall)
+	finally :
+		writer.close()
+		if writerError is not None :
+			writerError.close()
+	fpProj.resetMinAndMax()
+	impProj = ImagePlus("MAX_" + os.path.basename(session_.imagefile), fpProj)
+	for imp in (impProj, impDonnor, impAcceptor, impFRET) :
+		imp.setCalibration(calSmall)
+	return impProj, impDonnor, impAcceptor, impFRET
+
+# FRET index of a frame of a time-lapse with the parameters of the first frame : channels_ [Donnor, Acceptor] read at the
+# frame (maximum projection over Z), preprocessed, background subtracted (estimated again for each frame in the automatic
+# mode, appended to backgrounds_) and thresholded (Whole cell)
+# The images are held in pool_ : in the low-memory mode, the index is computed in place and the Acceptor is released
+def readFrameFRET(session_, idxSerie_, frame_, params_, channels_, saturation_, backROI_, threshold_, thresholds_, cal_, backgrounds_=None, pool_=None):
+	pool_ = pool_ or BufferPool()
+	planes = session_.readPlanes(idxSerie_, channels_, frame_)
+	pool_.hold(*planes.values())
+	imps = [removeSaturatedPixels(ImagePlus("C%d" % c, planes.pop(c)), saturation_, params_["sigma"], pool_) for c in channels_]
+	background = subtractBackgrounds(imps[0], imps[1], params_, backROI_)
+	if backgrounds_ is not None :
+		background["frame"] = frame_ + 1
+		backgrounds_.append(background)
+	impFRET, impError = CalculationFRETIndex(imps[0], imps[1], threshold_, thresholds_, False, pool_.reuse)
+	impFRET.setCalibration(cal_)
+	pool_.hold(impFRET)
+	if pool_.reuse :
+		imps[0].flush() # its pixels are the FRET index
+		imps = imps[1:]
+	pool_.release(*imps)
+	return impFRET
 
 # check the value of the multipoint roi to know if it is necessary to merge the background with the function "mergeLabels"
 def checkMerging(imp_,roi_):
@@ -350,233 +1551,888 @@ def checkMerging(imp_,roi_):
 		merging |= ip_.getPixelValue(int(polyRoi.xpoints[i]), int(polyRoi.ypoints[i])) > .0
 	return merging
 
-#convert the 2 arrays of the polygon coordinates into Points2D (in order to use the vector product). Remove 2 points too close
-def Polygon2Points(FPol) :
-	p2p =[Point2D(FPol.xpoints[i], FPol.ypoints[i]) for i in range(FPol.npoints)]
-	#remove all doublets
-	return list(OrderedDict.fromkeys(p2p))
+# FRET index at the points of a contour, the points with a NaN or 0 value are discarded.
+# Return the indexes of the kept points, their coordinates and values as primitive arrays.
+# Bilinear interpolation between the pixel centers if bilinear_, else the value of the pixel containing the point
+def sampleContour(ip_, contour_, bilinear_=False):
+	return core.sampleContour(ip_.getPixels(), ip_.getWidth(), ip_.getHeight(), contour_.xs, contour_.ys, bilinear_)
+
+#### Fonctions for STEP 4 : FRET index of segmented nuclei
+
+# Signed distance transform of a label image : negative inside the nuclei (EDM distance to the background) and positive
+# outside (EDM distance to the nearest nucleus), from the two native EDM. Return the distances and a copy of the labels
+# in which the background pixels up to the distance maxOut_ get the label of their nearest nucleus (LabelImages.dilateLabels)
+# inPlace_ : the labels of a 32-bit label image are grown in place. The images are held in pool_ (distances acquired)
+def labelDistanceTransform(ipLabel_, maxOut_, pool_=None, inPlace_=False):
+	pool_ = pool_ or BufferPool()
+	fp = ipLabel_.convertToFloatProcessor()
+	if fp is ipLabel_ and not inPlace_ :
+		fp = fp.duplicate()
+	pool_.hold(fp)
+	mask = ipLabel_.convertToByteProcessor(False)
+	mask.threshold(0) # 255 for the nuclei
+	fpIn = EDM().makeFloatEDM(mask, 0, False)
+	fpOut = EDM().makeFloatEDM(mask, 255, False)
+	pool_.hold(mask, fpIn, fpOut)
+	fpDist = pool_.acquire(fp.getWidth(), fp.getHeight()) # every pixel is written
+	fpDist.copyBits(fpOut, 0, 0, Blitter.COPY)
+	fpDist.copyBits(fpIn, 0, 0, Blitter.SUBTRACT)
+	pool_.release(mask, fpIn, fpOut)
+	grown = LabelImages.dilateLabels(fp, maxOut_)
+	pool_.hold(grown)
+	fp.copyBits(grown.convertToFloatProcessor(), 0, 0, Blitter.COPY)
+	pool_.release(grown)
+	return fp, fpDist.getPixels()
+
+# Nuclear envelope from the signed distance transform, computed once for all the frames (core.envelope) :
+# - labels of the band : pixels of the kept labels (keep_[label] True) at a distance -inner_ <= d <= outer_ of the envelope
+# - labels of the nuclei dilated by dilation_ for measureLabels
+# - boxes of the bands {label : [xmin, ymin, xmax, ymax]} used to extract the ROI of each band
+# - pixels of the radial profiles for -depth_ <= d <= outer_ in bins of width bin_, and the mask outside the band
+# The images are held in pool_
+def getEnvelope(fpLabel_, dist_, keep_, inner_, outer_, dilation_, depth_, bin_, pool_=None):
+	width = fpLabel_.getWidth()
+	height = fpLabel_.getHeight()
+	pool_ = pool_ or BufferPool()
+	bandLabels, dilatedLabels, boxes_, profilePixels_ = core.envelope(fpLabel_.getPixels(), dist_, width, keep_, inner_,
+		outer_, dilation_, depth_, bin_)
+	fpBandLabels_ = FloatProcessor(width, height, bandLabels)
+	fpDilated_ = FloatProcessor(width, height, dilatedLabels)
+	fpBandLabels_.setThreshold(1.0, Float.MAX_VALUE, ImageProcessor.NO_LUT_UPDATE)
+	outside_ = fpBandLabels_.createMask()
+	fpBandLabels_.resetThreshold()
+	outside_.invert()
+	pool_.hold(fpBandLabels_, fpDilated_, outside_)
+	return fpBandLabels_, fpDilated_, boxes_, profilePixels_, outside_
+
+# FRET index of a frame in the nuclear band (NaN outside_, native fill) and its radial profiles
+# {label : {bin : [count, sum]}} on the pixels of the envelope. The band image is acquired from pool_
+def measureBand(ipFRET_, outside_, profilePixels_, pool_=None):
+	pool_ = pool_ or BufferPool()
+	fpBand_ = pool_.acquire(ipFRET_.getWidth(), ipFRET_.getHeight())
+	fpBand_.copyBits(ipFRET_, 0, 0, Blitter.COPY)
+	fpBand_.setValue(Float.NaN)
+	fpBand_.fill(outside_)
+	return fpBand_, core.radialProfiles(ipFRET_.getPixels(), profilePixels_)
+
+# ROI of the band of each nucleus : threshold to selection of its label in the box of the band
+def getBandRois(fpBandLabels_, boxes_, names_):
+	rois_ = []
+	for label in sorted(boxes_) :
+		x0, y0, x1, y1 = boxes_[label]
+		fpBandLabels_.setRoi(x0, y0, x1-x0+1, y1-y0+1)
+		crop = fpBandLabels_.crop()
+		crop.setThreshold(label, label, ImageProcessor.NO_LUT_UPDATE)
+		roi = ThresholdToSelection().convert(crop)
+		if roi is not None :
+			roi.setLocation(int(x0 + roi.getXBase()), int(y0 + roi.getYBase()))
+			roi.setName(names_.get(label))
+			rois_.append(roi)
+	fpBandLabels_.resetRoi()
+	return rois_
+
+# Shape of the labels of labels_ (all labels if None), independent of the FRET index and computed once for all the frames :
+# {label : [box, mask, Area, Circ., AR, Round, Solidity]} with the box (Rectangle) and the mask of the label in its box
+# AR = major/minor, Round = minor/major axis of the native fitted ellipse, perimeter and convex hull of the traced contour
+def getLabelShapes(ipLabel_, cal_, labels_=None):
+	boxes = getLabelBoxes(ipLabel_)
+	wand = Wand(ipLabel_)
+	shapes_ = OrderedDict()
+	for label in sorted(boxes) :
+		if labels_ is not None and label not in labels_ :
+			continue
+		x0, y0, x1, y1, xseed, yseed = boxes[label]
+		box = Rectangle(x0, y0, x1-x0+1, y1-y0+1)
+		ipLabel_.setRoi(box)
+		crop = ipLabel_.crop()
+		crop.setThreshold(label, label, ImageProcessor.NO_LUT_UPDATE)
+		mask = crop.createMask()
+		mask.setMask(mask)
+		stats = ImageStatistics.getStatistics(mask, Measurements.AREA | Measurements.ELLIPSE, None)
+		n = stats.pixelCount
+		ar = stats.major / stats.minor if stats.minor > 0 else 1.0
+		wand.autoOutline(xseed, yseed, label, label)
+		roi = PolygonRoi(wand.xpoints, wand.ypoints, wand.npoints, Roi.TRACED_ROI)
+		perimeter = roi.getLength()
+		circ = min(4 * pi * n / (perimeter * perimeter), 1.0) if perimeter > 0 else 0.0
+		hull = roi.getConvexHull()
+		hullArea = abs(sum(hull.xpoints[i] * hull.ypoints[(i+1) % hull.npoints] - hull.xpoints[(i+1) % hull.npoints] * hull.ypoints[i] for i in range(hull.npoints))) / 2.0
+		solidity = min(n / hullArea, 1.0) if hullArea > 0 else Float.NaN
+		shapes_[label] = [box, mask, n * cal_.pixelWidth * cal_.pixelHeight, circ, ar, 1 / ar, solidity]
+	ipLabel_.resetRoi()
+	return shapes_
+
+# Statistics of the labels on a FRET index image (NaN excluded), natively in the mask of each label
+# {label : [Area, Mean, StdDev, Count, Circ., AR, Round, Solidity]} for the labels of labels_ (all labels if None)
+# shapes_ : shapes of getLabelShapes computed once for the frames of a time-lapse
+def measureLabels(ipLabel_, ipFRET_, cal_, labels_=None, shapes_=None):
+	if shapes_ is None :
+		shapes_ = getLabelShapes(ipLabel_, cal_, labels_)
+	stats_ = OrderedDict()
+	for label, (box, mask, area, circ, ar, rnd, solidity) in shapes_.items() :
+		ipFRET_.setRoi(box)
+		ipFRET_.setMask(mask)
+		stats = ImageStatistics.getStatistics(ipFRET_, Measurements.MEAN | Measurements.STD_DEV, None)
+		count = stats.pixelCount
+		mean = stats.mean if count > 0 else Float.NaN
+		std = stats.stdDev if count > 1 else 0.0
+		stats_[label] = [area, mean, std, count, circ, ar, rnd, solidity]
+	ipFRET_.resetRoi()
+	return stats_
+
+
+#### Fonctions for the batch mode : headless analysis of every serie of a list of files or folders
+
+# Save a list of ROIs in a zip file readable by the RoiManager, scaled by scale_ (ROIs of a downsampled image saved in
+# the coordinates of the full resolution image)
+def saveRoiZip(rois_, zipfile_, scale_=1):
+	zos = ZipOutputStream(BufferedOutputStream(FileOutputStream(zipfile_)))
+	try :
+		names = set()
+		for i, roi in enumerate(rois_) :
+			name = roi.getName()
+			if scale_ != 1 :
+				roi = RoiScaler.scale(roi, scale_, scale_, False)
+			if not name or name in names :
+				name = adjustSizeNum(str(i+1), 4)
+			names.add(name)
+			zos.putNextEntry(ZipEntry(name+".roi"))
+			zos.write(RoiEncoder.saveAsByteArray(roi))
+			zos.closeEntry()
+	finally :
+		zos.close()
+	return
 
-#---------------------------------------------------------------
-#     -----------------       Start       -----------------
-#---------------------------------------------------------------
+# Read all the ROIs of a zip file saved by the RoiManager (keep the order of the file)
+def readRoiZip(zipfile_):
+	rois_ = []
+	zis = ZipInputStream(FileInputStream(zipfile_))
+	buf = zeros(8192, 'b')
+	try :
+		entry = zis.getNextEntry()
+		while entry is not None :
+			if entry.getName().endswith(".roi") :
+				bytes_ = ByteArrayOutputStream()
+				n = zis.read(buf)
+				while n >= 0 :
+					bytes_.write(buf, 0, n)
+					n = zis.read(buf)
+				roi = RoiDecoder(bytes_.toByteArray(), entry.getName()).getRoi()
+				if roi is not None :
+					rois_.append(roi)
+			entry = zis.getNextEntry()
+	finally :
+		zis.close()
+	return rois_
+
+# Save a report (dictionaries, lists and numbers) as a JSON file
+def saveJson(report_, path_):
+	f = open(path_, "w")
+	try :
+		json.dump(report_, f, indent=2)
+	finally :
+		f.close()
+
+# Close the last stage of a profiler and save its report in the folder of the serie : return the report
+def closeProfiler(profiler_, result_):
+	profiler_.close()
+	profiler_.info["result"] = {True : "analyzed", False : "skipped", None : "failed"}[result_]
+	report_ = profiler_.getReport()
+	if profiler_.folder is not None :
+		try :
+			profiler_.save(os.path.join(profiler_.folder, "RunReport.json"))
+		except (Exception, JavaException), e :
+			print "Cannot save the run report: " + str(e)
+	return report_
+
+# Row of a serie in the runs table of the results store : keys, condition (folder of the file), channels, counts, times
+# and peak of the images held
+runColumns = ["File", "Serie", "Condition", "Result", "FRETtype", "Donor", "Acceptor", "Background", "Frames", "Nuclei",
+	"WallSeconds", "CpuSeconds", "PeakHeldMB", "Folder"]
+def storeRun(store_, report_, params_):
+	counts = {}
+	for stage in report_["stages"] :
+		counts.setdefault(stage["stage"], stage["counts"])
+	channels = report_.get("channels", {"donor" : params_["donor"], "acceptor" : params_["acceptor"]})
+	background = (report_.get("background") or [None])[0] or {}
+	store_.append("runs", runColumns, [[report_["file"], report_["serie"], os.path.basename(os.path.dirname(report_["file"])),
+		report_["result"], params_["FRETtype"], channels["donor"], channels["acceptor"], background.get("method"),
+		counts.get("frames", {}).get("frames"), counts.get("contours", {}).get("rois"), report_["wallSeconds"],
+		report_["cpuSeconds"], report_["peakHeldMB"], report_.get("folder")]])
+
+# Save an image of a serie according to the output mode : TIFF (full), zipped TIFF (compressed), none (tables, store)
+def saveImage(imp_, path_, params_):
+	if params_["output"] == "full" :
+		FileSaver(imp_).saveAsTiff(path_)
+	elif params_["output"] == "compressed" :
+		FileSaver(imp_).saveAsZip(os.path.splitext(path_)[0] + ".zip")
+
+# Save a result table of a serie as a csv file (except in output mode store) and append it to the results store
+def saveTable(table_, path_, params_, storeTable_, keys_):
+	if params_["output"] != "store" :
+		table_.saveAs(path_)
+	if params_["store"] is not None :
+		params_["store"].append(storeTable_, ["File", "Serie"] + table_.columns.keys(), table_.getRows(keys_))
+
+# Get a file of the serie folder (relative name) or an absolute path. None if it does not exist
+def findSeriesFile(name_, impFolder_):
+	if not name_ :
+		return None
+	file_ = os.path.join(impFolder_, name_) # os.path.join keeps name_ if it is an absolute path
+	if os.path.isfile(file_) :
+		return file_
+	return None
+
+# Parameters of the analysis given by the constants of the script
+def defaultParameters():
+	params_ = {"interactive" : True, "FRETError" : FRETError, "autoMarkers" : False, "cache" : None, "backgroundAuto" : None}
+	params_["output"] = "full"
+	params_["store"] = None
+	params_["lowMemory"] = False
+	params_["backgroundPercentile"] = backgroundPercentile
+	params_["fretPairs"] = fretPairs
+	params_["backgroundGrid"] = backgroundGrid
+	params_["markerDynamic"] = markerDynamic
+	params_["markerMinRadius"] = markerMinRadius
+	params_["backgroundMargin"] = backgroundMargin
+	params_["watershedFactor"] = watershedFactor
+	params_["watershedCheck"] = watershedCheck
+	params_["tileSize"] = tileSize
+	params_["tileFactor"] = tileFactor
+	params_["saturation"] = saturationLevel
+	params_["sigma"] = gaussianSigma
+	params_["dilation"] = nucleiDilation
+	params_["bilinear"] = contourBilinear
+	params_["spacing"] = contourSpacing
+	params_["bandInner"] = bandInner
+	params_["bandOuter"] = bandOuter
+	params_["profileDepth"] = profileDepth
+	params_["profileBin"] = profileBin
+	return params_
+
+# Read a table of FRET pairs (JSON) : [{"name" : "CFP/YFP", "donor" : {"emission" : [460, 500], "names" : ["CFP", ...]},
+# "acceptor" : {...}}, ...] in the order of preference
+def readFretPairs(path_):
+	f = open(path_)
+	try :
+		table = json.load(f)
+	finally :
+		f.close()
+	toSpec = lambda spec_ : (tuple(float(v) for v in spec_.get("emission", (0, -1))), tuple(spec_.get("names", ())))
+	return [(pair["name"], toSpec(pair["donor"]), toSpec(pair["acceptor"])) for pair in table]
+
+# Read the batch parameter file (java properties format "key = value", use / in the paths)
+def readParameterFile(paramfile_):
+	props = Properties()
+	stream = FileInputStream(paramfile_)
+	try :
+		props.load(InputStreamReader(stream, "UTF-8"))
+	finally :
+		stream.close()
+	values = dict((str(key).strip(), (props.getProperty(key) or "").strip()) for key in props.stringPropertyNames())
+	values = dict((key, value) for key, value in values.items() if value)
+	paramDir = os.path.dirname(paramfile_)
+	toList = lambda s_ : [s.strip() for s in s_.split(",") if s.strip()]
+	toBoolean = lambda s_ : s_.lower() in ("true", "yes", "1")
+
+	params_ = defaultParameters()
+	params_["interactive"] = False
+	params_["inputs"] = [os.path.join(paramDir, os.path.expanduser(s)) for s in toList(values.get("inputs", ""))]
+	params_["extensions"] = [s.lower() for s in toList(values.get("extensions", imageExtensions))]
+	params_["recursive"] = toBoolean(values.get("recursive", "false"))
+	# series analyzed concurrently : number of threads and of series open at once (memory)
+	params_["threads"] = int(values.get("threads", Runtime.getRuntime().availableProcessors()))
+	params_["maxOpenSeries"] = int(values.get("maxOpenSeries", params_["threads"]))
+	params_["series"] = None # all series
+	if values.get("series", "all").lower() != "all" :
+		params_["series"] = [int(s)-1 for s in toList(values["series"])]
+	params_["FRETtype"] = values.get("FRETtype", "Nuclei")
+	if params_["FRETtype"] not in ("Nuclei", "Whole cell") :
+		raise ValueError("FRETtype must be Nuclei or Whole cell: %s" % params_["FRETtype"])
+	if not params_["inputs"] :
+		raise ValueError("inputs are required in the parameter file %s" % paramfile_)
+	# Donnor and Acceptor channels, detected for each serie if not given or auto
+	params_["donor"] = int(values["donor"]) if values.get("donor", "auto").lower() != "auto" else None
+	params_["acceptor"] = int(values["acceptor"]) if values.get("acceptor", "auto").lower() != "auto" else None
+	if "fretPairs" in values :
+		params_["fretPairs"] = readFretPairs(os.path.join(paramDir, os.path.expanduser(values["fretPairs"])))
+	# constant background values, or a background ROI (zip) when they are not given
+	params_["backgroundSubtract"] = "backgroundDonor" in values and "backgroundAcceptor" in values
+	params_["backgroundDonor"] = float(values.get("backgroundDonor", 0))
+	params_["backgroundAcceptor"] = float(values.get("backgroundAcceptor", 0))
+	params_["backgroundRoi"] = values.get("backgroundRoi", backgroundFile)
+	# automatic background (percentile or surface), used instead of the values and the ROI
+	params_["backgroundAuto"] = values.get("backgroundAuto", "none").lower()
+	if params_["backgroundAuto"] not in ("none", "percentile", "surface") :
+		raise ValueError("backgroundAuto must be none, percentile or surface: %s" % params_["backgroundAuto"])
+	if params_["backgroundAuto"] == "none" :
+		params_["backgroundAuto"] = None
+	# markers of the watershed saved by a previous interactive analysis, or "auto" for automatic markers
+	params_["markers"] = values.get("markers", markersFile)
+	params_["autoMarkers"] = params_["markers"].lower() == "auto"
+	# thresholds of the Whole cell analysis, MaxEntropy automatic thresholds if not given
+	params_["thresholds"] = None
+	if "thresholdMin" in values and "thresholdMax" in values :
+		params_["thresholds"] = float(values["thresholdMin"]), float(values["thresholdMax"])
+	params_["FRETError"] = toBoolean(values.get("FRETError", str(FRETError)))
+	params_["bilinear"] = toBoolean(values.get("bilinear", str(contourBilinear)))
+	params_["watershedCheck"] = toBoolean(values.get("watershedCheck", str(watershedCheck)))
+	# cache of the preprocessed images and labels (size in MB), cleared for the input files if cacheClear
+	params_["cacheFolder"] = os.path.join(paramDir, os.path.expanduser(values["cacheFolder"])) if "cacheFolder" in values else None
+	params_["cacheSize"] = float(values.get("cacheSize", cacheSize))
+	params_["cacheClear"] = toBoolean(values.get("cacheClear", "false"))
+	# results of all the series appended to a store folder, and images and tables saved in the folder of each serie :
+	# full (TIFF), compressed (zipped TIFF), tables (no image) or store (no image and no csv table, a store is required)
+	params_["storeFolder"] = os.path.join(paramDir, os.path.expanduser(values["resultStore"])) if "resultStore" in values else None
+	params_["output"] = values.get("output", "full").lower()
+	if params_["output"] not in ("full", "compressed", "tables", "store") :
+		raise ValueError("output must be full, compressed, tables or store: %s" % params_["output"])
+	if params_["output"] == "store" and params_["storeFolder"] is None :
+		raise ValueError("output store requires a resultStore folder in the parameter file %s" % paramfile_)
+	# low-memory mode : stages in place, float images reused between the frames and images released once used
+	params_["lowMemory"] = toBoolean(values.get("lowMemory", str(lowMemory)))
+	# aggregated report of the stages of the batch (JSON)
+	params_["report"] = os.path.join(paramDir, os.path.expanduser(values.get("report", "BatchReport.json")))
+	# numerical parameters of the analysis (constants of the script if not given)
+	for key in numericalParameters :
+		if key in values :
+			params_[key] = float(values[key])
+	return params_
+
+# List the image files of the inputs (files or folders), the folders created by createFolder are skipped
+def listImageFiles(inputs_, extensions_, recursive_):
+	isImage = lambda f_ : os.path.splitext(f_)[1].lower() in extensions_
+	files_ = []
+	for input_ in inputs_ :
+		if os.path.isfile(input_) :
+			files_.append(input_)
+		elif os.path.isdir(input_) :
+			for root, dirs, names in os.walk(input_) :
+				files_ += [os.path.join(root, name) for name in sorted(names) if isImage(name)]
+				if recursive_ :
+					dirs[:] = sorted(d for d in dirs if not re.search(r"_S\d+$", d))
+				else :
+					dirs[:] = []
+		else :
+			print "Input not found: " + input_
+	return files_
+
+# Analyze all the series of all the files without dialog, on a pool of threads
+# Each file is opened once (ImageFileReader) and closed when all its series are analyzed
+def runBatch(params_):
+	files_ = listImageFiles(params_["inputs"], params_["extensions"], params_["recursive"])
+	print "Batch mode : %d file(s) to analyze on %d thread(s), %d serie(s) open at once" % (len(files_), params_["threads"], params_["maxOpenSeries"])
+	permits = Semaphore(params_["maxOpenSeries"])
+	filePermits = Semaphore(params_["maxOpenSeries"]) # files open at once
+	progress = BatchProgress()
+	if params_["cacheFolder"] is not None :
+		params_["cache"] = ResultCache(params_["cacheFolder"], int(params_["cacheSize"] * 1024 * 1024))
+		if params_["cacheClear"] :
+			params_["cache"].invalidate(files_)
+	if params_["storeFolder"] is not None :
+		params_["store"] = ResultStore(params_["storeFolder"], storeFlushRows)
+	executor = Executors.newFixedThreadPool(params_["threads"])
+	try :
+		for imagefile_ in files_ :
+			filePermits.acquire()
+			try :
+				session_ = ImageFileReader(imagefile_)
+			except (Exception, JavaException), e :
+				filePermits.release()
+				print "Cannot read %s: %s" % (imagefile_, e)
+				continue
+			session_.onClose = filePermits.release
+			series_ = params_["series"] if params_["series"] is not None else range(session_.getSeriesCount())
+			tasks_ = []
+			try :
+				for idxSerie_ in series_ :
+					if idxSerie_ >= session_.getSeriesCount() :
+						continue
+					sizeC_, sizeT_, sizeZ_ = session_.getDimensions(idxSerie_)
+					if sizeC_==1 :
+						print "%s - serie %d skipped: the script requires a multichannel image" % (imagefile_, idxSerie_+1)
+						continue
+					tasks_.append(SeriesTask(session_, idxSerie_, params_, permits, progress))
+			except (Exception, JavaException), e :
+				print "Cannot read the series of %s: %s" % (imagefile_, e)
+				tasks_ = []
+			if not tasks_ :
+				session_.close()
+				continue
+			session_.retain(len(tasks_))
+			for task in tasks_ :
+				executor.submit(task)
+	finally :
+		executor.shutdown()
+		executor.awaitTermination(Long.MAX_VALUE, TimeUnit.SECONDS)
+		if params_["store"] is not None :
+			params_["store"].close()
+			print "Batch mode : results appended to the store " + params_["storeFolder"]
+	results = progress.results
+	print "Batch mode : %d serie(s) analyzed, %d skipped, %d failure(s)" % (results[True], results[False], results[None])
+	report_ = progress.getReport()
+	saveJson(report_, params_["report"])
+	print "Batch mode : report saved in " + params_["report"]
+	print "Batch mode : peak of the images held by a serie %.1f MB, %d serie(s) open at once" % (report_["maxPeakHeldMB"], params_["maxOpenSeries"])
+	return
 
 
-#### STEP 1 : Preparation of data & analysis - Preprocessing
+#### Analysis of one serie : STEP 1 to STEP 4 (dialogs in interactive mode, parameters in batch mode)
+
+# Return True if the serie was analyzed, False if it was skipped
+def analyzeSeries(session_, idxSerie_, params_, profiler_):
+	imagefile_ = session_.imagefile
+	sizeC_, sizeT_, sizeZ_ = session_.getDimensions(idxSerie_)
+	interactive_ = params_["interactive"]
+	FRETtype_ = params_["FRETtype"]
+	tag_ = "" if interactive_ else "[%s S%d] " % (os.path.basename(imagefile_), idxSerie_+1) # prefix of the messages in batch mode
+
+	#Create Folder for the serie (Donnor and Acceptor images, ROIs and results)
+	impFolder_ = createFolder(imagefile_ , idxSerie_)
+	basename_ = os.path.basename(impFolder_)
+	profiler_.folder = impFolder_
+	profiler_.info["folder"] = impFolder_
+	storeKeys_ = (imagefile_, idxSerie_+1) # File and Serie of the rows of the results store
+	#images held by the analysis (peak bytes of each stage), computed in place, reused and released once used in the
+	#low-memory mode
+	pool_ = BufferPool(params_["lowMemory"])
+	lowMemory_ = pool_.reuse
+	profiler_.memory = pool_
+
+	#In batch mode, the ROIs of a previous analysis are reused
+	if not interactive_ :
+		backroifile_ = findSeriesFile(params_["backgroundRoi"], impFolder_)
+		markerfile_ = findSeriesFile(params_["markers"], impFolder_)
+		if not params_["backgroundSubtract"] and not params_["backgroundAuto"] and backroifile_ is None :
+			print tag_ + "Skipped: no background values and no background ROI " + str(params_["backgroundRoi"])
+			return False
+		if params_["backgroundAuto"] and params_["tileSize"] > 0 :
+			print tag_ + "Skipped: the automatic background is not available by tiles"
+			return False
+		if FRETtype_ == "Nuclei" and not params_["autoMarkers"] and markerfile_ is None :
+			print tag_ + "Skipped: no markers " + str(params_["markers"])
+			return False
+
+	#Donnor and Acceptor channels detected from the metadata and the thumbnails if not given (batch mode)
+	#(only the missing one when the other is given)
+	if not interactive_ and (params_["donor"] is None or params_["acceptor"] is None) :
+		donor, acceptor, source = detectChannels(session_, idxSerie_, params_["fretPairs"], None, params_["donor"], params_["acceptor"])
+		params_ = dict(params_) # the parameters are shared by the series
+		params_["donor"], params_["acceptor"] = donor, acceptor
+		profiler_.info["channels"] = OrderedDict([("donor", donor), ("acceptor", acceptor), ("source", source)])
+		print tag_ + "Donnor C%d and Acceptor C%d detected from the %s" % (donor, acceptor, source)
+	if not interactive_ and params_["donor"] == params_["acceptor"] :
+		raise ValueError("the Donnor and Acceptor channels must be different: C%d" % params_["donor"])
+
+	streaming_ = params_["tileSize"] > 0 and not interactive_
+	cache_ = None if interactive_ or streaming_ else params_["cache"]
+	scale_ = 1 # pixel size of the analyzed images in pixels of the serie
+	if streaming_ :
+		#the serie is read in tiles : full resolution FRET index saved as a pyramidal OME-TIFF and downsampled
+		#projection, Donnor, Acceptor and FRET index images for the segmentation and the measurements
+		print tag_ + 'STEP 2 : FRET index image by tiles'
+		profiler_.stage("stream")
+		backROI_ = None if params_["backgroundSubtract"] else readRoiZip(backroifile_)[0]
+		impProj_, impDonnor_, impAcceptor_, impFRET_ = streamSerie(session_, idxSerie_, params_, impFolder_, backROI_)
+		pool_.hold(impProj_, impDonnor_, impAcceptor_, impFRET_)
+		#the parameters in pixels are given at full resolution : scaled to the downsampled images (widths of the band and
+		#of the bins of at least one pixel), the coordinates and distances of the outputs scaled back by scale_
+		scale_ = max(int(params_["tileFactor"]), 1)
+		params_ = dict(params_)
+		for key in pixelParameters :
+			params_[key] = params_[key] / float(scale_)
+		for key in ("bandInner", "bandOuter", "profileBin") :
+			params_[key] = max(params_[key], 1.0)
+		cal_ = impFRET_.getCalibration()
+		profiler_.count(pixels=impFRET_.getWidth() * impFRET_.getHeight() * params_["tileFactor"]**2)
+		if sizeT_ > 1 :
+			print tag_ + "Only the first frame is analyzed by tiles"
+		frames_ = [0]
+	else :
+		#In batch mode, the preprocessed images of a previous run with the same parameters are reused
+		profiler_.stage("read")
+		cached_ = None
+		if cache_ is not None :
+			fileKey_ = cache_.getFileKey(imagefile_, idxSerie_)
+			backgroundKey_ = None if params_["backgroundSubtract"] or params_["backgroundAuto"] else cache_.getFileHash(backroifile_)
+			preprocessKey_ = cache_.getKey(fileKey_, "preprocess", params_["donor"], params_["acceptor"], params_["saturation"],
+				params_["sigma"], params_["backgroundSubtract"], params_["backgroundDonor"], params_["backgroundAcceptor"], backgroundKey_,
+				params_["backgroundAuto"], params_["backgroundPercentile"], params_["backgroundGrid"])
+			cached_ = cache_.load(preprocessKey_, ["projection", "donor", "acceptor"])
+		if cached_ is not None :
+			print tag_ + 'STEP 2 : preprocessed Donnor and Acceptor images from the cache'
+			impProj_, impDonnor_, impAcceptor_ = cached_
+			pool_.hold(*cached_)
+			idxDonnor_, idxAcceptor_ = params_["donor"], params_["acceptor"]
+			cal_ = session_.getCalibration(idxSerie_)
+			for imp, title in ((impDonnor_, basename_+"_c1"), (impAcceptor_, basename_+"_c2")) :
+				imp.setTitle(title)
+				imp.setCalibration(cal_)
+			saturation_ = params_["saturation"] or session_.getSaturation(idxSerie_)
+			backROI_ = None if params_["backgroundSubtract"] or params_["backgroundAuto"] else readRoiZip(backroifile_)[0]
+			profiler_.info["background"] = [cache_.loadInfo(preprocessKey_)]
+		else :
+			if interactive_ :
+				#Open a menu for selecting Donnor and Acceptor image indexes
+				print "Select Donnor, Acceptor images and the serie index to analyze"
+				idxDonnor_, idxAcceptor_ = selectChannels(session_, idxSerie_, params_["fretPairs"])
+			else :
+				idxDonnor_, idxAcceptor_ = params_["donor"], params_["acceptor"]
+			#the projection and the Donnor/Acceptor planes are read at once
+			impProj_, planes_ = session_.readSerie(idxSerie_, [idxDonnor_, idxAcceptor_])
+			pool_.hold(impProj_, *planes_.values())
+			if idxDonnor_ == idxAcceptor_ :
+				raise ValueError("the Donnor and Acceptor channels must be different")
+
+			#Extract Donnor and Acceptor images
+			print tag_ + "Process Donnor and Acceptor images"
+			cal_ = session_.getCalibration(idxSerie_)
+			impDonnor_ = extractImpFromPlanes(planes_, idxDonnor_, cal_, basename_+"_c1")
+			impAcceptor_ = extractImpFromPlanes(planes_, idxAcceptor_, cal_, basename_+"_c2")
+			pool_.release(*planes_.values())
+			planes_ = None # release the other channels
+
+
+			#### STEP 2 :  Subtract background and Calculate FRET index
+			print tag_ + 'STEP 2 : FRET index image'
+			profiler_.stage("preprocess", pixels=2 * impDonnor_.getWidth() * impDonnor_.getHeight())
+
+			#Background subtraction
+			saturation_ = params_["saturation"] or session_.getSaturation(idxSerie_)
+			impDonnor_ = removeSaturatedPixels(impDonnor_, saturation_, params_["sigma"], pool_)
+			impAcceptor_ = removeSaturatedPixels(impAcceptor_, saturation_, params_["sigma"], pool_)
+
+			backROI_ = None
+			if not params_["backgroundSubtract"] and not params_["backgroundAuto"] :
+				if interactive_ :
+					print 'Select a ROI in the background'
+					backROI_ = getBackgroundROI(impProj_)
+					saveRoiZip([backROI_], os.path.join(impFolder_, backgroundFile)) #save the background ROI for the batch mode
+				else :
+					backROI_ = readRoiZip(backroifile_)[0]
+			background_ = subtractBackgrounds(impDonnor_, impAcceptor_, params_, backROI_)
+			background_["frame"] = 1
+			profiler_.info["background"] = [background_]
+			print tag_ + "Background (%s) : Donnor %s, Acceptor %s" % (background_["method"], background_["donor"], background_["acceptor"])
+			if cache_ is not None :
+				cache_.store(preprocessKey_, {"projection" : impProj_, "donor" : impDonnor_, "acceptor" : impAcceptor_}, imagefile_, background_)
+
+		#Save Donnor and Acceptor images
+		saveImage(impDonnor_, os.path.join(impFolder_, basename_+"_c1.tif"), params_) #save Donnor image
+		saveImage(impAcceptor_, os.path.join(impFolder_, basename_+"_c2.tif"), params_) #save Acceptor image
+
+
+		#close RoiManager --- All RM will not be visible
+		if interactive_ :
+			rm = RoiManager.getInstance()
+			if rm:
+				rm.close()
+
+		thresholds_ = None
+		if FRETtype_ == "Whole cell" :
+			#thresholds chosen once on the first frame and applied to the next frames
+			if interactive_ :
+				thresholds_ = thresholdImageUI(impAcceptor_)
+			else :
+				thresholds_ = params_["thresholds"] or getAutoThresholds(impAcceptor_, "MaxEntropy dark")
+		profiler_.stage("fret", pixels=impDonnor_.getWidth() * impDonnor_.getHeight())
+		impFRET_, impError_ = CalculationFRETIndex(impDonnor_,impAcceptor_, FRETtype_ == "Whole cell", thresholds_, params_["FRETError"],
+			lowMemory_)
+		pool_.hold(impFRET_, impError_)
+		impFRET_.setTitle(FRETTitle+".tif")
+		impFRET_.setCalibration(cal_)
+		saveImage(impFRET_, os.path.join(impFolder_, FRETTitle+".tif"), params_)
+		if impError_ is not None :
+			impError_.setCalibration(cal_)
+			saveImage(impError_, os.path.join(impFolder_, FRETErrorTitle+".tif"), params_)
+		if lowMemory_ :
+			#the FRET index is in the pixels of the Donnor, the Acceptor and the error are no longer used
+			pool_.release(impAcceptor_, impError_)
+			impDonnor_ = impAcceptor_ = impError_ = None
+		frames_ = range(sizeT_)
+
+	#FRET index of a frame : the first one is already computed, the next ones are read and processed like it
+	def getFrameFRET(frame) :
+		if frame == 0 :
+			return impFRET_
+		print tag_ + "Frame %d/%d" % (frame+1, sizeT_)
+		return readFrameFRET(session_, idxSerie_, frame, params_, [idxDonnor_, idxAcceptor_], saturation_, backROI_,
+			FRETtype_ == "Whole cell", thresholds_, cal_, profiler_.info.setdefault("background", []), pool_)
+
+	if (FRETtype_ == "Whole cell") :
+		profiler_.stage("frames", frames=len(frames_))
+		table = ColumnTable(["Frame", "Area", "Mean", "StdDev"])
+		for frame in frames_ :
+			rt= ResultsTable()
+			impFrame = getFrameFRET(frame)
+			analyzer = Analyzer(impFrame, Measurements.AREA+ Measurements.MEAN +Measurements.STD_DEV, rt)
+			analyzer.measure()
+			table.addRow([frame+1] + [rt.getValue(column, 0) for column in ("Area", "Mean", "StdDev")])
+			if frame > 0 :
+				pool_.release(impFrame) # its pixels are reused by the next frame in the low-memory mode
+		if interactive_ :
+			impFRET_.show()
+			table.toResultsTable().show("Mean FRET index (%)")
+		else :
+			saveTable(table, os.path.join(impFolder_,"MeanFRETMeasurements.csv"), params_, "cells", storeKeys_) #save the measurement table
+		return True
 
-print "STEP 1 : Preparation of data & analysis - Preprocessing"
-# clear the console automatically when not in headless mode
-uiService.getDefaultUI().getConsolePane().clear()
+	#### STEP 3 :  Segmentation of nuclei  measurement
+	print tag_ + 'STEP 3 : Segmentation of nuclei'
 
-#close Result Table if opened
-if IJ.isResultsWindow() :
-	IJ.run("Clear Results", "")
-	tw = ResultsTable().getResultsWindow()
-	tw.close()
+	lutName = CommonLabelMaps.JET.getLabel()
+	lut = CommonLabelMaps.fromLabel(lutName).computeLut(255, True)
+
+	#In batch mode, the labels of a previous run with the same markers and watershed parameters are reused
+	cachedLabels_ = None
+	if cache_ is not None :
+		markersKey_ = ("auto", params_["sigma"], params_["markerDynamic"], params_["markerMinRadius"], params_["backgroundMargin"]) \
+			if params_["autoMarkers"] else cache_.getFileHash(markerfile_)
+		labelsKey_ = cache_.getKey(fileKey_, "labels", markersKey_, params_["watershedFactor"])
+		cachedLabels_ = cache_.load(labelsKey_, ["labels"])
+	if cachedLabels_ is not None :
+		print tag_ + "Labels of the nuclei from the cache"
+		impLabel = cachedLabels_[0]
+		markerRois_ = []
+	else :
+		markerRois_ = [] # nuclei points, background points and background regions to merge
+		profiler_.stage("markers")
+		if params_["autoMarkers"] :
+			#markers from the maxima of the distance map of the nuclei (Otsu mask) and background far from the nuclei
+			print tag_ + "Automatic markers for Marker-controlled Watershed"
+			impMarker, nucleiMask = getAutoMarkers(impProj_, params_["sigma"], params_["markerDynamic"],
+				params_["markerMinRadius"], params_["backgroundMargin"])
+		elif interactive_ :
+			#Draw marker for MorphoLibJ Marker-controlled Watershed
+			print "Draw marker for Marker-controlled Watershed from MorphoLibJ library"
+			IJ.setTool("multipoint")
+			impProj_.show()
+			IJ.run(impProj_, "Enhance Contrast...", "saturated=0.3 equalize")
+			waitDialog = WaitForUserDialog("ROI Selection","Please select inside each object of interest using the point selection tool.")
+			waitDialog.show()
+			markerRois_.append(impProj_.getRoi())
+			impProj_.deleteRoi()
+			if backROI_ is None :
+				backROI_ = getBackgroundROI(impProj_)
+			markerRois_.append(Line2PointRoi(backROI_))
+			impProj_.hide()
+		else :
+			markerRois_ = readRoiZip(markerfile_)
+			if streaming_ : # markers of the full resolution image
+				scale = 1.0 / scale_
+				markerRois_ = [RoiScaler.scale(roi, scale, scale, False) for roi in markerRois_]
+
+		if markerRois_ :
+			bp = ByteProcessor(impProj_.getWidth(), impProj_.getHeight())
+			bp.setColor(Color.WHITE)
+			for roi in markerRois_[:2]:
+				p = roi.getPolygon()
+				for x,y in zip(p.xpoints, p.ypoints) :
+					bp.fill(OvalRoi(x-2, y-2, 5, 5))
+			impMarker = ImagePlus("Marker Image", bp)
+			impMarker = BinaryImages.componentsLabeling(impMarker, 8, 32)
+		profiler_.stage("watershed", pixels=impProj_.getWidth() * impProj_.getHeight())
+		impLabel = computePyramidWatershed(impProj_, impMarker, params_["watershedFactor"])
+		pool_.hold(impMarker, impLabel)
+		if params_["watershedCheck"] and params_["watershedFactor"] > 1 :
+			ious = getLabelIoU(impLabel.getProcessor(), Watershed.computeWatershed(impProj_, impMarker, None, 8, True ).getProcessor())
+			if ious :
+				print tag_ + "Watershed x%d versus full resolution : mean IoU %.3f, min IoU %.3f" % (
+					int(params_["watershedFactor"]), sum(ious.values()) / len(ious), min(ious.values()))
+				print tag_ + "IoU per nucleus : " + ", ".join("%d:%.3f" % (label, iou) for label, iou in sorted(ious.items()))
+
+		#Merge regions of background and remove border label
+		print tag_ + "Merge regions of background and remove border label"
+		profiler_.stage("merge")
+		if params_["autoMarkers"] :
+			labelRoi = getBackgroundLabels(impLabel, nucleiMask)
+		elif interactive_ :
+			impLabelRGB = LabelImages.labelToRgb(impLabel, lut ,Color.BLACK)
+			impLabelRGB.show()
+			IJ.setTool("multipoint")
+			waitDialog = WaitForUserDialog("ROI Selection","Please select background regions to merge using the point selection tool.")
+			waitDialog.show()
+			labelRoi = impLabelRGB.getRoi()
+			impLabelRGB.hide()
+			impLabelRGB.deleteRoi()
+		else :
+			labelRoi = markerRois_[2] if len(markerRois_) > 2 else None
+		if labelRoi is not None :
+			if checkMerging(impLabel,labelRoi) :
+				LabelImages.mergeLabels(impLabel, labelRoi, True)
+		LabelImages.removeBorderLabels(impLabel)
+		if cache_ is not None :
+			cache_.store(labelsKey_, {"labels" : impLabel}, imagefile_)
+		if lowMemory_ :
+			pool_.release(impMarker)
+	pool_.hold(impLabel)
+	if lowMemory_ :
+		pool_.release(impProj_) # the projection is only used for the markers and the watershed
+	impLabelRGB = LabelImages.labelToRgb(impLabel, lut ,Color.WHITE)
+	pool_.hold(impLabelRGB)
+	saveImage(impLabelRGB, os.path.join(impFolder_, "LabelBordersRGB.tif"), params_)
+	if lowMemory_ :
+		pool_.release(impLabelRGB)
+	if interactive_ and markerRois_ :
+		if labelRoi is not None :
+			markerRois_.append(labelRoi)
+		saveRoiZip(markerRois_, os.path.join(impFolder_, markersFile)) #save the Rois
 
-#convert Files from #@ parameters to String 
-imagefile = inputFile.getCanonicalPath()
 
-# initialize the reader and get the OME metadata
-reader = ImageReader()
-omeMeta = MetadataTools.createOMEXMLMetadata()
-reader.setMetadataStore(omeMeta)
-reader.setId(imagefile)
-sizeC = reader.getSizeC()
-sizeT = reader.getSizeT()
-sizeZ = reader.getSizeZ()
-seriesCount = reader.getSeriesCount() #if multiple series 
-reader.close()
+	#Select the periphery of the nuclei
+	print tag_ + "Select the periphery of the nuclei"
+	profiler_.stage("contours")
+	nucleiRois = L2R(impLabel)
+	nucleiContours = [] # (label, name, contour, curvature, normals) of the nuclei with a contour of more than 10 points
+	nucleiLabels = set()
+	for label, roi0 in nucleiRois.items():
+		contour = Contour.fromPolygon(roi0.getInterpolatedPolygon(-1, True)).dedupe()
+		if params_["spacing"] :
+			contour = contour.resample(params_["spacing"])
+		if contour.size() > 10 : # exclude ROI with nb of coutour points < 10
+			nucleiContours.append((label, roi0.getName(), contour, contour.getCurvature(), contour.getNormals()))
+			nucleiLabels.add(label)
+
+	profiler_.count(rois=len(nucleiContours), points=sum(contour.size() for label, name, contour, k, normals in nucleiContours))
+	saveRoiZip([contour.toRoi(name) for label, name, contour, k, normals in nucleiContours], os.path.join(impFolder_, "RoiSet_NucleiContour.zip"), scale_) #save the Contours
 
+	#### STEP 4 :  FRET index of segmented nuclei
+	print tag_ + 'STEP 4 : FRET index of segmented nuclei'
+
+	#signed distance transform of the labels and nuclear envelope, computed once for all the frames
+	profiler_.stage("distance", pixels=impLabel.getWidth() * impLabel.getHeight())
+	maxOut = max(params_["bandOuter"], params_["dilation"])
+	fpLabelOut, dist = labelDistanceTransform(impLabel.getProcessor(), maxOut, pool_, lowMemory_) # labels grown in place in the low-memory mode
+	keep = [False] * (max(nucleiLabels) + 1 if nucleiLabels else 1)
+	for label in nucleiLabels :
+		keep[label] = True
+	fpBandLabels, fpDilated, bandBoxes, profilePixels, outsideBand = getEnvelope(fpLabelOut, dist, keep,
+		params_["bandInner"], params_["bandOuter"], params_["dilation"], params_["profileDepth"], params_["profileBin"], pool_)
+	pool_.release(fpLabelOut, FloatProcessor(fpLabelOut.getWidth(), fpLabelOut.getHeight(), dist))
+	names = dict((label, roi.getName()) for label, roi in nucleiRois.items())
+	saveRoiZip(getBandRois(fpBandLabels, bandBoxes, names), os.path.join(impFolder_, "RoiSet_NuclearBand.zip"), scale_) #save the nuclei band
+	pool_.release(fpBandLabels)
+	shapes = getLabelShapes(fpDilated, cal_, nucleiLabels) # shape of the dilated nuclei, the same for all the frames
+
+	contourTable = ColumnTable(["Frame", "IObject", "IName", "IContourPoints", "PointX", "PointY", FRETTitle, "Curvature", "NormalX", "NormalY"])
+	meanTable = ColumnTable(["Frame", "Label", "Area", "Mean", "StdDev", "Count", "Circ.", "AR", "Round", "Solidity"])
+	profileTable = ColumnTable(["Frame", "Label", "Distance", "Mean", "Count"])
+	profiler_.stage("frames", frames=len(frames_), rois=len(nucleiContours) * len(frames_))
+	for frame in frames_ :
+		impFrame = getFrameFRET(frame)
+		ipFRET = impFrame.getProcessor()
+
+		#FRET index along the contours
+		for label, name, contour, curvature, normals in nucleiContours :
+			idx, xs, ys, values = sampleContour(ipFRET, contour, params_["bilinear"])
+			n = len(idx)
+			if scale_ != 1 :
+				xs, ys = [x * scale_ for x in xs], [y * scale_ for y in ys]
+			contourTable.extend([[frame+1] * n, [label] * n, [name] * n, idx, xs, ys, values, [curvature[i] for i in idx],
+				[normals[0][i] for i in idx], [normals[1][i] for i in idx]])
+
+		#FRET index of the nuclear band and radial profiles
+		fpBand, profiles = measureBand(ipFRET, outsideBand, profilePixels, pool_)
+
+		#statistics of all nuclei at once on the dilated label image
+		stats = measureLabels(fpDilated, ipFRET, cal_, nucleiLabels, shapes)
+		for label, values in stats.items() :
+			meanTable.addRow([frame+1, label] + values)
+
+		#radial profiles of the FRET index versus the distance to the envelope
+		for label in sorted(profiles) :
+			for b, (count, s) in sorted(profiles[label].items()) :
+				profileTable.addRow([frame+1, label, (b + 0.5) * params_["profileBin"] * scale_, s / count, count])
+
+		if frame == 0 :
+			fpBand.setColorModel(ipFRET.getColorModel())
+			fpBand.setMinAndMax(ipFRET.getMin(), ipFRET.getMax())
+			impFRET_.setProcessor(fpBand) #FRET index of the nuclear band only
+			if interactive_ :
+				impFRET_.show()
+			saveImage(impFRET_, os.path.join(impFolder_, "FRET index Nuclei.tif"), params_)
+
+		#the images of the frame are no longer used (reused by the next frame in the low-memory mode), except the band
+		#of the first frame kept by impFRET_
+		pool_.release(ipFRET)
+		if frame > 0 :
+			pool_.release(fpBand)
+	pool_.release(fpDilated, outsideBand)
+
+	profiler_.stage("save", rows=contourTable.getCounter() + meanTable.getCounter() + profileTable.getCounter())
+	saveTable(contourTable, os.path.join(impFolder_,"ContourMeasurements.csv"), params_, "contours", storeKeys_) #save the measurement table
+	saveTable(meanTable, os.path.join(impFolder_,"MeanFRETMeasurements.csv"), params_, "nuclei", storeKeys_) #save the measurement table
+	saveTable(profileTable, os.path.join(impFolder_,"RadialProfileMeasurements.csv"), params_, "profiles", storeKeys_) #save the profiles
+	if interactive_ :
+		meanTable.toResultsTable().show("Mean FRET index (%)")
+	return True
 
-if sizeC==1 or sizeT>1 or sizeZ>1 : #abort script if monochannel, multiframe or multislice
-	IJ.error("nuclearFRET error", "The script requires a multichannel image with one slice and one frame ")
-	sys.exit(0)
+#---------------------------------------------------------------
+#     -----------------       Start       -----------------
+#---------------------------------------------------------------
 
-#select the serie if several
-idxSerie=0
-if seriesCount>1 :
-	gui = GenericDialog("Select image serie")
-	gui.addSlider("Image series: ", 1, seriesCount, 3)
-	gui.showDialog()
-	idxSerie = int(gui.getNextNumber()-1)
-
-#Open a menu for selecting Donnor and Acceptor image indexes
-print "Select Donnor, Acceptor images and the serie index to analyze"
-idxDonnor, idxAcceptor, idProj= getImpIndexes(imagefile, sizeC, idxSerie)
-
-
-#Extract Donnor and Acceptor images 
-print "Process Donnor and Acceptor images" 
-impDonnor = extractImpFromIndex(imagefile, idxDonnor, idxSerie)
-impAcceptor = extractImpFromIndex(imagefile, idxAcceptor, idxSerie)
-cal = impDonnor.getCalibration()
-unit = cal.getUnit()
-if unit =="micron" :
-	unit ="um"
-
-
-#### STEP 2 :  Subtract background and Calculate FRET index
-print 'STEP 2 : FRET index image'
-
-#Background subtraction
-impProj = WindowManager.getImage(idProj)
-removeSaturatedPixels(impDonnor)
-removeSaturatedPixels(impAcceptor)
-
-if backgroundSubtract:
-	impDonnor.getProcessor().subtract(backgroundDonor)
-	impAcceptor.getProcessor().subtract(backgroundAcceptor)
-else :	
-	print 'Select a ROI in the background'
-	backROI = getBackgroundROI(impProj)
-	subtractBackground(impDonnor,backROI)
-	subtractBackground(impAcceptor,backROI)
-
-
-#Create Folder for Donnor and Acceptor images & Save them
-impFolder = createFolder(imagefile , idxSerie)
-basename = os.path.basename(impFolder)
-
-IJ.saveAs(impDonnor, "TIFF",os.path.join(impFolder, basename+"_c1.tif")) #save Donnor image
-IJ.saveAs(impAcceptor, "TIFF",os.path.join(impFolder, basename+"_c2.tif")) #save Acceptor image
-
-
-#close RoiManager --- All RM will not be visible
-rm = RoiManager.getInstance()
-if rm:
-	rm.close()
-
-impFRET = CalculationFRETIndex(impDonnor,impAcceptor, FRETtype == "Whole cell")
-impFRET.setTitle(FRETTitle+".tif")
-impFRET.setCalibration(cal)
-IJ.saveAs(impFRET, "TIFF",os.path.join(impFolder, FRETTitle+".tif"))
-
-if (FRETtype == "Whole cell") :
-	impFRET.show()
-	Analyzer.setMeasurements(Measurements.AREA+ Measurements.MEAN +Measurements.STD_DEV)
-	Analyzer.setPrecision(5)
-	rt= ResultsTable() 
-	analyzer = Analyzer(impFRET,rt)
-	analyzer.measure()
-	rt.show("Mean FRET index (%)")
-else : 
-	#### STEP 3 :  Segmentation of nuclei  measurement
-	print 'STEP 3 : Segmentation of nuclei'
-
-	#Draw marker for MorphoLibJ Marker-controlled Watershed 
-	print "Draw marker for Marker-controlled Watershed from MorphoLibJ library" 
-	IJ.setTool("multipoint")
-	impProj.show()
-	IJ.run(impProj, "Enhance Contrast...", "saturated=0.3 equalize")
-	rmMarker = RoiManager(showRoiManager)
-	waitDialog = WaitForUserDialog("ROI Selection","Please select inside each object of interest using the point selection tool.")
-	waitDialog.show()
-	rmMarker.addRoi(impProj.getRoi())
-	impProj.deleteRoi()
-	if backgroundSubtract :
-		backROI = getBackgroundROI(impProj)
-	rmMarker.addRoi(Line2PointRoi(backROI))
-	impProj.hide()
-	
-
-	bp = ByteProcessor(impAcceptor.width, impAcceptor.height)
-	bp.setColor(Color.WHITE)
-	for i in range(2):
-		roi = rmMarker.getRoi(i)
-		p = roi.getPolygon()
-		for x,y in zip(p.xpoints, p.ypoints) :
-			bp.fill(OvalRoi(x-2, y-2, 5, 5))
-	impMarker = ImagePlus("Marker Image", bp) 
-	impMarker = BinaryImages.componentsLabeling(impMarker, 8, 32)
-	impLabel = Watershed.computeWatershed(impProj, impMarker, None, 8, True )
-	lutName = CommonLabelMaps.JET.getLabel()
-	lut = CommonLabelMaps.fromLabel(lutName).computeLut(255, True)    	
-	impLabelRGB = LabelImages.labelToRgb(impLabel, lut ,Color.BLACK)
-	impLabelRGB.show()
-
-	#Merge regions of background and remove border label
-	print "Merge regions of background and remove border label" 
-	IJ.setTool("multipoint")
-	waitDialog = WaitForUserDialog("ROI Selection","Please select background regions to merge using the point selection tool.")
-	waitDialog.show()
-	labelRoi = impLabelRGB.getRoi()
-	rmMarker.addRoi(labelRoi)
-	impLabelRGB.hide()
-	if checkMerging(impLabel,labelRoi) :
-		LabelImages.mergeLabels(impLabel, labelRoi, True)
-	impLabelRGB.deleteRoi()
-	LabelImages.removeBorderLabels(impLabel) 
-	impLabelRGB = LabelImages.labelToRgb(impLabel, lut ,Color.WHITE)
-	IJ.saveAs(impLabelRGB, "TIFF",os.path.join(impFolder, "LabelBordersRGB.tif"))
-	rmMarker.runCommand("Deselect") # deselect ROIs to save them all
-	rmMarker.runCommand("Save", os.path.join(impFolder, "RoiSet_Markers.zip")) #save the Rois
 
+# the analysis runs when the file is executed as a Fiji script, not when its functions are imported (benchmark)
+if __name__ in ("__main__", "__builtin__") :
 
-	#Select the periphery of the nuclei
-	print "Select the periphery of the nuclei"
-	rmNuclei = RoiManager(showRoiManager)
-	rmNucleiOut = RoiManager(showRoiManager)
-	L2R(impLabel, rmNuclei)
-	count = rmNuclei.getCount() 
-	rt = ResultsTable()
-
-	rmContour = RoiManager(showRoiManager)
-	ipFRET = impFRET.getProcessor()
-	for idx in range(count): 
-		roi0 = rmNuclei.getRoi(idx)
-		FintPol = roi0.getInterpolatedPolygon(-1, True) 
-		if FintPol.npoints > 10 : # exclude ROI with nb of coutour points < 10
-			polyroi0 = PolygonRoi(FintPol, Roi.POLYGON)
-			rmNuclei.addRoi(polyroi0)
-			Fpts = Polygon2Points(FintPol)
-			FptsSize = len(Fpts)
-			for ipts in range(FptsSize) :
-				Xpts = Fpts[ipts].getX()
-				Ypts = Fpts[ipts].getY()	
-				rt.incrementCounter()
-				rt.addValue("IObject", idx)
-				rt.addValue("IName", rmNuclei.getName(idx))
-				rt.addValue("IContourPoints", ipts)
-				rt.addValue("PointX", Xpts)
-				rt.addValue("PointY", Ypts)
-				rt.addValue(FRETTitle, ipFRET.getPixelValue(int(Xpts), int(Ypts)) )
-		
-			roiOUT = RoiEnlarger.enlarge(polyroi0, 2)
-			rmNucleiOut.addRoi(roiOUT)
-			roiIN = RoiEnlarger.enlarge(polyroi0, -1)
-			notRoi = ShapeRoi(roiOUT).xor(ShapeRoi(roiIN))
-			rmContour.addRoi(notRoi)
-	rmNuclei.setSelectedIndexes(range(count))
-	rmNuclei.runCommand(impLabel,"Delete")
-	rmNuclei.runCommand("Deselect") # deselect ROIs to save them all
-	rmNuclei.runCommand("Save", os.path.join(impFolder, "RoiSet_NucleiContour.zip")) #save the Contours
-	
-	for i in reversed(range(rt.getCounter())):
-		if 	isnan(rt.getValue(FRETTitle, i)) or rt.getValue(FRETTitle, i) == 0:
-			rt.deleteRow(i)
+	#### STEP 1 : Preparation of data & analysis - Preprocessing
 
+	print "STEP 1 : Preparation of data & analysis - Preprocessing"
+	# clear the console automatically when not in headless mode
+	if not uiService.isHeadless() :
+		uiService.getDefaultUI().getConsolePane().clear()
 
+	# global settings of the result tables, set once before the analysis of the series
 	IJ.run("Input/Output...", "jpeg=85 gif=-1 file=.csv save_column")
-	rt.saveAs(os.path.join(impFolder,"ContourMeasurements.csv")) #save the measurement table
-
-	#### STEP 4 :  FRET index of segmented nuclei
-	print 'STEP 4 : FRET index of segmented nuclei'
-	
-	rt.reset()	
-	Analyzer.setMeasurements (Measurements.AREA+ Measurements.MEAN +Measurements.STD_DEV + Measurements.SHAPE_DESCRIPTORS) 
-	rmNucleiOut.runCommand(impFRET,"Measure")
-	rt = Analyzer.getResultsTable()
-	rt.saveAs(os.path.join(impFolder,"MeanFRETMeasurements.csv")) #save the measurement table
-	IJ.renameResults("Mean FRET index (%)")
-	rmContour.runCommand("Deselect") # deselect ROIs to save them all
-	rmContour.runCommand("Save", os.path.join(impFolder, "RoiSet_NuclearBand.zip")) #save the nuclei band
-	rmContour.setSelectedIndexes(range(rmContour.getCount()))
-	rmContour.runCommand(impFRET,"Combine")
-	allRoi = impFRET.getRoi()
-	ipFRET.setValue(float('nan'))
-	ipFRET.fillOutside(allRoi)	
-	impFRET.deleteRoi()	
-	impFRET.show()
-	IJ.saveAs(impFRET, "TIFF",os.path.join(impFolder, "FRET index Nuclei.tif"))
-	
-print 'End'
+	Analyzer.setPrecision(precision)
+
+	if parameterFile is not None :
+		#### Batch mode : every serie of every file with the parameters of the file
+		runBatch(readParameterFile(parameterFile.getCanonicalPath()))
+		print 'End'
+		sys.exit(0)
+
+	if inputFile is None :
+		IJ.error("nuclearFRET error", "Select a file to analyze or a batch parameter file")
+		sys.exit(0)
+
+	#close Result Table if opened
+	if IJ.isResultsWindow() :
+		IJ.run("Clear Results", "")
+		tw = ResultsTable().getResultsWindow()
+		tw.close()
+
+	#convert Files from #@ parameters to String
+	imagefile = inputFile.getCanonicalPath()
+
+	# initialize the reader and get the OME metadata
+	session = ImageFileReader(imagefile)
+	seriesCount = session.getSeriesCount() #if multiple series
+
+	#select the serie if several
+	idxSerie=0
+	if seriesCount>1 :
+		gui = GenericDialog("Select image serie")
+		gui.addSlider("Image series: ", 1, seriesCount, 3)
+		gui.showDialog()
+		idxSerie = int(gui.getNextNumber()-1)
+
+	sizeC, sizeT, sizeZ = session.getDimensions(idxSerie)
+	if sizeC==1 : #abort script if monochannel
+		session.close()
+		IJ.error("nuclearFRET error", "The script requires a multichannel image")
+		sys.exit(0)
+
+	params = defaultParameters()
+	params.update({"FRETtype" : FRETtype, "backgroundSubtract" : backgroundSubtract,
+		"backgroundDonor" : backgroundDonor, "backgroundAcceptor" : backgroundAcceptor, "autoMarkers" : autoMarkers,
+		"backgroundAuto" : None if backgroundAuto == "None" else backgroundAuto.lower()})
+	profiler = StageProfiler(file=imagefile, serie=idxSerie+1)
+	result = None
+	try :
+		result = analyzeSeries(session, idxSerie, params, profiler)
+	finally :
+		session.close()
+		closeProfiler(profiler, result)
+
+	print 'End'